@@ -18,7 +18,7 @@ def get_version():
 
 def send_mail(subject, message, from_email, recipient_list,
               fail_silently=False, auth_user=None, auth_password=None,
-              priority=None):
+              priority=None, queue=None, send_at=None):
     """
     Add a new message to the mail queue.
 
@@ -34,12 +34,13 @@ def send_mail(subject, message, from_email, recipient_list,
     subject = force_unicode(subject)
     email_message = EmailMessage(subject, message, from_email,
                                  recipient_list)
-    queue_email_message(email_message, priority=priority)
+    queue_email_message(email_message, priority=priority, queue=queue,
+                        send_at=send_at)
 
 
 def send_html_mail(subject, message, html_message, from_email, recipient_list,
                    fail_silently=False, auth_user=None, auth_password=None,
-                   priority=None):
+                   priority=None, queue=None, send_at=None):
     """
     Add a new html email to the mail queue. This is largely the same as the
     ``send_mail`` method above, the only difference being that it passes an
@@ -51,7 +52,8 @@ def send_html_mail(subject, message, html_message, from_email, recipient_list,
                                            recipient_list)
     email_message.attach_alternative(html_message, "text/html")
     queue_email_message(email_message, priority=priority,
-                        html_message=html_message)
+                        html_message=html_message, queue=queue,
+                        send_at=send_at)
 
 
 def mail_admins(subject, message, fail_silently=False, priority=None):
@@ -103,7 +105,8 @@ def mail_managers(subject, message, fail_silently=False, priority=None):
 
 
 def queue_email_message(email_message, fail_silently=False, priority=None,
-                        html_message=''):
+                        html_message='', store_mime=None, queue=None,
+                        send_at=None):
     """
     Add new messages to the email queue.
 
@@ -111,41 +114,183 @@ def queue_email_message(email_message, fail_silently=False, priority=None,
     ``EmailMessage`` class.
 
     The messages can be assigned a priority in the queue by using the
-    ``priority`` argument.
+    ``priority`` argument, and put in a named queue other than the default one
+    with the ``queue`` argument (or the ``X-Mail-Queue`` header).
+
+    If a ``send_at`` datetime is given, the messages are not sent before that
+    time. A sending daemon wakes up to send them as soon as they are due.
+
+    If ``store_mime`` is ``True`` (it defaults to the ``MAILER_STORE_MIME``
+    setting), the fully rendered message is stored and later sent as it is,
+    keeping any cc, bcc, attachments and extra headers.
 
     The ``fail_silently`` argument is not used and is only provided to match
     the signature of the ``EmailMessage.send`` function which it may emulate
     (see ``queue_django_mail``).
 
     """
-    from django_mailer import constants, models, settings
+    from django_mailer import constants, mime, models, notify, settings, stats
 
-    if constants.PRIORITY_HEADER in email_message.extra_headers:
-        priority = email_message.extra_headers.pop(constants.PRIORITY_HEADER)
-        priority = constants.PRIORITIES.get(priority.lower())
+    priority = _get_priority(email_message, priority)
+    queue = _get_queue(email_message, queue)
 
+    if store_mime is None:
+        store_mime = settings.STORE_MIME
+    if store_mime:
+        body = models.MessageBody.objects.get_for_content(
+            mime=mime.serialize(email_message))
+    else:
+        body = models.MessageBody.objects.get_for_content(email_message.body,
+                                                          html_message)
     count = 0
     for to_email in email_message.recipients():
         message = models.Message.objects.create(
             to_address=to_email, from_address=email_message.from_email,
-            subject=email_message.subject, message=email_message.body,
-            html_message=html_message)
-        queued_message = models.QueuedMessage(message=message)
+            subject=email_message.subject, body=body)
+        queued_message = models.QueuedMessage(message=message, queue=queue)
+        if send_at:
+            queued_message.date_queued = send_at
         if priority:
             queued_message.priority = priority
         queued_message.save()
         count += 1
 
         if priority == constants.PRIORITY_EMAIL_NOW:
+            stats.update_queue(queue, queued=count)
             from django.core.mail import get_connection
             from django_mailer.engine import send_message
             connection = get_connection(backend=settings.MAILER_BACKEND)
             result = send_message(message, connection=connection)
             return (result == constants.RESULT_SENT)
     
+    if count:
+        stats.update_queue(queue, queued=count)
+        notify.notify()
+    return count
+
+
+def queue_email_messages(email_messages, batch_size=500, priority=None,
+                         recipients=None, store_mime=None, queue=None,
+                         send_at=None):
+    """
+    Add many new messages to the email queue, writing them to the database in
+    batches.
+
+    The ``email_messages`` argument can be any iterable (such as a generator)
+    of Django's core mail ``EmailMessage`` instances. The html alternative of
+    an ``EmailMultiAlternatives`` instance is queued along with it.
+
+    If ``recipients`` is provided, each of the email messages is queued for
+    every address in this iterable rather than for the message's own
+    recipients. This allows a message to be queued for a large (streamed)
+    mailing list.
+
+    Messages are written using bulk inserts of up to ``batch_size`` rows, each
+    batch in its own transaction, so memory use is bounded by the batch size
+    rather than the number of recipients.
+
+    Messages with a priority of "now" are passed on to
+    ``queue_email_message`` to be sent straight away.
+
+    The ``store_mime``, ``queue`` and ``send_at`` arguments are the same as
+    for ``queue_email_message``.
+
+    Returns the number of messages queued.
+
+    """
+    from django_mailer import constants, models, notify, settings
+
+    if store_mime is None:
+        store_mime = settings.STORE_MIME
+
+    def rows():
+        if recipients is None:
+            for email_message in email_messages:
+                message_priority = _get_priority(email_message, priority)
+                if message_priority == constants.PRIORITY_EMAIL_NOW:
+                    queue_email_message(email_message,
+                                        priority=message_priority,
+                                        html_message=_html(email_message),
+                                        store_mime=store_mime, queue=queue,
+                                        send_at=send_at)
+                    continue
+                html_message = _html(email_message)
+                message_queue = _get_queue(email_message, queue)
+                for to_email in email_message.recipients():
+                    yield (email_message, to_email, message_priority,
+                           html_message, message_queue)
+        else:
+            messages = []
+            for email_message in email_messages:
+                message_priority = _get_priority(email_message, priority)
+                if message_priority == constants.PRIORITY_EMAIL_NOW:
+                    raise ValueError("Messages with a priority of 'now' can "
+                                     "not be queued for a list of recipients.")
+                messages.append((email_message, message_priority,
+                                 _html(email_message),
+                                 _get_queue(email_message, queue)))
+            for to_email in recipients:
+                for email_message, message_priority, html_message, \
+                        message_queue in messages:
+                    yield (email_message, to_email, message_priority,
+                           html_message, message_queue)
+
+    count = 0
+    batch = []
+    for row in rows():
+        batch.append(row)
+        if len(batch) >= batch_size:
+            count += models.QueuedMessage.objects.bulk_queue(
+                batch, store_mime, send_at)
+            batch = []
+            # Let the sender get started on the batches queued so far.
+            notify.notify()
+    if batch:
+        count += models.QueuedMessage.objects.bulk_queue(batch, store_mime,
+                                                         send_at)
+        notify.notify()
     return count
 
 
+def _get_priority(email_message, priority=None):
+    """
+    Return the queue priority for an ``EmailMessage``, taken from (and
+    removing) its priority header if it has one.
+
+    """
+    from django_mailer import constants
+
+    if constants.PRIORITY_HEADER in email_message.extra_headers:
+        priority = email_message.extra_headers.pop(constants.PRIORITY_HEADER)
+        priority = constants.PRIORITIES.get(priority.lower())
+    return priority
+
+
+def _get_queue(email_message, queue=None):
+    """
+    Return the name of the queue for an ``EmailMessage``, taken from (and
+    removing) its queue header if it has one.
+
+    """
+    from django_mailer import constants
+
+    if constants.QUEUE_HEADER in email_message.extra_headers:
+        queue = email_message.extra_headers.pop(constants.QUEUE_HEADER)
+    return queue or constants.DEFAULT_QUEUE
+
+
+def _html(email_message):
+    """
+    Return the html alternative of an ``EmailMultiAlternatives`` instance (or
+    an empty string if there is none).
+
+    """
+    for content, mimetype in getattr(email_message, 'alternatives', ()):
+        if mimetype == 'text/html':
+            return content
+    return ''
+
+
 def queue_django_mail():
     """
     Monkey-patch the ``send`` method of Django's ``EmailMessage`` to just queue
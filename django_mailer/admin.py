@@ -1,13 +1,25 @@
 from django.contrib import admin
-from django_mailer import models
+from django_mailer import models, stats
 
 
 class Message(admin.ModelAdmin):
+    def content(self, obj):
+        return obj.get_content()[0]
+
+    def html_content(self, obj):
+        return obj.get_content()[1]
+    html_content.short_description = 'HTML content'
+
     list_display = ('to_address', 'subject', 'date_created')
     list_filter = ('date_created',)
-    search_fields = ('to_address', 'subject', 'from_address', 'message',)
+    # The content of messages queued by older versions is held in the
+    # message's own fields rather than its body.
+    search_fields = ('to_address', 'subject', 'from_address', 'body__message',
+                     'message',)
     date_hierarchy = 'date_created'
     ordering = ('-date_created',)
+    exclude = ('message', 'html_message')
+    readonly_fields = ('content', 'html_content')
 
 
 class MessageRelatedModelAdmin(admin.ModelAdmin):
@@ -33,7 +45,25 @@ class QueuedMessage(MessageRelatedModelAdmin):
     not_deferred.admin_order_field = 'deferred'
 
     list_display = ('id', 'message__to_address', 'message__subject',
-                    'message__date_created', 'priority', 'not_deferred')
+                    'message__date_created', 'priority', 'queue',
+                    'not_deferred', 'next_attempt')
+    list_filter = ('queue',)
+
+
+def requeue(modeladmin, request, queryset):
+    count = models.DeadLetter.objects.requeue(queryset)
+    modeladmin.message_user(request, '%s message%s put back in the queue.' %
+                            (count, count != 1 and 's were' or ' was'))
+requeue.short_description = 'Put the selected messages back in the queue'
+
+
+class DeadLetter(MessageRelatedModelAdmin):
+    list_display = ('id', 'message__to_address', 'message__subject',
+                    'priority', 'queue', 'failures', 'retries', 'reason',
+                    'date_failed')
+    list_filter = ('queue', 'date_failed')
+    search_fields = ('message__to_address', 'message__subject', 'reason')
+    actions = [requeue]
 
 
 class Blacklist(admin.ModelAdmin):
@@ -41,13 +71,60 @@ class Blacklist(admin.ModelAdmin):
 
 
 class Log(MessageRelatedModelAdmin):
+    def log_message_text(self, obj):
+        return obj.get_log_message()
+    log_message_text.short_description = 'log message'
+
     list_display = ('id', 'result', 'message__to_address', 'message__subject',
                     'date')
     list_filter = ('result',)
     list_display_links = ('id', 'result')
+    exclude = ('log_message',)
+    readonly_fields = ('log_message_text',)
+
+
+class CircuitState(admin.ModelAdmin):
+    list_display = ('key', 'failures', 'tripped', 'next_probe')
+
+
+class SendLock(admin.ModelAdmin):
+    list_display = ('name', 'owner', 'hostname', 'pid', 'acquired',
+                    'heartbeat')
+
+
+class DeliveryStat(admin.ModelAdmin):
+    list_display = ('period', 'priority', 'backend', 'sent', 'failed',
+                    'skipped')
+    list_filter = ('priority', 'backend')
+    date_hierarchy = 'period'
+
+
+class QueueStat(admin.ModelAdmin):
+    def oldest_queued(self, obj):
+        return stats.oldest_queued(obj.queue)
+
+    list_display = ('queue', 'queued', 'deferred', 'oldest_queued')
+
+    def changelist_view(self, request, extra_context=None):
+        # Bring the counters up to date (like stats.queue_depths), even if
+        # no sender has run since the mail was queued.
+        stats.fold_queue_changes()
+        return super(QueueStat, self).changelist_view(request, extra_context)
+
+
+class LogRollup(admin.ModelAdmin):
+    list_display = ('date', 'result', 'count')
+    list_filter = ('result',)
+    date_hierarchy = 'date'
 
 
 admin.site.register(models.Message, Message)
 admin.site.register(models.QueuedMessage, QueuedMessage)
+admin.site.register(models.DeadLetter, DeadLetter)
 admin.site.register(models.Blacklist, Blacklist)
 admin.site.register(models.Log, Log)
+admin.site.register(models.CircuitState, CircuitState)
+admin.site.register(models.SendLock, SendLock)
+admin.site.register(models.DeliveryStat, DeliveryStat)
+admin.site.register(models.QueueStat, QueueStat)
+admin.site.register(models.LogRollup, LogRollup)
@@ -0,0 +1,166 @@
+"""
+Archiving of old mail to compressed files (see the ``archive_mail`` command).
+
+Each archived mail is written as a line of JSON, holding the mail along with
+its logs, to a gzip-compressed file for the day the mail was created (named
+``mail-YYYY-MM-DD.jsonl.gz``). Later runs append to the existing files.
+
+``read_archive`` streams the archived records back a line at a time, and
+``email_message`` turns a record back into an ``EmailMessage`` so that it can
+be resent.
+
+"""
+
+import datetime
+import gzip
+import json
+import os
+import re
+
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+
+from django_mailer import compression, mime
+
+FILE_NAME = 'mail-%s.jsonl.gz'
+FILE_RE = re.compile(r'^mail-(\d{4}-\d{2}-\d{2})\.jsonl\.gz$')
+
+# How many archive files are kept open at once while writing.
+MAX_OPEN_FILES = 10
+
+
+def _format_date(value):
+    return value and value.isoformat()
+
+
+def message_record(message, logs=()):
+    """
+    Return the archive record for a ``Message``. ``logs`` are its ``Log``
+    entries, as ``(date, result, log_message)`` tuples.
+
+    """
+    text, html = message.get_content()
+    raw = ''
+    if message.body_id and message.body.mime:
+        raw = compression.decompress(message.body.mime)
+    return {
+        'id': message.pk,
+        'to_address': message.to_address,
+        'from_address': message.from_address,
+        'subject': message.subject,
+        'date_created': _format_date(message.date_created),
+        'message': text,
+        'html_message': html,
+        'mime': raw,
+        'logs': [{'date': _format_date(date), 'result': result,
+                  'log_message': compression.decompress(log_message)}
+                 for date, result, log_message in logs],
+    }
+
+
+class ArchiveWriter(object):
+    """
+    Appends records to the archive files in ``directory``.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, date):
+        return os.path.join(self.directory, FILE_NAME % date.isoformat())
+
+    def write(self, record, date):
+        """
+        Write a ``record`` to the file for ``date``.
+
+        """
+        archive_file = self.files.get(date)
+        if archive_file is None:
+            if len(self.files) >= MAX_OPEN_FILES:
+                self.files.pop(min(self.files)).close()
+            archive_file = gzip.open(self.path(date), 'ab')
+            self.files[date] = archive_file
+        archive_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        """
+        Make sure everything written so far is on disk.
+
+        """
+        for archive_file in self.files.values():
+            archive_file.flush()
+            os.fsync(archive_file.fileobj.fileno())
+
+    def close(self):
+        for archive_file in self.files.values():
+            archive_file.close()
+        self.files = {}
+
+
+def archive_files(directory, start=None, end=None):
+    """
+    Return the paths of the archive files in ``directory`` for mails created
+    between the ``start`` and ``end`` dates (inclusive), oldest first.
+
+    """
+    paths = []
+    for name in os.listdir(directory):
+        match = FILE_RE.match(name)
+        if not match:
+            continue
+        date = datetime.datetime.strptime(match.group(1), '%Y-%m-%d').date()
+        if (start and date < start) or (end and date > end):
+            continue
+        paths.append((date, os.path.join(directory, name)))
+    return [path for _, path in sorted(paths)]
+
+
+def read_file(path):
+    """
+    Iterate the records in an archive file, reading a line at a time.
+
+    """
+    archive_file = gzip.open(path, 'rb')
+    try:
+        for line in archive_file:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        archive_file.close()
+
+
+def read_archive(directory, start=None, end=None):
+    """
+    Iterate the records archived in ``directory`` for mails created between
+    the ``start`` and ``end`` dates (inclusive).
+
+    """
+    for path in archive_files(directory, start, end):
+        for record in read_file(path):
+            yield record
+
+
+def email_message(record, connection=None):
+    """
+    Return an ``EmailMessage`` which resends an archived mail to its
+    recipient.
+
+    """
+    if record.get('mime'):
+        return mime.RawEmailMessage(record['mime'], record['from_address'],
+                                    [record['to_address']],
+                                    subject=record['subject'],
+                                    connection=connection)
+    if record.get('html_message'):
+        msg = EmailMultiAlternatives(record['subject'], record['message'],
+                                     record['from_address'],
+                                     [record['to_address']],
+                                     connection=connection)
+        msg.attach_alternative(record['html_message'], 'text/html')
+        return msg
+    return EmailMessage(record['subject'], record['message'],
+                        record['from_address'], [record['to_address']],
+                        connection=connection)
@@ -0,0 +1,125 @@
+"""
+An in-memory index of blacklisted email addresses.
+
+"""
+
+import time
+
+from django.db.models import Max, signals
+
+from django_mailer import models, settings
+
+_index = None
+
+
+def normalize(address):
+    return address.strip().lower()
+
+
+class BlacklistIndex(object):
+    """
+    A set of blacklisted addresses which can be checked against in constant
+    time using the ``in`` operator.
+
+    Addresses are matched case-insensitively. An entry of ``*@example.com``
+    blacklists every address at the ``example.com`` domain.
+
+    """
+
+    def __init__(self):
+        self.addresses = set()
+        self.domains = set()
+        self.last_added = None
+        self.loaded = None
+        self.refreshed = None
+
+    def __contains__(self, address):
+        address = normalize(address)
+        if address in self.addresses:
+            return True
+        return address.rpartition('@')[2] in self.domains
+
+    def __len__(self):
+        return len(self.addresses) + len(self.domains)
+
+    def add(self, email):
+        email = normalize(email)
+        if email.startswith('*@'):
+            self.domains.add(email[2:])
+        else:
+            self.addresses.add(email)
+
+    def load(self):
+        """
+        (Re)load the entire blacklist.
+
+        """
+        self.addresses = set()
+        self.domains = set()
+        self.last_added = models.Blacklist.objects.aggregate(
+            last=Max('date_added'))['last']
+        queryset = models.Blacklist.objects.all()
+        if self.last_added is not None:
+            # Entries added while the blacklist is being loaded are picked up
+            # by the next refresh.
+            queryset = queryset.filter(date_added__lte=self.last_added)
+        for email in queryset.values_list('email', flat=True).iterator():
+            self.add(email)
+        self.loaded = self.refreshed = time.time()
+
+    def refresh(self):
+        """
+        Add entries added to the blacklist since it was last loaded or
+        refreshed.
+
+        The whole blacklist is reloaded every ``MAILER_BLACKLIST_RELOAD``
+        seconds so that removed entries are dropped.
+
+        """
+        if (self.loaded is None or
+                time.time() - self.loaded >= settings.BLACKLIST_RELOAD):
+            self.load()
+            return
+        queryset = models.Blacklist.objects.all()
+        if self.last_added is not None:
+            # Entries added at the same moment as the last one seen may not
+            # have been committed yet, so fetch those again too.
+            queryset = queryset.filter(date_added__gte=self.last_added)
+        for email, date_added in queryset.values_list('email', 'date_added'):
+            self.add(email)
+            if self.last_added is None or date_added > self.last_added:
+                self.last_added = date_added
+        self.refreshed = time.time()
+
+
+def get_blacklist():
+    """
+    Return the blacklist index shared by this process, refreshed with any
+    newly added entries.
+
+    The blacklist is only checked for new entries every
+    ``MAILER_BLACKLIST_REFRESH`` seconds (entries added by this process are
+    picked up straight away).
+
+    """
+    global _index
+    if _index is None:
+        _index = BlacklistIndex()
+    if (_index.refreshed is None or
+            time.time() - _index.refreshed >= settings.BLACKLIST_REFRESH):
+        _index.refresh()
+    return _index
+
+
+def _invalidate(sender, **kwargs):
+    global _index
+    _index = None
+
+
+def _added(sender, **kwargs):
+    if _index is not None:
+        # Refresh the index the next time it is used.
+        _index.refreshed = None
+
+signals.post_delete.connect(_invalidate, sender=models.Blacklist)
+signals.post_save.connect(_added, sender=models.Blacklist)
@@ -0,0 +1,177 @@
+"""
+A circuit breaker which stops sending through an email backend while it is
+unreachable.
+
+After ``MAILER_CIRCUIT_BREAKER_THRESHOLD`` consecutive connection failures
+the circuit is tripped (opened) and no more messages are taken from the
+queue. Every ``MAILER_CIRCUIT_BREAKER_PROBE_INTERVAL`` seconds one worker
+probes the backend by sending a single message (the circuit is half-open).
+If that succeeds the circuit is closed and sending resumes, otherwise it is
+tripped again.
+
+The state is stored as a ``CircuitState`` so that it is shared by every
+sending worker.
+
+"""
+
+import datetime
+import logging
+import threading
+
+from django.db import IntegrityError, transaction
+
+from django_mailer import models, settings
+from django_mailer.pool import CONNECTION_ERRORS
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+logger = logging.getLogger('django_mailer.circuit')
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, key, threshold=None, probe_interval=None):
+        self.key = key[:255]
+        if threshold is None:
+            threshold = settings.CIRCUIT_BREAKER_THRESHOLD
+        if probe_interval is None:
+            probe_interval = settings.CIRCUIT_BREAKER_PROBE_INTERVAL
+        self.threshold = threshold
+        self.probe_interval = datetime.timedelta(seconds=probe_interval)
+        self.failures = 0
+        self.state = CLOSED
+        self.next_probe = None
+
+    def refresh(self):
+        """
+        Load the state of the circuit, which may have been changed by other
+        workers. If the circuit is open and due to be probed, this worker
+        becomes the one to probe it.
+
+        """
+        if not self.threshold:
+            return
+        try:
+            next_probe = models.CircuitState.objects.filter(key=self.key) \
+                .values_list('next_probe', flat=True)[0]
+        except IndexError:
+            next_probe = None
+        if next_probe is None:
+            self.state = CLOSED
+            self.next_probe = None
+            return
+        now = datetime.datetime.now()
+        if next_probe <= now:
+            # Push the next probe back before probing, so that only this
+            # worker probes the backend now.
+            self.next_probe = now + self.probe_interval
+            claimed = models.CircuitState.objects.filter(
+                key=self.key, next_probe=next_probe).update(
+                next_probe=self.next_probe)
+            transaction.commit_unless_managed()
+            if claimed:
+                logger.warning("Probing the email backend.")
+                self.state = HALF_OPEN
+                return
+        else:
+            self.next_probe = next_probe
+        self.state = OPEN
+
+    def allow(self):
+        """
+        Return whether messages can be sent: the circuit is closed, or
+        half-open and waiting for a probe.
+
+        """
+        return self.state != OPEN
+
+    def wait_time(self):
+        """
+        Return how many seconds are left until the circuit can be probed.
+
+        """
+        if self.state != OPEN or self.next_probe is None:
+            return 0
+        delta = self.next_probe - datetime.datetime.now()
+        return max(delta.days * 86400 + delta.seconds, 0)
+
+    def record(self, error):
+        """
+        Record the result of a delivery: ``error`` is the exception raised, or
+        ``None`` if the message was sent.
+
+        Only connection level errors count as failures; any other response
+        means the backend could be reached.
+
+        """
+        if not self.threshold:
+            return
+        if isinstance(error, CONNECTION_ERRORS):
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and
+                                           self.failures >= self.threshold):
+                self.trip()
+        else:
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self.close()
+
+    def _save(self, **values):
+        def save():
+            with transaction.commit_on_success():
+                queryset = models.CircuitState.objects.filter(key=self.key)
+                if not queryset.update(**values):
+                    models.CircuitState.objects.create(key=self.key,
+                                                       **values)
+
+        try:
+            save()
+        except IntegrityError:
+            # Another worker created the state first.
+            save()
+
+    def trip(self):
+        now = datetime.datetime.now()
+        self.state = OPEN
+        self.next_probe = now + self.probe_interval
+        logger.warning("Email backend unreachable after %s connection "
+                       "failure%s, pausing sending until %s." %
+                       (self.failures, self.failures != 1 and 's' or '',
+                        self.next_probe.strftime('%Y-%m-%d %H:%M:%S')))
+        self._save(failures=self.failures, tripped=now,
+                   next_probe=self.next_probe)
+
+    def close(self):
+        logger.warning("Email backend reachable again, resuming sending.")
+        self.state = CLOSED
+        self.next_probe = None
+        self.failures = 0
+        self._save(failures=0, next_probe=None)
+
+
+def get_breaker(backend=None):
+    """
+    Return the ``CircuitBreaker`` shared by this process for ``backend``.
+
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(backend)
+        if breaker is None:
+            breaker = CircuitBreaker(backend or 'default')
+            _breakers[backend] = breaker
+        return breaker
+
+
+def reset():
+    """
+    Forget the circuit breakers of this process, so that changed settings
+    are picked up.
+
+    """
+    with _breakers_lock:
+        _breakers.clear()
@@ -0,0 +1,47 @@
+"""
+Compression of stored message content.
+
+Compressed values are stored as text: a marker prefix followed by the base64
+encoded, zlib compressed UTF-8 content. Values without the prefix are plain
+text, so compressed and uncompressed values can be mixed freely.
+
+"""
+
+import base64
+import zlib
+
+from django.utils.encoding import force_unicode, smart_str
+
+PREFIX = u'zlib+base64:'
+
+
+def is_compressed(value):
+    return bool(value) and value.startswith(PREFIX)
+
+
+def compress(value):
+    """
+    Compress a (plain) text value for storage.
+
+    The value is left as it is if compressing it wouldn't make it any smaller.
+
+    """
+    if not value:
+        return value
+    compressed = PREFIX + base64.b64encode(zlib.compress(smart_str(value)))
+    # Values which happen to start with the prefix must always be compressed
+    # so that they aren't mistaken for compressed values.
+    if len(compressed) < len(value) or value.startswith(PREFIX):
+        return compressed
+    return value
+
+
+def decompress(value):
+    """
+    Return the original text of a (possibly) compressed value.
+
+    """
+    if not is_compressed(value):
+        return value
+    data = base64.b64decode(value[len(PREFIX):])
+    return force_unicode(zlib.decompress(data))
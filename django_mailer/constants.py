@@ -16,6 +16,11 @@ PRIORITIES = {
 
 PRIORITY_HEADER = 'X-Mail-Queue-Priority'
 
+# Messages are added to the default queue unless another is named, with this
+# header or the ``queue`` argument.
+DEFAULT_QUEUE = 'default'
+QUEUE_HEADER = 'X-Mail-Queue'
+
 try:
     from django.core.mail import get_connection
     EMAIL_BACKEND_SUPPORT = True
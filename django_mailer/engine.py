@@ -5,108 +5,388 @@ Methods here actually handle the sending of queued messages.
 
 """
 
-from django_mailer import constants, models, settings
-from lockfile import FileLock, AlreadyLocked, LockTimeout
+from django.db import transaction
+from django.db.models import F, Min, Q
+from django_mailer import (circuit, compression, constants, locks, models,
+                           notify, retry, settings, stats)
+from django_mailer.blacklist import get_blacklist
+from django_mailer.logwriter import SyncLogWriter, get_log_writer
+from django_mailer.managers import delete_in
+from django_mailer.pool import (CONNECTION_ERRORS, DeliveryPool,
+                                InlineDelivery)
+from django_mailer.ratelimit import get_limiter
+from lockfile import AlreadyLocked, LockTimeout
 from socket import error as SocketError
+import datetime
+import errno
 import logging
 import os
+import re
+import select
 import smtplib
+import socket
 import tempfile
 import time
+import uuid
 
 if constants.EMAIL_BACKEND_SUPPORT:
     from django.core.mail import get_connection
 else:
     from django.core.mail import SMTPConnection as get_connection
+try:
+    from django.core.mail.message import sanitize_address
+except ImportError:
+    # Older Django versions
+    def sanitize_address(address, encoding):
+        return address
 
 LOCK_PATH = settings.LOCK_PATH or os.path.join(tempfile.gettempdir(),
                                                'send_mail')
 
+# How long to wait before checking the queue again after being notified of
+# new mail which isn't visible yet, doubling with each check for up to
+# NOTIFIED_RECHECK_FOR seconds.
+NOTIFIED_RECHECK = 0.25
+NOTIFIED_RECHECK_FOR = 5
+
+# The priorities in the order they are sent.
+PRIORITY_ORDER = sorted(set(constants.PRIORITIES.values()))
+
+# The block size used if none (or 0) is given, so that the whole queue is
+# never claimed (and its results held back) at once.
+DEFAULT_BLOCK_SIZE = 500
+
 logger = logging.getLogger('django_mailer.engine')
 
 
-def _message_queue(block_size, exclude_messages=[]):
+def _worker_id():
+    """
+    Return a (reasonably) unique identifier for this sending worker, used as
+    the owner of the leases it takes out on queued messages.
+
+    """
+    return '%s:%s:%s' % (socket.gethostname()[:60], os.getpid(),
+                         uuid.uuid4().hex[:8])
+
+
+def _message_blocks(block_size, owner, stop=None, queue=None):
     """
     A generator which iterates queued messages in blocks so that new
     prioritised messages can be inserted during iteration of a large number of
     queued messages.
 
+    Each block is claimed by taking out a lease for ``owner``, so several
+    workers can iterate the queue at the same time without sending the same
+    message twice. Leases on messages already yielded (including those sent
+    but not yet written back by a ``ResultBuffer``) are renewed every time a
+    new block is claimed.
+
+    Each priority is fetched separately, in order of when its messages are
+    due, so that every block is read off a range of the queue's index. Blocks
+    are paged through using a ``(priority, next_attempt, pk)`` cursor rather
+    than by excluding the messages which have already been seen, so the cost
+    of fetching a block doesn't grow with the number of messages that failed.
+    Messages with a higher priority than the cursor are always picked up, so
+    newly queued high priority messages still jump ahead.
+
+    If a ``stop`` event is provided, no more blocks are claimed once it is
+    set. If a ``queue`` name is provided, only messages in that queue are
+    claimed.
+
     To avoid an infinite loop, yielded messages *must* be deleted or deferred.
 
     """
-    def get_block():
-        queue = models.QueuedMessage.objects.non_deferred() \
-            .exclude(pk__in=exclude_messages).select_related()
-        if block_size:
-            queue = queue[:block_size]
-        return queue
-    queue = get_block()
-    while queue:
-        for message in queue:
+    block_size = block_size or DEFAULT_BLOCK_SIZE
+    cursor = None
+    while stop is None or not stop.is_set():
+        if cursor is not None:
+            models.QueuedMessage.objects.renew_leases(owner)
+        block = []
+        for priority in PRIORITY_ORDER:
+            queryset = _due(queue, priority)
+            if cursor is not None and priority == cursor[0]:
+                queryset = queryset.filter(
+                    Q(next_attempt__gt=cursor[1]) |
+                    Q(next_attempt=cursor[1], pk__gt=cursor[2]))
+            queryset = queryset.order_by('next_attempt', 'pk')
+            block.extend(models.QueuedMessage.objects.claim(
+                owner, limit=block_size - len(block), queryset=queryset))
+            if len(block) >= block_size:
+                break
+        if not block:
+            return
+        keys = [(message.priority, message.next_attempt, message.pk)
+                for message in block]
+        if cursor is not None:
+            keys.append(cursor)
+        cursor = max(keys)
+        yield block
+
+
+def _message_queue(block_size, owner, stop=None, queue=None):
+    """
+    Iterate the queued messages of each block from ``_message_blocks`` one
+    by one.
+
+    """
+    for block in _message_blocks(block_size, owner, stop, queue):
+        for message in block:
             yield message
-        queue = get_block()
 
 
-def send_all(block_size=500, backend=None):
+def _group(queued_messages, max_recipients, by_domain=False):
     """
-    Send all non-deferred messages in the queue.
+    Split ``queued_messages`` into lists of messages which can be delivered
+    together in a single transaction, of at most ``max_recipients`` messages.
+
+    Only messages stored fully rendered (see ``MAILER_STORE_MIME``) are
+    identical for every recipient, so only those which share their content,
+    sender and priority are grouped. Each recipient appears once in a group.
+    If ``by_domain`` is ``True``, only recipients at the same domain are
+    grouped.
 
-    A lock file is used to ensure that this process can not be started again
-    while it is already running.
+    """
+    groups = []
+    open_groups = {}
+    for queued_message in queued_messages:
+        message = queued_message.message
+        if max_recipients <= 1 or not (message.body_id and message.body.mime):
+            groups.append([queued_message])
+            continue
+        key = (queued_message.priority, message.body_id,
+               message.from_address)
+        if by_domain:
+            key += (message.to_address.rpartition('@')[2].lower(),)
+        group, addresses = open_groups.get(key, (None, None))
+        if (group is None or len(group) >= max_recipients or
+                message.to_address in addresses):
+            group, addresses = [], set()
+            groups.append(group)
+            open_groups[key] = (group, addresses)
+        group.append(queued_message)
+        addresses.add(message.to_address)
+    return groups
+
+
+def _due(queue=None, priority=None):
+    """
+    Return a QuerySet of the messages due to be sent, from the named
+    ``queue`` and of the given ``priority`` only if they are given.
+
+    """
+    queryset = models.QueuedMessage.objects.due()
+    if queue is not None:
+        queryset = queryset.filter(queue=queue)
+    if priority is not None:
+        queryset = queryset.filter(priority=priority)
+    return queryset
+
+
+def _queue_option(queue, name, default=None):
+    """
+    Return an option for the named ``queue`` from the ``MAILER_QUEUES``
+    setting, or ``default`` if it isn't set.
+
+    """
+    options = settings.QUEUES.get(queue) or {}
+    value = options.get(name)
+    if value is None:
+        return default
+    return value
+
+
+def _lock_path(queue=None):
+    """
+    Return the path of the lock file, which is separate for each queue
+    (rather than all mail) being sent.
+
+    """
+    if queue is None:
+        return LOCK_PATH
+    return '%s-%s' % (LOCK_PATH, re.sub(r'[^\w.-]', '_', queue))
+
+
+def _connection_factory(backend):
+    if constants.EMAIL_BACKEND_SUPPORT:
+        return lambda: get_connection(backend=backend)
+    return get_connection
+
+
+def get_delivery(concurrency=None, backend=None, queue=None):
+    """
+    Return an object which delivers messages through long-lived backend
+    connections: a ``DeliveryPool`` of ``concurrency`` threads, or an
+    ``InlineDelivery`` if ``concurrency`` is 1.
+
+    If ``concurrency`` isn't given, it is taken from the ``MAILER_QUEUES``
+    setting for the ``queue`` (defaulting to 1).
+
+    Connections are recycled according to the
+    ``MAILER_CONNECTION_MAX_MESSAGES`` and ``MAILER_CONNECTION_MAX_AGE``
+    settings, and reopened if the server drops them.
+
+    The delivery can be passed to ``send_all`` to keep its connections open
+    between runs. It should be closed when it is no longer needed.
+
+    """
+    if concurrency is None:
+        concurrency = _queue_option(queue, 'concurrency', 1)
+    connection_factory = _connection_factory(backend)
+    options = {'idle_timeout': settings.CONNECTION_IDLE_TIMEOUT,
+               'max_messages': settings.CONNECTION_MAX_MESSAGES,
+               'max_age': settings.CONNECTION_MAX_AGE}
+    if concurrency > 1:
+        return DeliveryPool(concurrency, connection_factory, _deliver,
+                            **options)
+    return InlineDelivery(connection_factory, _deliver, **options)
+
+
+def send_all(block_size=500, backend=None, use_lock=True, concurrency=None,
+             delivery=None, stop=None, queue=None):
+    """
+    Send all messages in the queue which are due: non-deferred messages and
+    deferred messages whose next attempt is due.
+
+    A lock (see ``django_mailer.locks``) is used to ensure that this process
+    can not be started again while it is already running.
 
     The ``block_size`` argument allows for queued messages to be iterated in
     blocks, allowing new prioritised messages to be inserted during iteration
-    of a large number of queued messages.
+    of a large number of queued messages. The results of each block are
+    written back as it is sent. A ``block_size`` of ``0`` uses the
+    ``DEFAULT_BLOCK_SIZE``.
+
+    Queued messages are claimed in leased blocks, so it is safe to run several
+    workers (on any number of hosts) in parallel by passing
+    ``use_lock=False``. Any leases still held when sending has finished are
+    released.
+
+    If ``concurrency`` is more than 1, messages are delivered by that many
+    threads, each with its own backend connection. Alternatively, a
+    ``delivery`` (see ``get_delivery``) can be provided, which is left open
+    so that its connections can be reused.
+
+    If a ``queue`` name is given, only the messages in that queue are sent,
+    taking out a lock for that queue only. Its concurrency and rate limits
+    can be set in the ``MAILER_QUEUES`` setting.
+
+    Messages to several recipients which share the same fully rendered
+    content and sender are delivered in a single transaction, to at most
+    ``MAILER_MAX_RECIPIENTS`` recipients at a time.
+
+    Mail to recipient domains which are held back by their rate limits (see
+    ``django_mailer.ratelimit``) waits while mail to other domains is sent.
+
+    Sending stops early if the backend can't be reached (see
+    ``django_mailer.circuit``), leaving the remaining messages in the queue.
+
+    If a ``stop`` event is provided, sending stops after the current block
+    once it is set.
+
+    Returns the number of messages sent, deferred or skipped (``0`` if the
+    lock couldn't be acquired).
 
     """
-    lock = FileLock(LOCK_PATH)
+    block_size = block_size or DEFAULT_BLOCK_SIZE
+    lock = None
+    if use_lock:
+        lock = locks.get_lock(_lock_path(queue))
 
-    logger.debug("Acquiring lock...")
-    try:
-        # lockfile has a bug dealing with a negative LOCK_WAIT_TIMEOUT (which
-        # is the default if it's not provided) systems which use a LinkFileLock
-        # so ensure that it is never a negative number.
-        lock.acquire(settings.LOCK_WAIT_TIMEOUT or 0)
-        #lock.acquire(settings.LOCK_WAIT_TIMEOUT)
-    except AlreadyLocked:
-        logger.debug("Lock already in place. Exiting.")
-        return
-    except LockTimeout:
-        logger.debug("Waiting for the lock timed out. Exiting.")
-        return
-    logger.debug("Lock acquired.")
+        logger.debug("Acquiring lock...")
+        try:
+            # lockfile has a bug dealing with a negative LOCK_WAIT_TIMEOUT
+            # (which is the default if it's not provided) systems which use a
+            # LinkFileLock so ensure that it is never a negative number.
+            lock.acquire(settings.LOCK_WAIT_TIMEOUT or 0)
+            #lock.acquire(settings.LOCK_WAIT_TIMEOUT)
+        except AlreadyLocked:
+            logger.debug("Lock already in place. Exiting.")
+            return 0
+        except LockTimeout:
+            logger.debug("Waiting for the lock timed out. Exiting.")
+            return 0
+        logger.debug("Lock acquired.")
 
     start_time = time.time()
+    owner = _worker_id()
 
-    sent = deferred = skipped = 0
+    counts = {constants.RESULT_SENT: 0, constants.RESULT_FAILED: 0,
+              constants.RESULT_SKIPPED: 0}
+    # Results are written back to the database a block at a time.
+    results = ResultBuffer(size=block_size, backend=backend)
 
-    # A list of messages to be sent, usually contains messages that failed
-    exclude_messages = []
+    def record(group, error):
+        for queued_message in group:
+            message = queued_message.message
+            if len(group) > 1:
+                message_error = _recipient_error(message, error)
+            else:
+                message_error = error
+            counts[_record_delivery(message, message_error,
+                                    queued_message, results)] += 1
 
+    close_delivery = delivery is None
     try:
-        if constants.EMAIL_BACKEND_SUPPORT:
-            connection = get_connection(backend=backend)
-        else:
-            connection = get_connection()
-        blacklist = models.Blacklist.objects.values_list('email', flat=True)
-        connection.open()
-        for message in _message_queue(block_size, exclude_messages=exclude_messages):
-            result = send_queued_message(message, connection=connection,
-                                  blacklist=blacklist)
-            if result == constants.RESULT_SENT:
-                sent += 1
-            elif result == constants.RESULT_FAILED:
-                deferred += 1
-                # Don't try to send this message again for now
-                exclude_messages.append(message.pk)
-            elif result == constants.RESULT_SKIPPED:
-                skipped += 1
-        connection.close()
+        breaker = circuit.get_breaker(backend)
+        breaker.refresh()
+        if not breaker.allow():
+            logger.warning("Sending paused while the email backend is "
+                           "unreachable, for %s more seconds." %
+                           breaker.wait_time())
+            return 0
+        blacklist = get_blacklist()
+        # Only start the delivery (which may start threads) once sending
+        # isn't paused, since it is only closed by the inner block below.
+        if close_delivery:
+            delivery = get_delivery(concurrency, backend, queue)
+        scheduler = _Scheduler(delivery, get_limiter(backend, queue),
+                               breaker, record, owner, lock)
+        try:
+            for block in _message_blocks(block_size, owner, stop, queue):
+                if not scheduler.heartbeat():
+                    # Another sender broke the lock, thinking this one had
+                    # died. Leave the queue to it.
+                    break
+                queued = []
+                for queued_message in block:
+                    if _is_blacklisted(queued_message.message, blacklist):
+                        counts[_skip(queued_message, results)] += 1
+                    else:
+                        queued.append(queued_message)
+                scheduler.add(_group(queued, settings.MAX_RECIPIENTS,
+                                     by_domain=scheduler.limiter.enabled))
+                # Don't claim messages more than a block ahead of what the
+                # rate limits allow to be sent.
+                scheduler.run(stop, limit=block_size)
+                if scheduler.lock_lost or not breaker.allow():
+                    # Leave the rest of the queue until the backend can be
+                    # reached again.
+                    break
+            scheduler.run(stop)
+        finally:
+            scheduler.collect(wait=True)
+            if close_delivery:
+                delivery.close()
     finally:
-        logger.debug("Releasing lock...")
-        lock.release()
-        logger.debug("Lock released.")
+        try:
+            results.flush()
+            if close_delivery:
+                # Unless a sending daemon is flushing the logs in the
+                # background, write them before finishing.
+                get_log_writer().flush()
+        finally:
+            models.QueuedMessage.objects.release_leases(owner)
+            if lock is not None and lock.i_am_locking():
+                logger.debug("Releasing lock...")
+                lock.release()
+                logger.debug("Lock released.")
+
+    # Bring the queue depth counters up to date.
+    stats.fold_queue_changes()
 
+    sent = counts[constants.RESULT_SENT]
+    deferred = counts[constants.RESULT_FAILED]
+    skipped = counts[constants.RESULT_SKIPPED]
     logger.debug("")
     if sent or deferred or skipped:
         log = logger.warning
@@ -114,9 +394,11 @@ def send_all(block_size=500, backend=None):
         log = logger.info
     log("%s sent, %s deferred, %s skipped." % (sent, deferred, skipped))
     logger.debug("Completed in %.2f seconds." % (time.time() - start_time))
+    return sent + deferred + skipped
 
 
-def send_loop(empty_queue_sleep=None):
+def send_loop(empty_queue_sleep=None, block_size=500, backend=None,
+              use_lock=True, concurrency=None, stop=None, queue=None):
     """
     Loop indefinitely, checking queue at intervals and sending and queued
     messages.
@@ -125,18 +407,136 @@ def send_loop(empty_queue_sleep=None):
     argument. The default is attempted to be retrieved from the
     ``MAILER_EMPTY_QUEUE_SLEEP`` setting (or if not set, 30s is used).
 
+    While the queue is empty, the loop is woken up straight away when new
+    mail is queued (see ``django_mailer.notify``), or when the next scheduled
+    message or retry is due, so the interval is only a fallback.
+
+    Backend connections are kept open from one run to the next, and only
+    closed after being idle for ``MAILER_CONNECTION_IDLE_TIMEOUT`` seconds.
+    Logs are written by the log writer in the background.
+
+    If a ``stop`` event is provided, the loop finishes sending the current
+    block and returns once it is set. The other arguments are passed on to
+    ``send_all``.
+
     """
     empty_queue_sleep = empty_queue_sleep or settings.EMPTY_QUEUE_SLEEP
-    while True:
-        while not models.QueuedMessage.objects.all():
-            logger.debug("Sleeping for %s seconds before checking queue "
-                          "again." % empty_queue_sleep)
-            time.sleep(empty_queue_sleep)
-        send_all()
+    listener = notify.get_listener()
+    delivery = get_delivery(concurrency, backend, queue)
+    breaker = circuit.get_breaker(backend)
+    log_writer = get_log_writer()
+    log_writer.start()
+
+    def stopped():
+        return stop is not None and stop.is_set()
+
+    try:
+        while not stopped():
+            timeout = empty_queue_sleep
+            rechecks_end = None
+            while not stopped() and not _queue_has_mail(queue):
+                delivery.close_idle()
+                wait = timeout
+                if settings.CONNECTION_IDLE_TIMEOUT:
+                    wait = min(wait, settings.CONNECTION_IDLE_TIMEOUT)
+                due = _next_due(queue)
+                if due is not None:
+                    wait = min(wait, due)
+                logger.debug("Waiting up to %s seconds before checking "
+                             "queue again." % wait)
+                if _wait(listener, wait, stopped):
+                    # The notification may have arrived before the new mail
+                    # was committed (socket notifications are sent straight
+                    # away, even inside a transaction), so keep checking
+                    # again soon while it can't be seen yet.
+                    timeout = NOTIFIED_RECHECK
+                    rechecks_end = time.time() + NOTIFIED_RECHECK_FOR
+                elif rechecks_end is not None and time.time() < rechecks_end:
+                    timeout = min(timeout * 2, rechecks_end - time.time())
+                else:
+                    timeout = empty_queue_sleep
+                    rechecks_end = None
+            if stopped():
+                break
+            count = send_all(block_size, backend=backend, use_lock=use_lock,
+                             delivery=delivery, stop=stop, queue=queue)
+            if not breaker.allow():
+                # Wait for the backend to be probed again.
+                _wait(None, max(breaker.wait_time(), 1), stopped)
+            elif not count:
+                # Another process holds the lock or claimed the mail first,
+                # so don't check again straight away.
+                _wait(listener, empty_queue_sleep, stopped)
+    finally:
+        delivery.close()
+        log_writer.close()
+        if listener is not None:
+            listener.close()
+
+
+def _wait(listener, timeout, stopped):
+    """
+    Wait up to ``timeout`` seconds for a notification of new mail, returning
+    whether one was received. Waiting ends early if ``stopped()`` becomes
+    true.
+
+    """
+    if listener is not None:
+        try:
+            return listener.wait(timeout)
+        except select.error, err:
+            # Interrupted by a signal (which may have stopped the loop).
+            if err.args[0] != errno.EINTR:
+                raise
+            return False
+    end = time.time() + timeout
+    while not stopped():
+        remaining = end - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, 1))
+    return False
+
+
+def _next_due(queue=None):
+    """
+    Return the seconds until the next message scheduled for later (or
+    deferred message) is due to be sent, or ``None`` if there are none.
+
+    """
+    now = datetime.datetime.now()
+    queryset = models.QueuedMessage.objects.filter(next_attempt__gt=now)
+    if queue is None:
+        times = [queryset.aggregate(next=Min('next_attempt'))['next']]
+    else:
+        # Look up each priority separately, so that each lookup can be read
+        # off the queue's index.
+        times = [queryset.filter(queue=queue, priority=priority).aggregate(
+                     next=Min('next_attempt'))['next']
+                 for priority in PRIORITY_ORDER]
+    times = [due for due in times if due is not None]
+    if not times:
+        return None
+    delta = min(times) - now
+    return max(delta.days * 86400 + delta.seconds +
+               delta.microseconds / 1000000.0, 0)
+
+
+def _queue_has_mail(queue=None):
+    # End the current transaction first so that newly committed mail is
+    # visible.
+    transaction.commit_unless_managed()
+    if queue is None:
+        return _due().unleased().exists()
+    # As in _next_due, each priority is looked up separately.
+    for priority in PRIORITY_ORDER:
+        if _due(queue, priority).unleased().exists():
+            return True
+    return False
 
 
 def send_queued_message(queued_message, connection=None, blacklist=None,
-                 log=True):
+                 log=True, results=None):
     """
     Send a queued message, returning a response code as to the action taken.
 
@@ -148,7 +548,8 @@ def send_queued_message(queued_message, connection=None, blacklist=None,
     To allow optimizations if multiple messages are to be sent, a
     connection can be provided and a list of blacklisted email addresses.
     Otherwise a new connection will be opened to send this message and the
-    email recipient address checked against the ``Blacklist`` table.
+    email recipient address checked against the process-wide index of the
+    ``Blacklist`` table.
 
     If the message recipient is blacklisted, the message will be removed from
     the queue without being sent. Otherwise, the message is attempted to be
@@ -158,6 +559,10 @@ def send_queued_message(queued_message, connection=None, blacklist=None,
     By default, a log is created as to the action. Either way, the original
     message is not deleted.
 
+    The changes to the queue and the log are written straight away unless a
+    ``ResultBuffer`` is passed as ``results``, in which case they are written
+    when the buffer is flushed.
+
     """
     message = queued_message.message
     if connection is None:
@@ -167,18 +572,15 @@ def send_queued_message(queued_message, connection=None, blacklist=None,
     else:
         arg_connection = True
 
-    if blacklist is None:
-        blacklisted = models.Blacklist.objects.filter(email=message.to_address)
+    if _is_blacklisted(message, blacklist):
+        result = _skip(queued_message, results)
     else:
-        blacklisted = message.to_address in blacklist
-
-    if blacklisted:
-        logger.info("Not sending to blacklisted email: %s" %
-                     message.to_address.encode("utf-8"))
-        queued_message.delete()
-        result = constants.RESULT_SKIPPED
-    else:
-        result = send_message(message, connection=connection)
+        try:
+            _deliver(message, connection)
+        except Exception, err:
+            result = _record_delivery(message, err, queued_message, results)
+        else:
+            result = _record_delivery(message, None, queued_message, results)
 
     if not arg_connection:
         connection.close()
@@ -205,24 +607,436 @@ def send_message(message, connection=None):
     opened_connection = False
 
     try:
-        logger.info("Sending message to %s: %s" %
-                     (message.to_address.encode("utf-8"),
-                      message.subject.encode("utf-8")))
-        message.email_message(connection=connection).send()
-        message.queuedmessage.delete()
-        result = constants.RESULT_SENT
-        log_message = 'Sent'
+        _deliver(message, connection)
     except Exception, err:
-        if isinstance(err, settings.DEFER_ON_ERRORS):
-            message.queuedmessage.defer()
-        logger.warning("Message to %s deferred due to failure: %s" %
-                        (message.to_address.encode("utf-8"), err))
-        log_message = unicode(err)
-        result = constants.RESULT_FAILED
-    
-    models.Log.objects.create(message=message, result=result,
-                              log_message=log_message)
+        result = _record_delivery(message, err)
+    else:
+        result = _record_delivery(message)
 
     if opened_connection:
         connection.close()
     return result
+
+
+def _is_blacklisted(message, blacklist=None):
+    """
+    Check whether the message recipient is blacklisted, either against the
+    ``blacklist`` provided or (if ``None``) the shared ``BlacklistIndex``.
+
+    """
+    if blacklist is None:
+        blacklist = get_blacklist()
+    return message.to_address in blacklist
+
+
+def _skip(queued_message, results=None):
+    """
+    Remove a message to a blacklisted recipient from the queue.
+
+    """
+    logger.info("Not sending to blacklisted email: %s" %
+                 queued_message.message.to_address.encode("utf-8"))
+    if results is None:
+        buffer = ResultBuffer(log_writer=SyncLogWriter())
+    else:
+        buffer = results
+    buffer.add(queued_message, constants.RESULT_SKIPPED)
+    if results is None:
+        buffer.flush()
+    return constants.RESULT_SKIPPED
+
+
+class PartiallyRefused(smtplib.SMTPRecipientsRefused):
+    """
+    Raised when some of the recipients of a group of messages were refused,
+    with just those recipients. The message was sent to the others.
+
+    """
+
+
+def _deliver(message, connection):
+    """
+    Send a ``Message`` through the ``connection``, raising an exception if
+    sending failed.
+
+    ``message`` can also be a list of messages grouped by ``_group``, which
+    are sent together (see ``_deliver_group``).
+
+    This function does not touch the database, so is safe to call from any
+    thread.
+
+    """
+    if isinstance(message, list):
+        return _deliver_group(message, connection)
+    logger.info("Sending message to %s: %s" %
+                 (message.to_address.encode("utf-8"),
+                  message.subject.encode("utf-8")))
+    message.email_message(connection=connection).send()
+
+
+def _deliver_group(messages, connection):
+    """
+    Send a group of messages sharing the same rendered content and sender to
+    all their recipients in a single SMTP transaction.
+
+    If some recipients are refused, ``PartiallyRefused`` is raised with just
+    those recipients; the message was sent to the others. If all of them are
+    refused, smtplib's ``SMTPRecipientsRefused`` is raised (keyed by the
+    original addresses). Backends other than the SMTP backend are handed a
+    single message to every recipient, so any error applies to all of them.
+
+    """
+    addresses = [message.to_address for message in messages]
+    logger.info("Sending message to %s recipients (%s): %s" %
+                 (len(addresses), ', '.join(addresses).encode("utf-8"),
+                  messages[0].subject.encode("utf-8")))
+    email_message = messages[0].email_message(connection=connection)
+    smtp = getattr(connection, 'connection', None)
+    if not isinstance(smtp, smtplib.SMTP):
+        email_message.to = addresses
+        email_message.send()
+        return
+    encoding = email_message.encoding
+    recipients = {}
+    for address in addresses:
+        recipients[sanitize_address(address, encoding)] = address
+    def original(refused):
+        # smtplib reports the addresses it was given, so map them back to
+        # the addresses of the messages.
+        return dict((recipients.get(address, address), response)
+                    for address, response in refused.items())
+    try:
+        refused = smtp.sendmail(
+            sanitize_address(email_message.from_email, encoding),
+            [sanitize_address(address, encoding) for address in addresses],
+            email_message.message().as_string())
+    except smtplib.SMTPRecipientsRefused, err:
+        raise smtplib.SMTPRecipientsRefused(original(err.recipients))
+    if refused:
+        raise PartiallyRefused(original(refused))
+
+
+def _recipient_error(message, error):
+    """
+    Return the error for the recipient of ``message`` from the ``error``
+    raised delivering the group it was sent with.
+
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused) and \
+            isinstance(error.recipients, dict):
+        response = error.recipients.get(message.to_address)
+        if response is None:
+            if isinstance(error, PartiallyRefused):
+                # Only other recipients were refused.
+                return None
+            # Nothing is known about this recipient, so don't assume the
+            # message was sent.
+            return error
+        return smtplib.SMTPRecipientsRefused({message.to_address: response})
+    return error
+
+
+def _record_delivery(message, error=None, queued_message=None, results=None):
+    """
+    Record the outcome of an attempt to deliver ``message``, returning a
+    response code as to the action taken.
+
+    If the message was sent successfully (``error`` is ``None``) it is removed
+    from the queue. Otherwise the message is deferred if ``error`` is one of
+    the ``DEFER_ON_ERRORS``, or else its failure is counted unless the
+    connection to the backend was lost. Either way, a log is created.
+
+    The changes are added to the ``results`` buffer if one is provided,
+    otherwise they are written straight away (log included).
+
+    """
+    if results is None:
+        buffer = ResultBuffer(log_writer=SyncLogWriter())
+    else:
+        buffer = results
+    if queued_message is None:
+        queued_message = message.queuedmessage
+    defer = False
+    count_failure = False
+    if error is None:
+        result = constants.RESULT_SENT
+        log_message = 'Sent'
+    else:
+        defer = isinstance(error, settings.DEFER_ON_ERRORS)
+        # Losing the connection to the backend says nothing about the
+        # message, so it doesn't count towards its dead letter failures.
+        count_failure = not isinstance(error, CONNECTION_ERRORS)
+        logger.warning("Message to %s deferred due to failure: %s" %
+                        (message.to_address.encode("utf-8"), error))
+        log_message = unicode(error)
+        result = constants.RESULT_FAILED
+    buffer.add(queued_message, result, log_message, defer=defer,
+               count_failure=count_failure)
+    if results is None:
+        buffer.flush()
+    return result
+
+
+class _Scheduler(object):
+    """
+    Submits groups of queued messages (see ``_group``) to a ``delivery`` as
+    the ``limiter`` allows, holding back the groups to throttled domains while
+    the others are sent.
+
+    Nothing is submitted while the circuit ``breaker`` is open. While it is
+    half-open, each group is delivered before the next one is submitted.
+
+    ``record`` is called with each group and the error (if any) raised
+    delivering it. If an ``owner`` is given, its leases are renewed as groups
+    are submitted and collected (including while groups are held back), so
+    that no other worker claims them however long a block takes to send.
+    Likewise, the heartbeat of the sender's ``lock`` (if any) is kept up, and
+    nothing more is submitted once the lock has been lost.
+
+    """
+
+    def __init__(self, delivery, limiter, breaker, record, owner=None,
+                 lock=None):
+        self.delivery = delivery
+        self.limiter = limiter
+        self.breaker = breaker
+        self.record = record
+        self.owner = owner
+        self.lock = lock
+        self.lock_lost = False
+        self.renewed = time.time()
+        self.waiting = []
+
+    def _domain(self, group):
+        return self.limiter.domain(group[0].message.to_address)
+
+    def add(self, groups):
+        self.waiting.extend(groups)
+        self.submit()
+
+    def submit(self):
+        """
+        Submit each waiting group which the limits allow to be sent, returning
+        the seconds until the next of the rest might be (or ``None`` if there
+        are none left).
+
+        """
+        self.renew_leases()
+        if not self.heartbeat():
+            return None
+        waiting, self.waiting = self.waiting, []
+        next_try = None
+        for i, group in enumerate(waiting):
+            if self.lock_lost or not self.breaker.allow():
+                self.waiting.extend(waiting[i:])
+                return None
+            wait = self.limiter.acquire(self._domain(group), len(group))
+            if wait:
+                self.waiting.append(group)
+                if next_try is None or wait < next_try:
+                    next_try = wait
+                continue
+            messages = [queued_message.message for queued_message in group]
+            if len(messages) == 1:
+                messages = messages[0]
+            self.delivery.submit(group, messages)
+            self.collect(wait=self.breaker.state == circuit.HALF_OPEN)
+        return next_try
+
+    def collect(self, wait=False):
+        """
+        Record the deliveries which have finished, or all submitted
+        deliveries if ``wait`` is ``True``.
+
+        """
+        for group, error in self.delivery.completed(wait):
+            self.limiter.release(self._domain(group))
+            self.breaker.record(error)
+            self.record(group, error)
+            self.renew_leases()
+            self.heartbeat()
+
+    def run(self, stop=None, limit=0):
+        """
+        Keep submitting waiting groups until no more than ``limit`` are left,
+        the ``stop`` event is set, the circuit breaker is open or the lock has
+        been lost.
+
+        """
+        while len(self.waiting) > limit:
+            if (stop is not None and stop.is_set()) or self.lock_lost or \
+                    not self.breaker.allow():
+                return
+            wait = self.submit()
+            if len(self.waiting) > limit and self.breaker.allow() and \
+                    not self.lock_lost:
+                time.sleep(min(wait, 1))
+                self.collect()
+
+    def renew_leases(self):
+        """
+        Renew the owner's leases if a quarter of the lease time has passed
+        since they were last renewed.
+
+        """
+        if self.owner is None or \
+                time.time() - self.renewed < settings.LEASE_SECONDS / 4.0:
+            return
+        models.QueuedMessage.objects.renew_leases(self.owner)
+        self.renewed = time.time()
+
+    def heartbeat(self):
+        """
+        Keep up the heartbeat of the lock, returning whether it is still held
+        (always ``True`` if there is no lock).
+
+        """
+        if self.lock is not None and not self.lock_lost and \
+                not self.lock.heartbeat():
+            self.lock_lost = True
+        return not self.lock_lost
+
+
+class ResultBuffer(object):
+    """
+    Collects the changes resulting from delivery attempts so that they can be
+    written back to the database together in a single transaction: one
+    ``DELETE`` for sent messages, an ``UPDATE`` for the deferred messages
+    sharing each number of retries and next attempt (see
+    ``retry.JITTER_STEPS``), one ``UPDATE`` counting the failures of the other
+    failed messages and one bulk ``INSERT`` of dead letters. The logs are
+    handed to the ``log_writer`` (by default, the process's shared writer; see
+    ``django_mailer.logwriter``) which writes them in the same transaction or
+    buffers them. The delivery statistics and queue depths (see
+    ``django_mailer.stats``) are updated in the same transaction, counting
+    deliveries as made through ``backend``.
+
+    If ``size`` is given, the buffer is flushed automatically once that many
+    results have been collected, or once the oldest of them has been waiting
+    for half the ``MAILER_LEASE_SECONDS``.
+
+    Since the messages in the buffer are still leased by the sending worker,
+    no other worker will pick them up before the buffer has been flushed (as
+    long as their leases are renewed while sending).
+
+    """
+
+    def __init__(self, size=None, log_writer=None, backend=None):
+        self.size = size
+        self.stats = stats.StatsBuffer(backend)
+        if log_writer is None:
+            log_writer = get_log_writer()
+        self.log_writer = log_writer
+        self.count = 0
+        self.started = None
+        self.removed = []
+        self.deferred_at = None
+        self.deferred = {}
+        self.failed = []
+        self.dead = []
+        self.logs = []
+
+    def __len__(self):
+        return self.count
+
+    def add(self, queued_message, result, log_message=None, defer=False,
+            count_failure=True):
+        """
+        Add the ``result`` of an attempt to send a queued message.
+
+        Sent or skipped messages are removed from the queue, failed messages
+        are deferred if ``defer`` is ``True`` or otherwise have their failure
+        counted (unless ``count_failure`` is ``False``). Messages which have
+        failed too many times are moved to the dead letters. A log is created
+        if a ``log_message`` is provided.
+
+        """
+        was_deferred = queued_message.deferred and 1 or 0
+        dead = False
+        if result == constants.RESULT_FAILED:
+            if defer:
+                if was_deferred:
+                    # This was a retry of a deferred message.
+                    queued_message.retries += 1
+                dead = bool(settings.DEAD_LETTER_RETRIES and
+                            queued_message.retries >=
+                            settings.DEAD_LETTER_RETRIES)
+            elif count_failure:
+                queued_message.failures += 1
+                dead = bool(settings.DEAD_LETTER_FAILURES and
+                            queued_message.failures >=
+                            settings.DEAD_LETTER_FAILURES)
+        if dead:
+            logger.warning("Moving message to %s to the dead letters." %
+                           queued_message.message.to_address.encode("utf-8"))
+            self.dead.append(models.DeadLetter(
+                message_id=queued_message.message_id,
+                priority=queued_message.priority, queue=queued_message.queue,
+                failures=queued_message.failures,
+                retries=queued_message.retries, reason=log_message or '',
+                date_queued=queued_message.date_queued))
+        if dead or result in (constants.RESULT_SENT,
+                              constants.RESULT_SKIPPED):
+            self.removed.append(queued_message.pk)
+            self.stats.queue_changed(queued_message.queue, queued=-1,
+                                     deferred=-was_deferred)
+        elif defer:
+            if not was_deferred:
+                self.stats.queue_changed(queued_message.queue, deferred=1)
+            # Each message gets its own next attempt, but those deferred with
+            # the same number of retries and next attempt are written
+            # together.
+            if self.deferred_at is None:
+                self.deferred_at = datetime.datetime.now()
+            queued_message.deferred = self.deferred_at
+            queued_message.next_attempt = retry.next_attempt(
+                queued_message.retries, self.deferred_at)
+            self.deferred.setdefault(
+                (queued_message.retries, queued_message.next_attempt),
+                []).append(queued_message.pk)
+        elif result == constants.RESULT_FAILED and count_failure:
+            self.failed.append(queued_message.pk)
+        self.stats.delivered(queued_message.priority, result)
+        if log_message is not None:
+            if settings.COMPRESS:
+                log_message = compression.compress(log_message)
+            self.logs.append(models.Log(message_id=queued_message.message_id,
+                                        result=result,
+                                        log_message=log_message))
+        self.count += 1
+        if self.started is None:
+            self.started = time.time()
+        if self.size and (self.count >= self.size or time.time() -
+                          self.started >= settings.LEASE_SECONDS / 2.0):
+            self.flush()
+
+    def flush(self):
+        """
+        Write all collected results to the database.
+
+        """
+        if not self.count:
+            return
+        removed, deferred, logs = self.removed, self.deferred, self.logs
+        failed, dead, deferred_at = self.failed, self.dead, self.deferred_at
+        self.removed, self.deferred, self.logs = [], {}, []
+        self.deferred_at = None
+        self.failed, self.dead = [], []
+        self.count = 0
+        self.started = None
+        with transaction.commit_on_success():
+            if dead:
+                models.DeadLetter.objects.bulk_create(dead)
+            if removed:
+                delete_in(models.QueuedMessage, 'id', removed)
+            for (retries, next_attempt), pks in deferred.items():
+                models.QueuedMessage.objects.filter(pk__in=pks).update(
+                    deferred=deferred_at, retries=retries,
+                    next_attempt=next_attempt)
+            if failed:
+                models.QueuedMessage.objects.filter(pk__in=failed).update(
+                    failures=F('failures') + 1)
+            self.stats.flush()
+            if logs:
+                self.log_writer.write(logs)
+        self.log_writer.flush(force=False)
@@ -0,0 +1,400 @@
+"""
+Locks which stop more than one ``send_mail`` process sending the same queue.
+
+The backend is chosen by the ``MAILER_LOCK_BACKEND`` setting:
+
+``FlockLock``
+    An ``fcntl.flock`` lock on a file, which the kernel releases as soon as
+    the holding process dies. Only shared by processes on the same host.
+    The default where ``fcntl`` is available.
+
+``DatabaseLock``
+    A row in the ``SendLock`` table, shared by processes on every host using
+    the database.
+
+``FileLock``
+    The lock files of ``django_mailer.lockfile``. The default elsewhere.
+
+Each lock records its holder's host and process id along with a heartbeat,
+which the holder refreshes while sending. A lock whose heartbeat is older
+than ``MAILER_LOCK_STALE_AFTER`` seconds, or whose holder is known to have
+died (a process on the same host which no longer exists), is stale and is
+broken by the next process trying to take it out.
+
+The locks raise the ``django_mailer.lockfile`` exceptions.
+
+"""
+
+import datetime
+import errno
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows.
+    fcntl = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils.importlib import import_module
+
+from django_mailer import lockfile, models, settings
+from django_mailer.lockfile import AlreadyLocked, LockTimeout, NotLocked
+
+logger = logging.getLogger('django_mailer.locks')
+
+# How often (in seconds) to try again while waiting for a lock.
+POLL_INTERVAL = 0.1
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class BaseLock(object):
+    """
+    A lock identified by ``path``. Subclasses implement ``_claim``,
+    ``_heartbeat``, ``_release``, ``_break`` and ``owner_info``.
+
+    """
+
+    def __init__(self, path, stale_after=None):
+        if stale_after is None:
+            stale_after = settings.LOCK_STALE_AFTER
+        self.path = path
+        self.stale_after = stale_after
+        self.hostname = socket.gethostname()
+        self.pid = os.getpid()
+        self.owner = '%s:%s:%s' % (self.hostname[:60], self.pid,
+                                   uuid.uuid4().hex[:8])
+        self.locked = False
+        self.last_heartbeat = None
+
+    def owner_data(self):
+        return {'owner': self.owner, 'hostname': self.hostname,
+                'pid': self.pid, 'heartbeat': time.time()}
+
+    def owner_info(self):
+        """
+        Return a dictionary describing the current holder of the lock
+        (``owner``, ``hostname``, ``pid`` and ``heartbeat``, a timestamp), or
+        ``None`` if it isn't held (or this isn't known).
+
+        """
+        raise NotImplementedError
+
+    def is_stale(self, info):
+        """
+        Return whether the lock held by the holder described by ``info``
+        should be broken.
+
+        """
+        if info is None:
+            return False
+        if info.get('hostname') == self.hostname and info.get('pid') and \
+                info.get('pid') != self.pid and not _pid_alive(info['pid']):
+            return True
+        return bool(self.stale_after and info.get('heartbeat') is not None
+                    and time.time() - info['heartbeat'] > self.stale_after)
+
+    def acquire(self, timeout=None):
+        """
+        Acquire the lock, waiting for up to ``timeout`` seconds (forever if
+        ``None``). ``AlreadyLocked`` is raised if the lock is held and
+        ``timeout`` is ``0``, ``LockTimeout`` if waiting for it timed out.
+
+        """
+        if timeout is not None:
+            end_time = time.time() + max(timeout, 0)
+        while True:
+            if self._claim():
+                break
+            info = self.owner_info()
+            if self.is_stale(info):
+                logger.warning("Breaking the stale lock held by %s." %
+                               (info.get('owner') or 'an unknown process'))
+                if self._break(info):
+                    continue
+            if timeout is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    if timeout > 0:
+                        raise LockTimeout
+                    raise AlreadyLocked
+            else:
+                remaining = POLL_INTERVAL
+            time.sleep(min(POLL_INTERVAL, remaining))
+        self.locked = True
+        self.last_heartbeat = time.time()
+
+    def heartbeat(self):
+        """
+        Record that the holder of the lock is still alive, returning whether
+        the lock is still held (it may have been broken by another process if
+        the heartbeat stopped for too long).
+
+        The heartbeat is only actually written every tenth of the
+        ``stale_after`` time, so this can be called as often as is
+        convenient.
+
+        """
+        if not self.locked:
+            return False
+        if time.time() - self.last_heartbeat < (self.stale_after or 0) / 10.0:
+            return True
+        if not self._heartbeat():
+            logger.warning("The lock has been taken by another process.")
+            self.locked = False
+            return False
+        self.last_heartbeat = time.time()
+        return True
+
+    def release(self):
+        if not self.locked:
+            raise NotLocked
+        self.locked = False
+        self._release()
+
+    def i_am_locking(self):
+        return self.locked
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FlockLock(BaseLock):
+    """
+    A lock taken out with ``fcntl.flock`` on the file ``path + '.lock'``,
+    which holds the holder's details.
+
+    The kernel releases the lock when its holder dies, so it is never stale
+    (an old heartbeat only means a process is taking a long time).
+
+    """
+
+    def __init__(self, path, stale_after=None):
+        super(FlockLock, self).__init__(path, stale_after)
+        self.lock_file = os.path.abspath(path) + '.lock'
+        self.fd = None
+
+    def _claim(self):
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, err:
+            os.close(fd)
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self.fd = fd
+        self._heartbeat()
+        return True
+
+    def _heartbeat(self):
+        data = json.dumps(self.owner_data())
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, data)
+        return True
+
+    def _release(self):
+        fd, self.fd = self.fd, None
+        try:
+            os.ftruncate(fd, 0)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _break(self, info):
+        return False
+
+    def is_stale(self, info):
+        return False
+
+    def owner_info(self):
+        try:
+            lock_file = open(self.lock_file)
+        except IOError:
+            return None
+        try:
+            data = lock_file.read()
+        finally:
+            lock_file.close()
+        try:
+            return json.loads(data)
+        except ValueError:
+            # Not locked (or just being written).
+            return None
+
+
+class FileLock(BaseLock):
+    """
+    A ``django_mailer.lockfile`` lock file, with the holder's details written
+    to ``path + '.lock.owner'``.
+
+    A lock file without those details (left by a sender which crashed while
+    taking it out, or by an older version) is stale once it is older than
+    ``stale_after``.
+
+    """
+
+    def __init__(self, path, stale_after=None):
+        super(FileLock, self).__init__(path, stale_after)
+        self.lock = lockfile.FileLock(path)
+        self.owner_file = self.lock.lock_file + '.owner'
+
+    def _claim(self):
+        try:
+            self.lock.acquire(0)
+        except AlreadyLocked:
+            return False
+        self._heartbeat()
+        return True
+
+    def _heartbeat(self):
+        if not self.lock.i_am_locking():
+            return False
+        owner_file = open(self.owner_file, 'w')
+        try:
+            owner_file.write(json.dumps(self.owner_data()))
+        finally:
+            owner_file.close()
+        return True
+
+    def _release(self):
+        if not self.lock.i_am_locking():
+            # The lock was broken by another process.
+            return
+        try:
+            os.unlink(self.owner_file)
+        except OSError:
+            pass
+        self.lock.release()
+
+    def _break(self, info):
+        # Check again, in case another process has just broken the lock and
+        # taken it out itself.
+        if self.owner_info() != info:
+            return False
+        try:
+            os.unlink(self.owner_file)
+        except OSError:
+            pass
+        self.lock.break_lock()
+        return True
+
+    def owner_info(self):
+        if not self.lock.is_locked():
+            return None
+        try:
+            owner_file = open(self.owner_file)
+            try:
+                return json.loads(owner_file.read())
+            finally:
+                owner_file.close()
+        except (IOError, ValueError):
+            pass
+        try:
+            return {'heartbeat': os.stat(self.lock.lock_file).st_mtime}
+        except OSError:
+            return None
+
+
+class DatabaseLock(BaseLock):
+    """
+    A lock held in the ``SendLock`` row named after the last part of
+    ``path``, so it is shared by processes on every host.
+
+    Taking out the lock (including one whose heartbeat is too old) is a
+    single conditional ``UPDATE``, so only one process can get it. The hosts'
+    clocks need to be roughly in step.
+
+    """
+
+    def __init__(self, path, stale_after=None):
+        super(DatabaseLock, self).__init__(path, stale_after)
+        self.name = os.path.basename(path)[:255]
+
+    def _locks(self):
+        return models.SendLock.objects.filter(name=self.name)
+
+    def _claim(self):
+        now = datetime.datetime.now()
+        values = {'owner': self.owner, 'hostname': self.hostname[:255],
+                  'pid': self.pid, 'acquired': now, 'heartbeat': now}
+        free = Q(owner='')
+        if self.stale_after:
+            free |= Q(heartbeat__lt=now - datetime.timedelta(
+                seconds=self.stale_after))
+        with transaction.commit_on_success():
+            if self._locks().filter(free).update(**values):
+                return True
+            sid = transaction.savepoint()
+            try:
+                models.SendLock.objects.create(name=self.name, **values)
+            except IntegrityError:
+                # The lock is held (or another process has just created it).
+                transaction.savepoint_rollback(sid)
+                return False
+            transaction.savepoint_commit(sid)
+            return True
+
+    def _heartbeat(self):
+        with transaction.commit_on_success():
+            return bool(self._locks().filter(owner=self.owner).update(
+                heartbeat=datetime.datetime.now()))
+
+    def _release(self):
+        with transaction.commit_on_success():
+            self._locks().filter(owner=self.owner).update(owner='')
+
+    def _break(self, info):
+        # Only free the lock if it is still held by the same process.
+        with transaction.commit_on_success():
+            return bool(self._locks().filter(owner=info['owner'])
+                        .update(owner=''))
+
+    def owner_info(self):
+        try:
+            lock = self._locks().exclude(owner='').get()
+        except models.SendLock.DoesNotExist:
+            return None
+        return {'owner': lock.owner, 'hostname': lock.hostname,
+                'pid': lock.pid,
+                'heartbeat': time.mktime(lock.heartbeat.timetuple()) +
+                lock.heartbeat.microsecond / 1000000.0}
+
+
+def get_lock(path):
+    """
+    Return a lock for ``path``, using the class set by the
+    ``MAILER_LOCK_BACKEND`` setting.
+
+    """
+    backend = settings.LOCK_BACKEND
+    if backend is None:
+        if fcntl is not None:
+            return FlockLock(path)
+        return FileLock(path)
+    try:
+        mod_name, klass_name = backend.rsplit('.', 1)
+        klass = getattr(import_module(mod_name), klass_name)
+    except (ImportError, AttributeError, ValueError), e:
+        raise ImproperlyConfigured('Error importing lock backend %s: "%s"' %
+                                   (backend, e))
+    return klass(path)
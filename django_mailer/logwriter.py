@@ -0,0 +1,193 @@
+"""
+Writing of the ``Log`` entries made while sending mail.
+
+``BufferedLogWriter`` (the default) holds logs in memory and writes them with
+a single bulk insert once ``MAILER_LOG_BUFFER_SIZE`` logs are waiting or
+``MAILER_LOG_FLUSH_INTERVAL`` seconds have passed, so writing logs doesn't
+hold up sending. A sending daemon flushes the buffer from a background thread
+instead. Whatever is left is written when sending stops (or the process
+exits), but logs still in memory are lost if the process is killed outright.
+
+``SyncLogWriter`` writes logs straight away, in the same transaction as the
+changes to the queue they record.
+
+The writer used is set by the ``MAILER_LOG_WRITER`` setting. Any class with
+the same methods can be used.
+
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.utils.importlib import import_module
+
+from django_mailer import models, settings
+
+logger = logging.getLogger('django_mailer.logwriter')
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class SyncLogWriter(object):
+    """
+    Writes logs as soon as they are handed over.
+
+    """
+
+    def write(self, logs):
+        """
+        Write (or buffer) a list of unsaved ``Log`` instances. This is called
+        inside the transaction recording the results the logs are for.
+
+        """
+        models.Log.objects.bulk_create(logs)
+
+    def flush(self, force=True):
+        """
+        Write any buffered logs. Unless ``force`` is ``True``, only do so if
+        the buffer is due to be written.
+
+        """
+
+    def start(self):
+        """
+        Start flushing the buffer in the background.
+
+        """
+
+    def close(self):
+        """
+        Stop flushing in the background and write any buffered logs.
+
+        """
+
+
+class BufferedLogWriter(SyncLogWriter):
+    """
+    Buffers logs in memory, writing them once ``size`` logs are waiting or
+    ``interval`` seconds have passed since they were last written.
+
+    """
+
+    def __init__(self, size=None, interval=None):
+        if size is None:
+            size = settings.LOG_BUFFER_SIZE
+        if interval is None:
+            interval = settings.LOG_FLUSH_INTERVAL
+        self.size = size
+        self.interval = interval
+        self.logs = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closing = False
+        self.thread = None
+
+    def __len__(self):
+        return len(self.logs)
+
+    def write(self, logs):
+        with self.lock:
+            self.logs.extend(logs)
+            if self.thread is not None and len(self.logs) >= self.size:
+                self.wake.set()
+
+    def due(self):
+        """
+        Return whether the buffered logs should be written.
+
+        """
+        return bool(self.logs) and (
+            len(self.logs) >= self.size or
+            time.time() - self.last_flush >= self.interval)
+
+    def flush(self, force=True):
+        if not force and (self.thread is not None or not self.due()):
+            return
+        with self.lock:
+            logs, self.logs = self.logs, []
+            self.last_flush = time.time()
+        if not logs:
+            return
+        try:
+            with transaction.commit_on_success():
+                models.Log.objects.bulk_create(logs)
+        except Exception:
+            # Keep the logs to try again next time.
+            with self.lock:
+                self.logs[:0] = logs
+            raise
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.closing = False
+        self.wake.clear()
+        self.thread = threading.Thread(target=self._run,
+                                       name='django-mailer-logs')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                self.wake.wait(self.interval)
+                self.wake.clear()
+                if self.closing:
+                    break
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("Writing %s logs failed." %
+                                     len(self.logs))
+        finally:
+            # Database connections are per thread.
+            connection.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.closing = True
+            self.wake.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+
+def get_log_writer():
+    """
+    Return the log writer shared by this process, as set by the
+    ``MAILER_LOG_WRITER`` setting. Any buffered logs are written when the
+    process exits.
+
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            path = settings.LOG_WRITER
+            try:
+                mod_name, klass_name = path.rsplit('.', 1)
+                klass = getattr(import_module(mod_name), klass_name)
+            except (ImportError, AttributeError, ValueError), e:
+                raise ImproperlyConfigured('Error importing log writer %s: '
+                                           '"%s"' % (path, e))
+            _writer = klass()
+            atexit.register(_writer.close)
+        return _writer
+
+
+def reset():
+    """
+    Write any buffered logs and forget the log writer of this process, so
+    that changed settings are picked up.
+
+    """
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
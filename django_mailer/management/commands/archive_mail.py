@@ -0,0 +1,82 @@
+import datetime
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_mailer import archive, settings
+from django_mailer.management.commands import create_handler
+from django_mailer.management.commands.cleanup_mail import delete_mail
+from django_mailer.models import Log, Message, MessageBody
+
+
+class Command(BaseCommand):
+    help = ('Move old mails, along with their logs, out of the database into '
+            'compressed archive files.')
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--days', type='int', default=90,
+            help="Archive mails older than this many days, defaults to 90."),
+        make_option('--directory',
+            help='The directory to write the archive files to, defaults to '
+                'the MAILER_ARCHIVE_DIR setting.'),
+        make_option('-b', '--batch-size', default=500, type='int',
+            help='The number of mails to archive in each transaction, '
+                'defaults to 500.'),
+        make_option('--sleep', default=0, type='float',
+            help='Seconds to pause between batches, leaving the tables free '
+                'for sending mail.'),
+        make_option('--max-time', type='float',
+            help='Stop after this many seconds (the rest is archived by the '
+                'next run).'),
+    )
+
+    def handle(self, verbosity, days, directory=None, batch_size=500,
+               sleep=0, max_time=None, **options):
+        directory = directory or settings.ARCHIVE_DIR
+        if not directory:
+            raise CommandError('Set the MAILER_ARCHIVE_DIR setting or use '
+                               '--directory.')
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        today = datetime.date.today()
+        cutoff_date = today - datetime.timedelta(days)
+        deadline = max_time and time.time() + max_time
+        writer = archive.ArchiveWriter(directory)
+        try:
+            count, finished = delete_mail(
+                cutoff_date, batch_size, sleep, deadline,
+                before_delete=lambda pks: archive_mail(writer, pks))
+        finally:
+            writer.close()
+        logger.warning("Archived %s mails created before %s to %s" %
+                       (count, cutoff_date, directory))
+        if finished:
+            MessageBody.objects.delete_unreferenced(created_before=cutoff_date,
+                                                    batch_size=batch_size)
+        else:
+            logger.warning("Stopped after %s seconds, leaving the rest for "
+                           "the next run." % max_time)
+
+        logger.removeHandler(handler)
+
+
+def archive_mail(writer, pks):
+    """
+    Write the mails with the primary keys ``pks`` (and their logs) to the
+    archive, making sure they are on disk before they are deleted.
+
+    """
+    logs = {}
+    for message_id, date, result, log_message in Log.objects \
+            .filter(message__in=pks).order_by('date', 'pk') \
+            .values_list('message', 'date', 'result', 'log_message'):
+        logs.setdefault(message_id, []).append((date, result, log_message))
+    messages = Message.objects.filter(pk__in=pks).select_related('body') \
+        .order_by('pk')
+    for message in messages:
+        writer.write(archive.message_record(message, logs.get(message.pk, ())),
+                     message.date_created.date())
+    writer.flush()
@@ -1,21 +1,37 @@
 import datetime
 import logging
+import time
 from optparse import make_option
 
 from django.core.management.base import BaseCommand
 
+from django.db import transaction
+
+from django_mailer import stats
+from django_mailer.managers import delete_in
 from django_mailer.management.commands import create_handler
-from django_mailer.models import Message
+from django_mailer.models import (DeadLetter, Log, Message, MessageBody,
+                                  QueuedMessage)
 
 
 class Command(BaseCommand):
-    help = 'Place deferred messages back in the queue.'
+    help = 'Delete old mails, along with their logs.'
     option_list = BaseCommand.option_list + (
         make_option('-d', '--days', type='int', default=90,
             help="Cleanup mails older than this many days, defaults to 90."),
+        make_option('-b', '--batch-size', default=500, type='int',
+            help='The number of mails to delete in each transaction, defaults '
+                'to 500.'),
+        make_option('--sleep', default=0, type='float',
+            help='Seconds to pause between batches, leaving the tables free '
+                'for sending mail.'),
+        make_option('--max-time', type='float',
+            help='Stop after this many seconds (the rest is deleted by the '
+                'next run).'),
     )
 
-    def handle(self, verbosity, days, **options):
+    def handle(self, verbosity, days, batch_size=500, sleep=0, max_time=None,
+               **options):
         # Delete mails and their related logs and queued created before X days
         logger = logging.getLogger('django_mailer')
         handler = create_handler(verbosity)
@@ -23,7 +39,63 @@ class Command(BaseCommand):
 
         today = datetime.date.today()
         cutoff_date = today - datetime.timedelta(days)
-        count = Message.objects.filter(date_created__lt=cutoff_date).count()
-        Message.objects.filter(date_created__lt=cutoff_date).delete()
+        deadline = max_time and time.time() + max_time
+        count, finished = delete_mail(cutoff_date, batch_size, sleep,
+                                      deadline)
         logger.warning("Deleted %s mails created before %s " %
                        (count, cutoff_date))
+        if finished:
+            # Remove the content of the deleted mails, unless it is shared
+            # with mails which are being kept.
+            MessageBody.objects.delete_unreferenced(created_before=cutoff_date,
+                                                    batch_size=batch_size)
+        else:
+            logger.warning("Stopped after %s seconds, leaving the rest for "
+                           "the next run." % max_time)
+
+        logger.removeHandler(handler)
+
+
+def delete_mail(cutoff_date, batch_size, sleep=0, deadline=None,
+                before_delete=None):
+    """
+    Delete the mails created before ``cutoff_date`` (with their logs and any
+    queued messages or dead letters), ``batch_size`` mails at a time in order
+    of primary key.
+
+    Before being deleted, logs are added to the daily ``LogRollup`` counts
+    and ``before_delete`` (if given) is called with the primary keys of the
+    batch's mails.
+
+    Nothing is loaded into memory beyond the primary keys of a batch and the
+    counts of its logs by day and result.
+
+    Returns the number of mails deleted and whether all of them were deleted
+    (rather than stopping once the ``deadline`` timestamp passed).
+
+    """
+    count = 0
+    last_pk = 0
+    messages = Message.objects.filter(date_created__lt=cutoff_date)
+    while True:
+        pks = list(messages.filter(pk__gt=last_pk).order_by('pk')
+                   .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return count, True
+        with transaction.commit_on_success():
+            if before_delete is not None:
+                before_delete(pks)
+            stats.roll_up_logs(Log.objects.filter(message__in=pks))
+            stats.queued_deleted(QueuedMessage.objects.filter(
+                message__in=pks))
+            delete_in(Log, 'message', pks)
+            delete_in(QueuedMessage, 'message', pks)
+            delete_in(DeadLetter, 'message', pks)
+            count += delete_in(Message, 'id', pks)
+        last_pk = pks[-1]
+        if len(pks) < batch_size:
+            return count, True
+        if deadline and time.time() >= deadline:
+            return count, False
+        if sleep:
+            time.sleep(sleep)
@@ -0,0 +1,74 @@
+import logging
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from django_mailer import compression, models
+from django_mailer.management.commands import create_handler
+
+# The models and fields holding (potentially) compressed content.
+COMPRESSED_FIELDS = (
+    (models.MessageBody, ('message', 'html_message', 'mime')),
+    (models.Message, ('message', 'html_message')),
+    (models.Log, ('log_message',)),
+)
+
+
+class Command(NoArgsCommand):
+    help = 'Compress the stored content of existing mails and logs.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('-b', '--batch-size', default=500, type='int',
+            help='The number of rows to update in each transaction, defaults '
+                'to 500.'),
+        make_option('--decompress', action='store_true', default=False,
+            help='Decompress stored content instead.'),
+    )
+
+    def handle_noargs(self, verbosity, batch_size, decompress, **options):
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        if decompress:
+            convert = compression.decompress
+        else:
+            convert = compress_stored
+        for model, fields in COMPRESSED_FIELDS:
+            count = convert_model(model, fields, convert, batch_size)
+            logger.warning("%s %s row%s updated" % (
+                count, model._meta.verbose_name, count != 1 and 's' or ''))
+
+        logger.removeHandler(handler)
+
+
+def compress_stored(value):
+    if compression.is_compressed(value):
+        return value
+    return compression.compress(value)
+
+
+def convert_model(model, fields, convert, batch_size):
+    """
+    Convert the ``fields`` of every row of ``model`` with the ``convert``
+    function, a batch of rows at a time, returning the number of rows changed.
+
+    """
+    count = 0
+    last_pk = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=last_pk).order_by('pk')
+                    .values_list('pk', *fields)[:batch_size])
+        if not rows:
+            return count
+        with transaction.commit_on_success():
+            for row in rows:
+                values = {}
+                for field, value in zip(fields, row[1:]):
+                    converted = convert(value)
+                    if converted != value:
+                        values[field] = converted
+                if values:
+                    model.objects.filter(pk=row[0]).update(**values)
+                    count += 1
+        last_pk = rows[-1][0]
@@ -0,0 +1,53 @@
+import datetime
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from django_mailer import stats
+
+
+class Command(NoArgsCommand):
+    help = ('Report the depth of each queue and the mail sent each hour, '
+            'from the counters kept while sending.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hours', type='int', default=24,
+            help='Report the mail sent over this many hours, defaults to 24.'),
+        make_option('-q', '--queue',
+            help='Only report the depth of this named queue.'),
+        make_option('--rebuild', action='store_true', default=False,
+            help='Recount the messages in each queue first (scanning the '
+                'whole queue).'),
+    )
+
+    def handle_noargs(self, hours, queue=None, rebuild=False, **options):
+        if rebuild:
+            stats.rebuild_queue_stats()
+
+        now = datetime.datetime.now()
+        for name, queued, deferred in stats.queue_depths():
+            if queue is not None and name != queue:
+                continue
+            oldest = stats.oldest_queued(name)
+            if oldest is None:
+                age = 'empty'
+            else:
+                age = 'oldest queued %s ago' % _format_age(now - oldest)
+            sys.stdout.write('%s: %s queued (%s deferred), %s.\n' % (
+                name, queued, deferred, age))
+
+        since = now - datetime.timedelta(hours=hours)
+        totals = stats.delivery_totals(since)
+        sys.stdout.write('\n%-16s %8s %8s %8s\n' % ('Hour', 'Sent', 'Failed',
+                                                    'Skipped'))
+        for period, sent, failed, skipped in totals:
+            sys.stdout.write('%-16s %8s %8s %8s\n' % (
+                period.strftime('%Y-%m-%d %H:%M'), sent, failed, skipped))
+        sys.stdout.write('%-16s %8s %8s %8s\n' % (
+            'Total', sum(row[1] for row in totals),
+            sum(row[2] for row in totals), sum(row[3] for row in totals)))
+
+
+def _format_age(delta):
+    # Leave off the microseconds.
+    return str(delta - datetime.timedelta(microseconds=delta.microseconds))
@@ -1,11 +1,14 @@
 from django.core.management.base import NoArgsCommand
 from django.db import connection
-from django_mailer import models, settings
-from django_mailer.engine import send_all
+from django_mailer import settings, stats
+from django_mailer.engine import send_all, send_loop
 from django_mailer.management.commands import create_handler
 from optparse import make_option
 import logging
+import os
+import signal
 import sys
+import threading
 try:
     from django.core.mail import get_connection
     EMAIL_BACKEND_SUPPORT = True
@@ -23,14 +26,32 @@ class Command(NoArgsCommand):
                 'is being cleared).'),
         make_option('-c', '--count', action='store_true', default=False,
             help='Return the number of messages in the queue (without '
-                'actually sending any)'),
+                'actually sending any), as counted by mailer_stats.'),
+        make_option('--no-lock', action='store_false', dest='lock',
+            default=True,
+            help="Don't take out the lock file, allowing several send_mail "
+                'processes to send queued messages in parallel.'),
+        make_option('--concurrency', type='int',
+            help='The number of threads (each with their own connection) to '
+                'deliver messages with, defaults to 1 (or the concurrency set '
+                'for the queue in MAILER_QUEUES).'),
+        make_option('-q', '--queue',
+            help='Only send the messages in this named queue (using a lock '
+                'file for this queue only).'),
+        make_option('--daemon', action='store_true', default=False,
+            help='Keep running, sending mail as soon as it is queued. Stops '
+                'gracefully on SIGTERM or SIGINT and restarts on SIGHUP.'),
     )
 
-    def handle_noargs(self, verbosity, block_size, count, **options):
+    def handle_noargs(self, verbosity, block_size, count, lock=True,
+                      concurrency=None, daemon=False, queue=None, **options):
         # If this is just a count request the just calculate, report and exit.
         if count:
-            queued = models.QueuedMessage.objects.non_deferred().count()
-            deferred = models.QueuedMessage.objects.non_deferred().count()
+            queued = deferred = 0
+            for name, queue_queued, queue_deferred in stats.queue_depths():
+                if queue is None or name == queue:
+                    queued += queue_queued - queue_deferred
+                    deferred += queue_deferred
             sys.stdout.write('%s queued message%s (and %s deferred message%s).'
                              '\n' % (queued, queued != 1 and 's' or '',
                                      deferred, deferred != 1 and 's' or ''))
@@ -41,12 +62,20 @@ class Command(NoArgsCommand):
         handler = create_handler(verbosity)
         logger.addHandler(handler)
 
+        if EMAIL_BACKEND_SUPPORT:
+            backend = settings.MAILER_BACKEND
+        else:
+            backend = None
+
+        reload = False
         # if PAUSE_SEND is turned on don't do anything.
         if not settings.PAUSE_SEND:
-            if EMAIL_BACKEND_SUPPORT:
-                send_all(block_size, backend=settings.MAILER_BACKEND)
+            if daemon:
+                reload = self.run_daemon(block_size, backend, lock,
+                                         concurrency, queue)
             else:
-                send_all(block_size)
+                send_all(block_size, backend=backend, use_lock=lock,
+                         concurrency=concurrency, queue=queue)
         else:
             logger = logging.getLogger('django_mailer.commands.send_mail')
             logger.warning("Sending is paused, exiting without sending "
@@ -58,3 +87,34 @@ class Command(NoArgsCommand):
         # Postgres log files caused by the database connection not being
         # explicitly closed.
         connection.close()
+
+        if reload:
+            # Start afresh, picking up changed code and settings.
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def run_daemon(self, block_size, backend, lock, concurrency, queue):
+        """
+        Run the send loop until a signal stops it, finishing the block being
+        sent first. Returns whether the command should be restarted.
+
+        """
+        logger = logging.getLogger('django_mailer.commands.send_mail')
+        stop = threading.Event()
+        signals = {'reload': False}
+
+        def handle_stop(signum, frame):
+            logger.warning("Stopping after the current block...")
+            stop.set()
+
+        def handle_reload(signum, frame):
+            logger.warning("Restarting after the current block...")
+            signals['reload'] = True
+            stop.set()
+
+        signal.signal(signal.SIGTERM, handle_stop)
+        signal.signal(signal.SIGINT, handle_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, handle_reload)
+        send_loop(block_size=block_size, backend=backend, use_lock=lock,
+                  concurrency=concurrency, stop=stop, queue=queue)
+        return signals['reload']
@@ -1,6 +1,14 @@
 import datetime
-from django.db import models
-from django_mailer import constants
+import hashlib
+from django.db import connections, models, router, transaction
+from django.db.models import Q
+from django.utils.encoding import smart_str
+from django_mailer import compression, constants, mime, settings
+
+# A reused message body has its ``last_used`` time updated if it is older than
+# this many seconds (so that a body shared by many messages queued one by one
+# isn't updated for every message).
+BODY_USE_INTERVAL = 60
 
 
 class QueueMethods(object):
@@ -14,7 +22,7 @@ class QueueMethods(object):
         Exclude future time-delayed messages.
 
         """
-        return self.exclude(date_queued__gt=datetime.datetime.now)
+        return self.filter(date_queued__lte=datetime.datetime.now)
 
     def high_priority(self):
         """
@@ -45,6 +53,15 @@ class QueueMethods(object):
         """
         return self.exclude_future().filter(deferred=None)
 
+    def due(self):
+        """
+        Return a QuerySet of the queued messages which are due to be sent:
+        those whose next attempt (the time they were queued for, or their next
+        retry if they have been deferred) has been reached.
+
+        """
+        return self.filter(next_attempt__lte=datetime.datetime.now)
+
     def deferred(self):
         """
         Return a QuerySet of all deferred messages in the queue, excluding
@@ -53,6 +70,15 @@ class QueueMethods(object):
         """
         return self.exclude_future().exclude(deferred=None)
 
+    def unleased(self):
+        """
+        Return a QuerySet of queued messages which are not currently leased
+        by a sending worker (including those whose lease has expired).
+
+        """
+        return self.filter(Q(lease_expires=None) |
+                           Q(lease_expires__lte=datetime.datetime.now))
+
 
 class QueueQuerySet(QueueMethods, models.query.QuerySet):
     pass
@@ -77,12 +103,361 @@ class QueueManager(QueueMethods, models.Manager):
         will be set to this priority level.
 
         """
+        from django_mailer import stats
         queryset = self.deferred()
         if max_retries:
             queryset = queryset.filter(retries__lte=max_retries)
-        count = queryset.count()
-        update_kwargs = dict(deferred=None, retries=models.F('retries')+1)
+        update_kwargs = dict(deferred=None,
+                             next_attempt=datetime.datetime.now(),
+                             retries=models.F('retries')+1)
         if new_priority is not None:
             update_kwargs['priority'] = new_priority
-        queryset.update(**update_kwargs)
+        count = 0
+        with transaction.commit_on_success(using=self.db):
+            counts = queryset.values_list('queue').order_by() \
+                .annotate(models.Count('pk'))
+            for queue, queue_count in counts:
+                stats.update_queue(queue, deferred=-queue_count)
+                count += queue_count
+            queryset.update(**update_kwargs)
         return count
+
+    def bulk_queue(self, rows, store_mime=False, send_at=None):
+        """
+        Queue a batch of messages using bulk inserts (see
+        ``create_with_pks``) inside a single transaction, returning the number
+        of messages queued.
+
+        ``rows`` is a list of ``(email_message, to_address, priority,
+        html_message, queue)`` tuples.
+
+        If ``store_mime`` is ``True``, the fully rendered email messages are
+        stored rather than just their content. If ``send_at`` is given, the
+        messages aren't sent before that time.
+
+        If a transaction is already being managed (for example, by the
+        ``TransactionMiddleware``), the messages are queued as part of it.
+
+        """
+        if not transaction.is_managed(using=self.db):
+            with transaction.commit_on_success(using=self.db):
+                return self.bulk_queue(rows, store_mime, send_at)
+        # Only undo this batch if it fails, leaving the rest of the
+        # transaction to be committed (or rolled back) by its manager.
+        sid = transaction.savepoint(using=self.db)
+        try:
+            count = self._bulk_queue(rows, store_mime, send_at)
+        except Exception:
+            transaction.savepoint_rollback(sid, using=self.db)
+            raise
+        transaction.savepoint_commit(sid, using=self.db)
+        return count
+
+    def _bulk_queue(self, rows, store_mime, send_at):
+        from django_mailer import stats
+        message_model = self.model._meta.get_field('message').rel.to
+        body_model = message_model._meta.get_field('body').rel.to
+        now = datetime.datetime.now()
+        bodies = {}
+        messages = []
+        for email_message, to_address, priority, html_message, queue in rows:
+            key = id(email_message)
+            if key not in bodies:
+                if store_mime:
+                    bodies[key] = body_model.objects.get_for_content(
+                        mime=mime.serialize(email_message))
+                else:
+                    bodies[key] = body_model.objects.get_for_content(
+                        email_message.body, html_message)
+            messages.append(message_model(
+                to_address=to_address,
+                from_address=email_message.from_email,
+                subject=email_message.subject, body=bodies[key],
+                date_created=now))
+        # bulk_create doesn't set the primary keys of the new messages, which
+        # the queued messages need.
+        create_with_pks(message_model, messages, using=self.db)
+        queued_messages = []
+        depths = {}
+        for message, row in zip(messages, rows):
+            priority = row[2] or constants.PRIORITY_NORMAL
+            queue = row[4] or constants.DEFAULT_QUEUE
+            depths[queue] = depths.get(queue, 0) + 1
+            queued_messages.append(self.model(
+                message_id=message.pk, priority=priority, queue=queue,
+                date_queued=send_at or now, next_attempt=send_at or now))
+        self.bulk_create(queued_messages)
+        for queue, count in sorted(depths.items()):
+            stats.update_queue(queue, queued=count)
+        return len(queued_messages)
+
+    def claim(self, owner, limit=None, queryset=None, lease_seconds=None):
+        """
+        Take out a lease on a block of unleased, non-deferred messages for the
+        worker identified by ``owner``, returning a QuerySet of the messages
+        which were claimed.
+
+        Up to ``limit`` messages are claimed (or all available messages if
+        ``limit`` is ``None``). A ``queryset`` can be passed to narrow down
+        which messages are candidates to be claimed.
+
+        The lease lasts for ``lease_seconds`` seconds (defaulting to the
+        ``MAILER_LEASE_SECONDS`` setting). Messages whose lease has expired,
+        for example because the worker holding it crashed, are available to
+        be claimed again.
+
+        """
+        if queryset is None:
+            queryset = self.non_deferred()
+        if lease_seconds is None:
+            lease_seconds = settings.LEASE_SECONDS
+        expires = datetime.datetime.now() + \
+            datetime.timedelta(seconds=lease_seconds)
+        queryset = queryset.unleased()
+        if settings.USE_SKIP_LOCKED:
+            pks = self._claim_skip_locked(owner, expires, queryset, limit)
+        else:
+            pks = queryset.values_list('pk', flat=True)
+            if limit:
+                pks = pks[:limit]
+            pks = list(pks)
+            if pks:
+                # The conditional update is atomic, so if another worker
+                # claimed some of these messages in the meantime they are
+                # simply skipped.
+                self.filter(pk__in=pks).unleased().update(
+                    lease_owner=owner, lease_expires=expires)
+        return self.filter(pk__in=pks, lease_owner=owner) \
+            .select_related('message').prefetch_related('message__body')
+
+    def _claim_skip_locked(self, owner, expires, queryset, limit):
+        """
+        Claim messages with a single ``UPDATE ... WHERE pk IN (SELECT ...
+        FOR UPDATE SKIP LOCKED) RETURNING pk`` statement, so that concurrent
+        workers never block on each other's rows.
+
+        Only supported by PostgreSQL 9.5+.
+
+        """
+        using = queryset.db
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        candidates = queryset.values('pk')
+        if limit:
+            candidates = candidates[:limit]
+        select_sql, select_params = candidates.query.sql_with_params()
+        opts = self.model._meta
+        sql = ('UPDATE %s SET %s = %%s, %s = %%s WHERE %s IN '
+               '(%s FOR UPDATE SKIP LOCKED) RETURNING %s' % (
+                   qn(opts.db_table),
+                   qn(opts.get_field('lease_owner').column),
+                   qn(opts.get_field('lease_expires').column),
+                   qn(opts.pk.column), select_sql, qn(opts.pk.column)))
+        cursor = connection.cursor()
+        cursor.execute(sql, (owner, expires) + tuple(select_params))
+        pks = [row[0] for row in cursor.fetchall()]
+        transaction.commit_unless_managed(using=using)
+        return pks
+
+    def renew_leases(self, owner, lease_seconds=None):
+        """
+        Extend the lease on all messages currently claimed by ``owner``.
+
+        """
+        if lease_seconds is None:
+            lease_seconds = settings.LEASE_SECONDS
+        expires = datetime.datetime.now() + \
+            datetime.timedelta(seconds=lease_seconds)
+        return self.filter(lease_owner=owner).update(lease_expires=expires)
+
+    def release_leases(self, owner):
+        """
+        Release the lease on all messages claimed by ``owner`` so that they
+        can be picked up by any worker again.
+
+        """
+        return self.filter(lease_owner=owner).update(lease_owner='',
+                                                     lease_expires=None)
+
+
+class DeadLetterManager(models.Manager):
+
+    def requeue(self, queryset=None, new_priority=None):
+        """
+        Put dead letters (all of them, or those in ``queryset``) back in the
+        queue as new messages, returning the number requeued.
+
+        If ``new_priority`` is ``None`` (default), requeued messages retain
+        their original priority level. Otherwise they are all set to this
+        priority level.
+
+        """
+        from django_mailer import notify, stats
+        from django_mailer.models import QueuedMessage
+        if queryset is None:
+            queryset = self.all()
+        now = datetime.datetime.now()
+        depths = {}
+        queued_messages = []
+        with transaction.commit_on_success(using=self.db):
+            rows = list(queryset.values_list('pk', 'message', 'priority',
+                                             'queue'))
+            for pk, message_id, priority, queue in rows:
+                if new_priority is not None:
+                    priority = new_priority
+                queued_messages.append(QueuedMessage(
+                    message_id=message_id, priority=priority, queue=queue,
+                    date_queued=now, next_attempt=now))
+                depths[queue] = depths.get(queue, 0) + 1
+            for offset in range(0, len(rows), 100):
+                self.filter(pk__in=[row[0] for row in
+                                    rows[offset:offset + 100]]).delete()
+                QueuedMessage.objects.bulk_create(
+                    queued_messages[offset:offset + 100])
+            for queue, count in sorted(depths.items()):
+                stats.update_queue(queue, queued=count)
+        if queued_messages:
+            notify.notify(using=self.db)
+        return len(queued_messages)
+
+
+class MessageBodyManager(models.Manager):
+
+    def get_for_content(self, message='', html_message='', mime=''):
+        """
+        Return the ``MessageBody`` holding this content, creating it if it
+        doesn't exist yet.
+
+        ``mime`` is a fully rendered message (see
+        ``django_mailer.mime.serialize``).
+
+        The ``last_used`` time of an existing body is updated, so that it
+        isn't deleted by ``delete_unreferenced`` before the message using it
+        has been saved.
+
+        """
+        digest = hashlib.sha1()
+        digest.update(smart_str(message))
+        digest.update('\0')
+        digest.update(smart_str(html_message))
+        digest.update('\0')
+        digest.update(smart_str(mime))
+        if settings.COMPRESS:
+            message = compression.compress(message)
+            html_message = compression.compress(html_message)
+            mime = compression.compress(mime)
+        body, created = self.get_or_create(digest=digest.hexdigest(),
+            defaults={'message': message, 'html_message': html_message,
+                      'mime': mime})
+        now = datetime.datetime.now()
+        if not created and body.last_used < now - datetime.timedelta(
+                seconds=BODY_USE_INTERVAL):
+            self.filter(pk=body.pk).update(last_used=now)
+            body.last_used = now
+        return body
+
+    def delete_unreferenced(self, created_before=None, batch_size=500):
+        """
+        Delete message bodies which are no longer used by any message,
+        returning the number deleted.
+
+        If ``created_before`` is provided, only bodies last used (see
+        ``get_for_content``) before then are deleted, so that bodies which are
+        just about to be used by a newly queued message are left alone.
+
+        Bodies are deleted ``batch_size`` at a time, without loading them.
+
+        """
+        queryset = self.filter(messages__isnull=True)
+        if created_before is not None:
+            queryset = queryset.filter(last_used__lt=created_before -
+                datetime.timedelta(seconds=BODY_USE_INTERVAL))
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        message_opts = self.model.messages.related.model._meta
+        count = 0
+        last_pk = 0
+        while True:
+            pks = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return count
+            # Check again that each body is unused, in case it has been
+            # reused in the meantime.
+            sql = ('DELETE FROM %s WHERE %s IN (%s) AND NOT EXISTS '
+                   '(SELECT 1 FROM %s WHERE %s.%s = %s.%s)' % (
+                       qn(opts.db_table), qn(opts.pk.column),
+                       ', '.join(['%s'] * len(pks)),
+                       qn(message_opts.db_table), qn(message_opts.db_table),
+                       qn(message_opts.get_field('body').column),
+                       qn(opts.db_table), qn(opts.pk.column)))
+            with transaction.commit_on_success(using=self.db):
+                cursor = connection.cursor()
+                cursor.execute(sql, pks)
+                count += cursor.rowcount
+            last_pk = pks[-1]
+
+
+def delete_in(model, field_name, values, using=None):
+    """
+    Delete the rows of ``model`` whose ``field_name`` is one of ``values``,
+    returning the number deleted.
+
+    Unlike ``QuerySet.delete``, the rows aren't loaded first and related rows
+    aren't deleted along with them.
+
+    """
+    if not values:
+        return 0
+    connection = connections[using or router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        qn(opts.db_table), qn(opts.get_field(field_name).column),
+        ', '.join(['%s'] * len(values))), list(values))
+    transaction.commit_unless_managed(using=connection.alias)
+    return cursor.rowcount
+
+
+def create_with_pks(model, objs, using=None, batch_size=500):
+    """
+    Insert the new ``objs`` (instances of ``model``), setting their primary
+    keys.
+
+    Where the database can return the primary keys of the rows it inserts
+    (PostgreSQL), the objects are inserted ``batch_size`` at a time with
+    ``INSERT ... RETURNING``. Elsewhere they are saved one at a time, since
+    the keys given to a bulk insert can't be found out reliably.
+
+    """
+    using = using or router.db_for_write(model)
+    connection = connections[using]
+    if not connection.features.can_return_id_from_insert:
+        for obj in objs:
+            obj.save(force_insert=True, using=using)
+        return
+    qn = connection.ops.quote_name
+    opts = model._meta
+    fields = [field for field in opts.local_fields
+              if not isinstance(field, models.AutoField)]
+    placeholder = '(%s)' % ', '.join(['%s'] * len(fields))
+    cursor = connection.cursor()
+    for offset in range(0, len(objs), batch_size):
+        batch = objs[offset:offset + batch_size]
+        params = []
+        for obj in batch:
+            params.extend([field.get_db_prep_save(field.pre_save(obj, True),
+                                                  connection=connection)
+                           for field in fields])
+        cursor.execute('INSERT INTO %s (%s) VALUES %s RETURNING %s' % (
+            qn(opts.db_table), ', '.join([qn(field.column)
+                                          for field in fields]),
+            ', '.join([placeholder] * len(batch)), qn(opts.pk.column)),
+            params)
+        for obj, row in zip(batch, cursor.fetchall()):
+            obj.pk = row[0]
+            obj._state.adding = False
+            obj._state.db = using
+    transaction.commit_unless_managed(using=using)
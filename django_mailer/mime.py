@@ -0,0 +1,94 @@
+"""
+Support for storing fully rendered MIME messages.
+
+Rendering an ``EmailMessage`` once when it is queued keeps everything about
+it (cc, bcc, attachments, custom headers and so on) and means no MIME
+encoding needs to be done when the message is sent.
+
+"""
+
+import email
+
+from django.core.mail import EmailMessage
+from django.utils.encoding import smart_str
+
+
+def serialize(email_message):
+    """
+    Render an ``EmailMessage`` to its RFC 2822 text.
+
+    The rendered bytes are mapped one to one onto unicode code points
+    (latin-1) so they can be stored in a text field and restored exactly by
+    ``deserialize``.
+
+    """
+    return smart_str(email_message.message().as_string()).decode('latin-1')
+
+
+def deserialize(mime):
+    """
+    Return the original bytes of a message rendered by ``serialize``.
+
+    """
+    return mime.encode('latin-1')
+
+
+def get_content(mime):
+    """
+    Extract the plain text and html content from a rendered message.
+
+    """
+    message = email.message_from_string(deserialize(mime))
+    text = html = u''
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if part.get_filename() or content_type not in ('text/plain',
+                                                       'text/html'):
+            continue
+        charset = part.get_content_charset() or 'us-ascii'
+        content = part.get_payload(decode=True).decode(charset, 'replace')
+        if content_type == 'text/plain' and not text:
+            text = content
+        elif content_type == 'text/html' and not html:
+            html = content
+    return text, html
+
+
+class RawMessage(object):
+    """
+    A stand-in for a MIME message object which returns the already rendered
+    message when an email backend asks for it.
+
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def as_string(self, unixfrom=False):
+        return self.data
+
+    def as_bytes(self, *args, **kwargs):
+        return self.data
+
+    def __str__(self):
+        return self.data
+
+
+class RawEmailMessage(EmailMessage):
+    """
+    An ``EmailMessage`` which sends an already rendered MIME message (see
+    ``serialize``) to the envelope ``recipients``, rather than rendering
+    one itself.
+
+    """
+
+    def __init__(self, mime, from_email, recipients, subject='',
+                 connection=None):
+        super(RawEmailMessage, self).__init__(subject=subject,
+                                              from_email=from_email,
+                                              to=recipients,
+                                              connection=connection)
+        self.mime = mime
+
+    def message(self):
+        return RawMessage(deserialize(self.mime))
@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.core.mail import EmailMessage, EmailMultiAlternatives
 from django.db import models
-from django_mailer import constants, managers
+from django_mailer import compression, constants, managers, mime, retry
 from django.utils.encoding import force_unicode
 
 import datetime
@@ -20,16 +20,49 @@ RESULT_CODES = (
 )
 
 
+class MessageBody(models.Model):
+    """
+    The content of an email, stored once and shared by every message with
+    identical content (for example, each recipient of a newsletter).
+
+    Bodies are looked up by a digest of their content. The content is stored
+    compressed if the ``MAILER_COMPRESS`` setting is enabled.
+
+    If the body holds a fully rendered MIME message (see the
+    ``MAILER_STORE_MIME`` setting), it is sent as it is.
+    """
+    digest = models.CharField(max_length=40, unique=True, editable=False)
+    message = models.TextField(blank=True)
+    html_message = models.TextField(blank=True)
+    mime = models.TextField(blank=True)
+    date_created = models.DateTimeField(default=datetime.datetime.now,
+                                        db_index=True)
+    last_used = models.DateTimeField(default=datetime.datetime.now,
+                                     db_index=True)
+
+    objects = managers.MessageBodyManager()
+
+    def __unicode__(self):
+        return self.digest
+
+
 class Message(models.Model):
     """
     A model to hold email information.    
+
+    The content of the email is held in a shared ``MessageBody``. Messages
+    queued by older versions hold their content in the ``message`` and
+    ``html_message`` fields instead.
     """
     to_address = models.CharField(max_length=200)
     from_address = models.CharField(max_length=200)
     subject = models.CharField(max_length=255)
-    message = models.TextField()
+    body = models.ForeignKey(MessageBody, null=True, blank=True,
+                             editable=False, related_name='messages')
+    message = models.TextField(blank=True)
     html_message = models.TextField(blank=True)
-    date_created = models.DateTimeField(default=datetime.datetime.now)
+    date_created = models.DateTimeField(default=datetime.datetime.now,
+                                        db_index=True)
 
     class Meta:
         ordering = ('date_created',)
@@ -37,20 +70,42 @@ class Message(models.Model):
     def __unicode__(self):
         return '%s: %s' % (self.to_address, self.subject)
 
+    def get_content(self):
+        """
+        Returns a tuple of the plain text and html content of the message.
+        """
+        if self.body_id:
+            if self.body.mime:
+                return mime.get_content(
+                    compression.decompress(self.body.mime))
+            message, html_message = self.body.message, self.body.html_message
+        else:
+            message, html_message = self.message, self.html_message
+        return (compression.decompress(message),
+                compression.decompress(html_message))
+
     def email_message(self, connection=None):
         """
         Returns a django ``EmailMessage`` or ``EmailMultiAlternatives`` object
         from a ``Message`` instance, depending on whether html_message is empty.
+
+        If the message was stored fully rendered, a ``RawEmailMessage`` which
+        sends it as it is to the message recipient is returned instead.
         """
         subject = force_unicode(self.subject)
-        if self.html_message:
-            msg = EmailMultiAlternatives(subject, self.message,
+        if self.body_id and self.body.mime:
+            return mime.RawEmailMessage(
+                compression.decompress(self.body.mime), self.from_address,
+                [self.to_address], subject=subject, connection=connection)
+        message, html_message = self.get_content()
+        if html_message:
+            msg = EmailMultiAlternatives(subject, message,
                                          self.from_address, [self.to_address],
                                          connection=connection)
-            msg.attach_alternative(self.html_message, "text/html")
+            msg.attach_alternative(html_message, "text/html")
             return msg
         else:
-            return EmailMessage(subject, self.message, self.from_address,
+            return EmailMessage(subject, message, self.from_address,
                                 [self.to_address], connection=connection)
 
 
@@ -59,7 +114,20 @@ class QueuedMessage(models.Model):
     A queued message.
     
     Messages in the queue can be prioritised so that the higher priority
-    messages are sent first (secondarily sorted by the oldest message).
+    messages are sent first (secondarily sorted by when they are due).
+
+    Messages can also be put in separate named queues (for example, to keep
+    transactional mail apart from newsletters), which can each be sent by
+    their own workers.
+
+    A sending worker claims a message by taking out a lease on it (see
+    ``QueueManager.claim``). Other workers will not pick up a leased message
+    until the lease has been released or has expired.
+
+    A message is sent once its ``next_attempt`` time is reached: the time it
+    was queued for at first and, once it has been deferred, the time of its
+    next retry (see ``django_mailer.retry``). A message which keeps failing is
+    eventually moved to the ``DeadLetter`` table.
     
     """
     message = models.OneToOneField(Message, editable=False)
@@ -67,28 +135,84 @@ class QueuedMessage(models.Model):
                                             default=constants.PRIORITY_NORMAL)
     deferred = models.DateTimeField(null=True, blank=True)
     retries = models.PositiveIntegerField(default=0)
-    date_queued = models.DateTimeField(default=datetime.datetime.now)
+    # Failures which didn't defer the message.
+    failures = models.PositiveIntegerField(default=0)
+    # When the message is due to be sent, or ``None`` for a deferred message
+    # waiting for ``retry_deferred``. Indexed together with the priority and
+    # queue (see sql/queuedmessage.sql).
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
+    queue = models.CharField(max_length=50, default=constants.DEFAULT_QUEUE)
+    date_queued = models.DateTimeField(default=datetime.datetime.now,
+                                       db_index=True)
+    lease_owner = models.CharField(max_length=100, blank=True, editable=False,
+                                   db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True,
+                                         editable=False, db_index=True)
 
     objects = managers.QueueManager()
 
     class Meta:
-        ordering = ('priority', 'date_queued')
+        ordering = ('priority', 'next_attempt')
+
+    def save(self, *args, **kwargs):
+        if self.next_attempt is None and self.deferred is None:
+            self.next_attempt = self.date_queued
+        super(QueuedMessage, self).save(*args, **kwargs)
 
     def defer(self):
+        from django_mailer import stats
+        if self.deferred:
+            # This was a retry of a deferred message.
+            self.retries += 1
+        else:
+            stats.update_queue(self.queue, deferred=1)
         self.deferred = datetime.datetime.now()
+        self.next_attempt = retry.next_attempt(self.retries, self.deferred)
         self.save()
 
 
+class DeadLetter(models.Model):
+    """
+    A message taken out of the queue after failing too many times (see the
+    ``MAILER_DEAD_LETTER_FAILURES`` and ``MAILER_DEAD_LETTER_RETRIES``
+    settings).
+
+    Dead letters are never attempted again unless they are put back in the
+    queue (see ``DeadLetterManager.requeue``).
+
+    """
+    message = models.OneToOneField(Message, editable=False)
+    priority = models.PositiveSmallIntegerField(choices=PRIORITIES,
+                                            default=constants.PRIORITY_NORMAL)
+    queue = models.CharField(max_length=50, default=constants.DEFAULT_QUEUE)
+    failures = models.PositiveIntegerField(default=0)
+    retries = models.PositiveIntegerField(default=0)
+    # The error from the last attempt to send the message.
+    reason = models.TextField(blank=True)
+    date_queued = models.DateTimeField()
+    date_failed = models.DateTimeField(default=datetime.datetime.now,
+                                       db_index=True)
+
+    objects = managers.DeadLetterManager()
+
+    class Meta:
+        ordering = ('-date_failed',)
+
+
 class Blacklist(models.Model):
     """
     A blacklisted email address.
     
     Messages attempted to be sent to e-mail addresses which appear on this
-    blacklist will be skipped entirely.
+    blacklist will be skipped entirely. Addresses are matched
+    case-insensitively, and an address of ``*@example.com`` blacklists a
+    whole domain.
     
     """
-    email = models.EmailField(max_length=200)
-    date_added = models.DateTimeField(default=datetime.datetime.now)
+    email = models.CharField(max_length=200, help_text='An e-mail address, '
+                             'or *@domain to blacklist a whole domain.')
+    date_added = models.DateTimeField(default=datetime.datetime.now,
+                                      db_index=True)
 
     class Meta:
         ordering = ('-date_added',)
@@ -103,8 +227,146 @@ class Log(models.Model):
     """
     message = models.ForeignKey(Message, editable=False)
     result = models.PositiveSmallIntegerField(choices=RESULT_CODES)
-    date = models.DateTimeField(default=datetime.datetime.now)
+    date = models.DateTimeField(default=datetime.datetime.now, db_index=True)
     log_message = models.TextField()
 
     class Meta:
         ordering = ('-date',)
+
+    def get_log_message(self):
+        """
+        Returns the log message text, decompressing it if needed.
+        """
+        return compression.decompress(self.log_message)
+
+
+class RateLimitBucket(models.Model):
+    """
+    The state of a token bucket rate limit shared by every sending worker
+    (see the ``MAILER_SHARED_RATE_LIMITS`` setting).
+
+    """
+    key = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    # When the tokens were last topped up, as a Unix timestamp.
+    updated = models.FloatField()
+
+    def __unicode__(self):
+        return self.key
+
+
+class CircuitState(models.Model):
+    """
+    The state of the circuit breaker for an email backend, shared by every
+    sending worker (see ``django_mailer.circuit``).
+
+    While ``next_probe`` is set the circuit is open: nothing is sent through
+    the backend until that time, when a single worker probes it again.
+
+    """
+    key = models.CharField(max_length=255, unique=True)
+    failures = models.PositiveIntegerField(default=0)
+    tripped = models.DateTimeField(null=True, blank=True)
+    next_probe = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'circuit breaker'
+
+    def __unicode__(self):
+        return self.key
+
+
+class SendLock(models.Model):
+    """
+    A lock taken out by a sender (see ``django_mailer.locks.DatabaseLock``).
+
+    The lock is free while ``owner`` is empty, or once its ``heartbeat`` is
+    older than the ``MAILER_LOCK_STALE_AFTER`` setting.
+
+    """
+    name = models.CharField(max_length=255, unique=True)
+    owner = models.CharField(max_length=100, blank=True)
+    hostname = models.CharField(max_length=255, blank=True)
+    pid = models.PositiveIntegerField(null=True, blank=True)
+    acquired = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'send lock'
+
+    def __unicode__(self):
+        return self.name
+
+
+class DeliveryStat(models.Model):
+    """
+    The number of messages sent, failed and skipped in an hour, by priority
+    and email backend.
+
+    These counters (and the ``QueueStat`` ones) are kept up to date as mail is
+    queued and sent (see ``django_mailer.stats``), so reporting doesn't need
+    to count the rows of the queue or the logs.
+
+    """
+    period = models.DateTimeField(db_index=True)
+    priority = models.PositiveSmallIntegerField(choices=PRIORITIES)
+    backend = models.CharField(max_length=255)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('-period', 'priority')
+        unique_together = ('period', 'priority', 'backend')
+        verbose_name = 'delivery statistics'
+        verbose_name_plural = 'delivery statistics'
+
+
+class QueueStat(models.Model):
+    """
+    The number of messages in a named queue, and how many of those are
+    deferred, as of the last time the ``QueueStatChange`` rows were added to
+    it.
+
+    """
+    queue = models.CharField(max_length=50, unique=True)
+    queued = models.IntegerField(default=0)
+    deferred = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('queue',)
+        verbose_name = 'queue depth'
+
+    def __unicode__(self):
+        return self.queue
+
+
+class QueueStatChange(models.Model):
+    """
+    A change to the number of messages in a named queue which hasn't been
+    added to its ``QueueStat`` yet.
+
+    Changes are only ever inserted, so processes queueing and sending mail at
+    the same time don't wait on each other's counter updates.
+
+    """
+    queue = models.CharField(max_length=50)
+    queued = models.IntegerField(default=0)
+    deferred = models.IntegerField(default=0)
+
+
+class LogRollup(models.Model):
+    """
+    The number of logs with each result on a day, kept when old logs are
+    deleted by the ``cleanup_mail`` command.
+
+    """
+    date = models.DateField()
+    result = models.PositiveSmallIntegerField(choices=RESULT_CODES)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ('-date', 'result')
+        unique_together = ('date', 'result')
+        verbose_name = 'log summary'
+        verbose_name_plural = 'log summaries'
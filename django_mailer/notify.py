@@ -0,0 +1,183 @@
+"""
+Wake up a waiting sender as soon as new mail is queued.
+
+With PostgreSQL, ``LISTEN``/``NOTIFY`` is used (notifications are only
+delivered once the transaction queueing the mail commits). Otherwise, each
+waiting sender listens on a UNIX datagram socket in the
+``MAILER_NOTIFY_SOCKET_DIR`` directory and every socket there is sent a
+notification, so this only wakes senders on the same host.
+
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from django_mailer import settings
+
+CHANNEL = 'django_mailer'
+
+# The connection parameters libpq accepts, which are passed on from the
+# database's OPTIONS (others, such as Django's own "autocommit", aren't).
+LIBPQ_OPTIONS = frozenset([
+    'application_name', 'client_encoding', 'connect_timeout',
+    'fallback_application_name', 'gsslib', 'keepalives', 'keepalives_count',
+    'keepalives_idle', 'keepalives_interval', 'krbsrvname', 'options',
+    'passfile', 'requirepeer', 'requiressl', 'service', 'sslcert',
+    'sslcompression', 'sslcrl', 'sslkey', 'sslmode', 'sslrootcert',
+    'target_session_attrs', 'tcp_user_timeout'])
+
+logger = logging.getLogger('django_mailer.notify')
+
+
+def _use_postgres(using):
+    return connections[using].vendor == 'postgresql'
+
+
+def notify(using=None):
+    """
+    Notify waiting senders that new mail has been queued.
+
+    """
+    if not settings.NOTIFY:
+        return
+    using = using or DEFAULT_DB_ALIAS
+    if _use_postgres(using):
+        cursor = connections[using].cursor()
+        cursor.execute('NOTIFY %s' % CHANNEL)
+        transaction.commit_unless_managed(using=using)
+    elif hasattr(socket, 'AF_UNIX') and \
+            os.path.isdir(settings.NOTIFY_SOCKET_DIR):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for name in os.listdir(settings.NOTIFY_SOCKET_DIR):
+                path = os.path.join(settings.NOTIFY_SOCKET_DIR, name)
+                try:
+                    sock.sendto('1', path)
+                except socket.error, err:
+                    if err.errno == errno.ECONNREFUSED:
+                        # Nothing is listening any more.
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+        finally:
+            sock.close()
+
+
+def get_listener(using=None):
+    """
+    Return a listener which can wait for notifications, or ``None`` if
+    notifications aren't available (in which case the queue must be
+    polled).
+
+    """
+    if not settings.NOTIFY:
+        return None
+    using = using or DEFAULT_DB_ALIAS
+    if _use_postgres(using):
+        return PostgresListener(using)
+    if hasattr(socket, 'AF_UNIX'):
+        return SocketListener()
+    return None
+
+
+def connection_params(settings_dict):
+    """
+    Return the ``psycopg2.connect`` arguments for a database's settings.
+
+    """
+    params = {'database': settings_dict['NAME']}
+    for key, param in (('USER', 'user'), ('PASSWORD', 'password'),
+                       ('HOST', 'host'), ('PORT', 'port')):
+        if settings_dict[key]:
+            params[param] = settings_dict[key]
+    for key, value in settings_dict.get('OPTIONS', {}).items():
+        if key in LIBPQ_OPTIONS:
+            params[key] = value
+    return params
+
+
+class PostgresListener(object):
+    """
+    Wait for notifications using PostgreSQL's ``LISTEN`` on a dedicated
+    database connection.
+
+    """
+
+    def __init__(self, using):
+        import psycopg2
+        import psycopg2.extensions
+        params = connection_params(connections[using].settings_dict)
+        self.connection = psycopg2.connect(**params)
+        self.connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.connection.cursor().execute('LISTEN %s' % CHANNEL)
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for a notification, returning whether
+        one was received.
+
+        """
+        self.connection.poll()
+        if not self.connection.notifies:
+            if select.select([self.connection], [], [], timeout) == \
+                    ([], [], []):
+                return False
+            self.connection.poll()
+        notified = bool(self.connection.notifies)
+        del self.connection.notifies[:]
+        return notified
+
+    def close(self):
+        self.connection.close()
+
+
+class SocketListener(object):
+    """
+    Wait for notifications on a UNIX datagram socket.
+
+    """
+
+    def __init__(self):
+        if not os.path.isdir(settings.NOTIFY_SOCKET_DIR):
+            try:
+                os.makedirs(settings.NOTIFY_SOCKET_DIR)
+            except OSError:
+                # Probably created by another sender in the meantime.
+                pass
+        self.path = os.path.join(settings.NOTIFY_SOCKET_DIR,
+                                 '%s.sock' % os.getpid())
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for a notification, returning whether
+        one was received.
+
+        """
+        if select.select([self.socket], [], [], timeout) == ([], [], []):
+            return False
+        # Drain any other notifications which have arrived.
+        while True:
+            try:
+                self.socket.recv(16)
+            except socket.error:
+                return True
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
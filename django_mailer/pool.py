@@ -0,0 +1,263 @@
+"""
+Delivery of messages through long-lived backend connections.
+
+``InlineDelivery`` delivers messages one at a time through a single
+connection. ``DeliveryPool`` delivers messages concurrently through a pool
+of worker threads, each of which holds its own connection. Only the actual
+delivery happens in the worker threads; delivery results are handed back to
+the thread which submitted the messages, so all database work stays in that
+thread.
+
+Both keep their connections open between messages (and between runs, if the
+same instance is reused), reconnecting after a connection level failure, once
+a connection has been idle for ``idle_timeout`` seconds, or once it has
+reached its ``max_messages`` or ``max_age``.
+
+"""
+
+import logging
+import Queue
+import smtplib
+import socket
+import threading
+import time
+
+logger = logging.getLogger('django_mailer.pool')
+
+# Errors which mean the connection can't be used any more.
+CONNECTION_ERRORS = (socket.error, smtplib.SMTPServerDisconnected)
+
+
+class ManagedConnection(object):
+    """
+    A backend connection which is opened when first needed and kept open
+    until it fails, is closed, or has been idle for ``idle_timeout`` seconds.
+
+    ``connection_factory`` is a callable returning a new (unopened) backend
+    connection.
+
+    The connection is recycled (closed and a new one opened) once it has been
+    used to send ``max_messages`` messages or has been open for ``max_age``
+    seconds, to stay within the limits mail servers put on each session.
+
+    """
+
+    def __init__(self, connection_factory, idle_timeout=None,
+                 max_messages=None, max_age=None):
+        self.connection_factory = connection_factory
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.connection = None
+        self.last_used = None
+        self.opened = None
+        self.messages = 0
+
+    def get(self):
+        """
+        Return the open connection, opening a new one if needed.
+
+        """
+        if self.connection is not None and self.expired():
+            logger.debug("Recycling connection.")
+            self.close()
+        if self.connection is None:
+            connection = self.connection_factory()
+            connection.open()
+            self.connection = connection
+            self.opened = time.time()
+            self.messages = 0
+        self.last_used = time.time()
+        return self.connection
+
+    def expired(self):
+        """
+        Return whether the connection has sent as many messages or been open
+        for as long as it should be.
+
+        """
+        if self.max_messages and self.messages >= self.max_messages:
+            return True
+        return bool(self.max_age and
+                    time.time() - self.opened >= self.max_age)
+
+    def close(self):
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        try:
+            connection.close()
+        except Exception:
+            # The connection may well be broken already.
+            pass
+
+    def close_idle(self):
+        """
+        Close the connection if it has been idle for too long.
+
+        """
+        if (self.connection is not None and self.idle_timeout is not None
+                and time.time() - self.last_used >= self.idle_timeout):
+            logger.debug("Closing idle connection.")
+            self.close()
+
+    def attempt(self, deliver, message):
+        """
+        Deliver ``message`` using the ``deliver`` callable (which takes the
+        message and a connection), returning the exception raised or ``None``
+        if delivery succeeded.
+
+        If a connection which had already been used turns out to have been
+        dropped by the server, the message is tried once more through a new
+        connection.
+
+        """
+        for retry in (True, False):
+            reused = False
+            try:
+                connection = self.get()
+                reused = self.messages > 0
+                self.messages += 1
+                deliver(message, connection)
+            except Exception, err:
+                if isinstance(err, CONNECTION_ERRORS):
+                    logger.debug("Connection failed: %s" % err)
+                    self.close()
+                    if retry and reused:
+                        logger.info("Connection dropped, reconnecting.")
+                        continue
+                return err
+            return None
+
+
+class InlineDelivery(object):
+    """
+    Delivers messages as soon as they are submitted, through a single
+    connection.
+
+    ``deliver`` is a callable taking a ``Message`` instance and a connection
+    which sends the message, raising an exception on failure. The other
+    arguments are passed on to ``ManagedConnection``.
+
+    """
+
+    def __init__(self, connection_factory, deliver, idle_timeout=None,
+                 max_messages=None, max_age=None):
+        self.connection = ManagedConnection(connection_factory, idle_timeout,
+                                            max_messages, max_age)
+        self.deliver = deliver
+        self.results = []
+
+    def submit(self, item, message):
+        """
+        Deliver ``message``. ``item`` is returned along with the result of the
+        delivery by ``completed``.
+
+        """
+        self.results.append(
+            (item, self.connection.attempt(self.deliver, message)))
+
+    def completed(self, wait=False):
+        """
+        Iterate ``(item, error)`` tuples for deliveries which have finished,
+        where ``error`` is ``None`` for a successful delivery.
+
+        """
+        while self.results:
+            yield self.results.pop(0)
+
+    def close_idle(self):
+        self.connection.close_idle()
+
+    def close(self):
+        self.connection.close()
+
+
+class DeliveryPool(object):
+    """
+    A pool of ``size`` threads delivering messages concurrently.
+
+    The arguments are otherwise the same as for ``InlineDelivery``.
+
+    """
+
+    def __init__(self, size, connection_factory, deliver, idle_timeout=None,
+                 max_messages=None, max_age=None):
+        self.size = size
+        self.connection_factory = connection_factory
+        self.deliver = deliver
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.pending = 0
+        # Keep the number of undelivered messages handed to the pool bounded
+        # so that the submitting thread can process results as they arrive.
+        self.tasks = Queue.Queue(size * 2)
+        self.results = Queue.Queue()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work,
+                                      name='django-mailer-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        connection = ManagedConnection(self.connection_factory,
+                                       self.idle_timeout, self.max_messages,
+                                       self.max_age)
+        try:
+            while True:
+                try:
+                    task = self.tasks.get(timeout=self.idle_timeout)
+                except Queue.Empty:
+                    connection.close_idle()
+                    continue
+                if task is None:
+                    break
+                item, message = task
+                self.results.put(
+                    (item, connection.attempt(self.deliver, message)))
+        finally:
+            connection.close()
+
+    def submit(self, item, message):
+        """
+        Queue ``message`` for delivery. ``item`` is returned along with the
+        result of the delivery by ``completed``.
+
+        """
+        self.pending += 1
+        self.tasks.put((item, message))
+
+    def completed(self, wait=False):
+        """
+        Iterate ``(item, error)`` tuples for deliveries which have finished,
+        where ``error`` is ``None`` for a successful delivery.
+
+        If ``wait`` is ``True``, block until every submitted message has been
+        delivered.
+
+        """
+        while self.pending:
+            try:
+                item, error = self.results.get(block=wait)
+            except Queue.Empty:
+                return
+            self.pending -= 1
+            yield item, error
+
+    def close_idle(self):
+        # Each worker thread closes its own idle connection.
+        pass
+
+    def close(self):
+        """
+        Stop the worker threads once all submitted messages are delivered,
+        closing their connections.
+
+        """
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,293 @@
+"""
+Rate limits and concurrency caps for the mail sent to each recipient domain.
+
+Limits are configured by the ``MAILER_RATE_LIMITS`` setting (per recipient
+domain) and the ``MAILER_BACKEND_RATE_LIMIT`` setting (for all mail sent
+through the backend). Each limit is a dictionary which can contain:
+
+``rate``
+    The number of messages per second which can be sent on average.
+
+``burst``
+    The number of messages which can be sent at once before the rate applies
+    (defaults to the rate, or 1 if that is lower).
+
+``concurrency``
+    The most deliveries which can be in progress at the same time.
+
+Rate limits are token buckets, kept in memory by each worker process or, if
+``MAILER_SHARED_RATE_LIMITS`` is enabled, in the database so that they apply
+across every worker. The buckets for the ``MAILER_RATE_LIMITS`` and
+``MAILER_BACKEND_RATE_LIMIT`` settings are shared by the workers of every
+queue, while a queue's own ``rate_limits`` and ``backend_rate_limit`` (see
+``MAILER_QUEUES``) have buckets of their own.
+
+Concurrency caps are only enforced within each worker process, so several
+workers sending to the same domain can together have up to that many times
+the cap in progress.
+
+"""
+
+import threading
+import time
+
+from django.db import IntegrityError, transaction
+
+from django_mailer import models, settings
+
+# The domain key which applies to every domain without its own limit.
+DEFAULT_DOMAIN = '*'
+
+# How long to wait before checking again when the concurrency cap has been
+# reached.
+CONCURRENCY_RECHECK = 0.05
+
+_limiters = {}
+# The in-memory buckets of this process, shared by its limiters.
+_buckets = {}
+_limiters_lock = threading.Lock()
+
+
+def _take(tokens, updated, now, rate, burst, count):
+    """
+    Top up the ``tokens`` of a bucket last topped up at ``updated`` and try
+    to take ``count`` of them.
+
+    Returns the new ``(tokens, wait)`` where ``wait`` is ``0`` if the tokens
+    were taken or otherwise the seconds until enough will be available. A
+    full bucket always gives out the tokens asked for, even if that is more
+    than it holds, leaving it owing the difference.
+
+    """
+    tokens = min(burst, tokens + max(now - updated, 0) * rate)
+    if tokens >= min(count, burst):
+        return tokens - count, 0
+    return tokens, (min(count, burst) - tokens) / rate
+
+
+class TokenBucket(object):
+    """
+    A token bucket kept in memory, safe to use from several threads.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, count=1, now=None):
+        """
+        Take ``count`` tokens, returning ``0`` or (if there aren't enough)
+        the seconds to wait before trying again.
+
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.tokens, wait = _take(self.tokens, self.updated, now,
+                                      self.rate, self.burst, count)
+            self.updated = now
+            return wait
+
+    def refund(self, count=1):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + count)
+
+
+class DatabaseBucket(object):
+    """
+    A token bucket stored as a ``RateLimitBucket`` so it is shared by every
+    sending worker.
+
+    """
+
+    def __init__(self, key, rate, burst):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+
+    def _update(self, change):
+        with transaction.commit_on_success():
+            queryset = models.RateLimitBucket.objects.select_for_update()
+            try:
+                bucket = queryset.get(key=self.key)
+            except models.RateLimitBucket.DoesNotExist:
+                bucket = models.RateLimitBucket(key=self.key,
+                                                tokens=self.burst,
+                                                updated=time.time())
+            result = change(bucket)
+            bucket.save()
+            return result
+
+    def take(self, count=1, now=None):
+        """
+        Take ``count`` tokens, returning ``0`` or (if there aren't enough)
+        the seconds to wait before trying again.
+
+        """
+        if now is None:
+            now = time.time()
+
+        def take(bucket):
+            bucket.tokens, wait = _take(bucket.tokens, bucket.updated, now,
+                                        self.rate, self.burst, count)
+            bucket.updated = now
+            return wait
+
+        try:
+            return self._update(take)
+        except IntegrityError:
+            # Another worker created the bucket first.
+            return self._update(take)
+
+    def refund(self, count=1):
+        def refund(bucket):
+            bucket.tokens = min(self.burst, bucket.tokens + count)
+        self._update(refund)
+
+
+class Limiter(object):
+    """
+    Applies the configured limits to the deliveries made through one backend.
+
+    Deliveries are grouped by recipient domain: ``acquire`` must allow a
+    delivery before it starts and ``release`` be called once it finishes.
+
+    The rate limit buckets are shared with every other limiter for the same
+    backend, unless ``limits_queue`` or ``backend_limit_queue`` name the
+    queue which the ``limits`` or ``backend_limit`` (respectively) belong to.
+
+    """
+
+    def __init__(self, limits=None, backend_limit=None, backend=None,
+                 shared=False, limits_queue=None, backend_limit_queue=None):
+        self.limits = dict((domain.lower(), limit)
+                           for domain, limit in (limits or {}).items())
+        self.backend_limit = backend_limit
+        self.backend = backend or ''
+        self.limits_queue = limits_queue or ''
+        self.backend_limit_queue = backend_limit_queue or ''
+        self.shared = shared
+        self.buckets = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.limits or self.backend_limit)
+
+    def domain(self, address):
+        return address.rpartition('@')[2].strip().lower()
+
+    def _bucket(self, name, limit, queue=''):
+        if not limit.get('rate'):
+            return None
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            rate = float(limit['rate'])
+            burst = limit.get('burst') or max(rate, 1)
+            key = ('%s:%s:%s' % (self.backend, queue, name))[:255]
+            if self.shared:
+                bucket = DatabaseBucket(key, rate, burst)
+            else:
+                with _limiters_lock:
+                    bucket = _buckets.get(key)
+                    if bucket is None:
+                        bucket = _buckets[key] = TokenBucket(rate, burst)
+            self.buckets[name] = bucket
+        return bucket
+
+    def acquire(self, domain, count=1):
+        """
+        Start a delivery of ``count`` messages to ``domain`` if the limits
+        allow it, returning ``0``. Otherwise, returns the seconds to wait
+        before trying again.
+
+        """
+        if not self.enabled:
+            return 0
+        limit = self.limits.get(domain, self.limits.get(DEFAULT_DOMAIN))
+        with self.lock:
+            if limit and limit.get('concurrency') and \
+                    self.in_flight.get(domain, 0) >= limit['concurrency']:
+                return CONCURRENCY_RECHECK
+            if self.backend_limit and self.backend_limit.get('concurrency') \
+                    and sum(self.in_flight.values()) >= \
+                    self.backend_limit['concurrency']:
+                return CONCURRENCY_RECHECK
+            domain_bucket = limit and self._bucket(domain, limit,
+                                                   self.limits_queue)
+            if domain_bucket:
+                wait = domain_bucket.take(count)
+                if wait:
+                    return wait
+            backend_bucket = self.backend_limit and \
+                self._bucket(DEFAULT_DOMAIN, self.backend_limit,
+                             self.backend_limit_queue)
+            if backend_bucket:
+                wait = backend_bucket.take(count)
+                if wait:
+                    if domain_bucket:
+                        domain_bucket.refund(count)
+                    return wait
+            self.in_flight[domain] = self.in_flight.get(domain, 0) + 1
+            return 0
+
+    def release(self, domain):
+        """
+        Finish a delivery started by ``acquire``.
+
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.in_flight[domain] -= 1
+            if not self.in_flight[domain]:
+                del self.in_flight[domain]
+
+
+def get_limiter(backend=None, queue=None):
+    """
+    Return the ``Limiter`` shared by this process for ``backend`` and the
+    named ``queue``, so that its limits carry over from one run to the next.
+
+    A queue's limits can be set by the ``rate_limits`` and
+    ``backend_rate_limit`` options of the ``MAILER_QUEUES`` setting, which
+    limit that queue separately. Otherwise the ``MAILER_RATE_LIMITS`` and
+    ``MAILER_BACKEND_RATE_LIMIT`` settings apply, to the mail of all queues
+    together.
+
+    """
+    with _limiters_lock:
+        limiter = _limiters.get((backend, queue))
+        if limiter is None:
+            options = settings.QUEUES.get(queue) or {}
+            limits = options.get('rate_limits')
+            limits_queue = queue
+            if limits is None:
+                limits = settings.RATE_LIMITS
+                limits_queue = None
+            backend_limit = options.get('backend_rate_limit')
+            backend_limit_queue = queue
+            if backend_limit is None:
+                backend_limit = settings.BACKEND_RATE_LIMIT
+                backend_limit_queue = None
+            limiter = Limiter(limits, backend_limit, backend,
+                              settings.SHARED_RATE_LIMITS, limits_queue,
+                              backend_limit_queue)
+            _limiters[(backend, queue)] = limiter
+        return limiter
+
+
+def reset():
+    """
+    Forget the limiters (and in-memory rate limit state) of this process, so
+    that changed settings are picked up.
+
+    """
+    with _limiters_lock:
+        _limiters.clear()
+        _buckets.clear()
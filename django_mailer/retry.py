@@ -0,0 +1,38 @@
+"""
+Scheduling of retries for deferred messages.
+
+"""
+
+import datetime
+import random
+
+from django_mailer import settings
+
+# The random part taken off each delay is a whole number of steps of this
+# many, so that deferred messages can be written back in a few updates.
+JITTER_STEPS = 20
+
+
+def next_attempt(retries, now=None):
+    """
+    Return when a message deferred after ``retries`` previous retries should
+    next be attempted, or ``None`` if it shouldn't be retried automatically.
+
+    The delay doubles with each retry (starting at ``MAILER_RETRY_DELAY``
+    seconds, up to ``MAILER_RETRY_MAX_DELAY``). A random part of up to half of
+    it (in ``JITTER_STEPS`` steps) is taken off so that messages deferred
+    together or over a period are spread out rather than all being retried
+    at the same moment.
+
+    """
+    if not settings.RETRY_DELAY:
+        return None
+    if settings.MAX_RETRIES is not None and retries >= settings.MAX_RETRIES:
+        return None
+    if now is None:
+        now = datetime.datetime.now()
+    delay = settings.RETRY_DELAY * 2 ** min(retries, 32)
+    if settings.RETRY_MAX_DELAY:
+        delay = min(delay, settings.RETRY_MAX_DELAY)
+    delay -= delay / 2.0 * random.randint(0, JITTER_STEPS) / JITTER_STEPS
+    return now + datetime.timedelta(seconds=delay)
@@ -1,4 +1,6 @@
+import os
 import smtplib
+import tempfile
 from socket import error as SocketError
 
 from django.conf import settings
@@ -23,6 +25,15 @@ MAIL_MANAGERS_PRIORITY = getattr(settings, 'MAILER_MAIL_MANAGERS_PRIORITY',
 # When queue is empty, how long to wait (in seconds) before checking again.
 EMPTY_QUEUE_SLEEP = getattr(settings, "MAILER_EMPTY_QUEUE_SLEEP", 30)
 
+# Wake up a waiting sender (see send_loop) as soon as new mail is queued.
+NOTIFY = getattr(settings, "MAILER_NOTIFY", True)
+
+# The directory holding the sockets used to wake up waiting senders (unless
+# PostgreSQL is being used).
+NOTIFY_SOCKET_DIR = getattr(settings, "MAILER_NOTIFY_SOCKET_DIR",
+                            os.path.join(tempfile.gettempdir(),
+                                         'django_mailer'))
+
 # Lock timeout value. how long to wait for the lock to become available.
 # default behavior is to never wait for the lock to be available.
 LOCK_WAIT_TIMEOUT = max(getattr(settings, "MAILER_LOCK_WAIT_TIMEOUT", 0), 0)
@@ -31,6 +42,110 @@ LOCK_WAIT_TIMEOUT = max(getattr(settings, "MAILER_LOCK_WAIT_TIMEOUT", 0), 0)
 # projects running on the same server.
 LOCK_PATH = getattr(settings, "MAILER_LOCK_PATH", None)
 
+# The class of the lock stopping more than one sender running at once (see
+# django_mailer.locks). Defaults to an flock lock file (or a lockfile lock
+# where flock isn't available).
+LOCK_BACKEND = getattr(settings, "MAILER_LOCK_BACKEND", None)
+
+# How long (in seconds) since its holder's last heartbeat before a lock is
+# considered stale and broken by the next sender.
+LOCK_STALE_AFTER = getattr(settings, "MAILER_LOCK_STALE_AFTER", 600)
+
+# How long (in seconds) a sending worker's claim on a block of queued messages
+# lasts. If a worker dies, its messages are picked up again by other workers
+# once the lease expires.
+LEASE_SECONDS = getattr(settings, "MAILER_LEASE_SECONDS", 600)
+
+# Claim queued messages using SELECT ... FOR UPDATE SKIP LOCKED (requires
+# PostgreSQL 9.5 or later). Otherwise an atomic conditional UPDATE is used.
+USE_SKIP_LOCKED = getattr(settings, "MAILER_USE_SKIP_LOCKED", False)
+
+# How often (in seconds) the in-memory blacklist is entirely reloaded. In
+# between, only newly added addresses are fetched.
+BLACKLIST_RELOAD = getattr(settings, "MAILER_BLACKLIST_RELOAD", 300)
+
+# How often (in seconds) the in-memory blacklist is checked for newly added
+# addresses.
+BLACKLIST_REFRESH = getattr(settings, "MAILER_BLACKLIST_REFRESH", 5)
+
+# Compress the content of queued messages (and log messages) when storing
+# them in the database.
+COMPRESS = getattr(settings, "MAILER_COMPRESS", False)
+
+# Store fully rendered messages when they are queued (keeping cc, bcc,
+# attachments and extra headers) and send them as they are.
+STORE_MIME = getattr(settings, "MAILER_STORE_MIME", False)
+
+# The most recipients a message with fully rendered content (see STORE_MIME)
+# is delivered to in a single transaction. 1 delivers to each recipient
+# separately.
+MAX_RECIPIENTS = getattr(settings, "MAILER_MAX_RECIPIENTS", 100)
+
+# Deferred messages are retried automatically after this many seconds,
+# doubling after each retry up to RETRY_MAX_DELAY. 0 (or None) only retries
+# messages placed back in the queue by the retry_deferred command.
+RETRY_DELAY = getattr(settings, "MAILER_RETRY_DELAY", 60)
+RETRY_MAX_DELAY = getattr(settings, "MAILER_RETRY_MAX_DELAY", 6 * 60 * 60)
+
+# Stop retrying deferred messages automatically after this many retries
+# (None retries them indefinitely).
+MAX_RETRIES = getattr(settings, "MAILER_MAX_RETRIES", None)
+
+# Move a message out of the queue, to the dead letters, once it has failed
+# this many times with an error which doesn't defer it, or (if set) once it
+# has been retried this many times after being deferred. 0 (or None) never
+# moves messages.
+DEAD_LETTER_FAILURES = getattr(settings, "MAILER_DEAD_LETTER_FAILURES", 3)
+DEAD_LETTER_RETRIES = getattr(settings, "MAILER_DEAD_LETTER_RETRIES", None)
+
+# Stop sending after this many consecutive connection failures, probing the
+# backend every CIRCUIT_BREAKER_PROBE_INTERVAL seconds until it can be
+# reached again. 0 disables the circuit breaker.
+CIRCUIT_BREAKER_THRESHOLD = getattr(settings,
+                                    "MAILER_CIRCUIT_BREAKER_THRESHOLD", 5)
+CIRCUIT_BREAKER_PROBE_INTERVAL = getattr(
+    settings, "MAILER_CIRCUIT_BREAKER_PROBE_INTERVAL", 60)
+
+# Options for each named queue, e.g.
+# {'newsletter': {'concurrency': 4, 'rate_limits': {'*': {'rate': 10}}}}.
+QUEUES = getattr(settings, "MAILER_QUEUES", {})
+
+# Rate limits and concurrency caps keyed by recipient domain ("*" applies
+# to each domain without its own limit), e.g.
+# {'example.com': {'rate': 10, 'burst': 20, 'concurrency': 2}}.
+RATE_LIMITS = getattr(settings, "MAILER_RATE_LIMITS", {})
+
+# A rate limit and concurrency cap for all mail sent through the backend.
+BACKEND_RATE_LIMIT = getattr(settings, "MAILER_BACKEND_RATE_LIMIT", None)
+
+# Keep rate limits in the database so that they apply across all workers.
+SHARED_RATE_LIMITS = getattr(settings, "MAILER_SHARED_RATE_LIMITS", False)
+
+# Backend connections held open by a sending daemon are closed after being
+# idle for this many seconds.
+CONNECTION_IDLE_TIMEOUT = getattr(settings, "MAILER_CONNECTION_IDLE_TIMEOUT",
+                                  60)
+
+# Backend connections are closed and reopened after sending this many
+# messages or being open for this many seconds (None for no limit).
+CONNECTION_MAX_MESSAGES = getattr(settings, "MAILER_CONNECTION_MAX_MESSAGES",
+                                  None)
+CONNECTION_MAX_AGE = getattr(settings, "MAILER_CONNECTION_MAX_AGE", None)
+
+# The class writing logs of sent (and failed) mail. The default buffers logs
+# and writes them in bulk, 'django_mailer.logwriter.SyncLogWriter' writes them
+# along with the changes to the queue.
+LOG_WRITER = getattr(settings, "MAILER_LOG_WRITER",
+                     'django_mailer.logwriter.BufferedLogWriter')
+
+# Buffered logs are written once this many are waiting or after this many
+# seconds.
+LOG_BUFFER_SIZE = getattr(settings, "MAILER_LOG_BUFFER_SIZE", 500)
+LOG_FLUSH_INTERVAL = getattr(settings, "MAILER_LOG_FLUSH_INTERVAL", 5)
+
+# The directory the archive_mail command writes archived mail to.
+ARCHIVE_DIR = getattr(settings, "MAILER_ARCHIVE_DIR", None)
+
 # Should be an interable containing dotted path to exceptions
 # e.g: DEFER_ON_ERRORS = ('mail_backend.Exception1', 'mail_backend.Exception2')
 
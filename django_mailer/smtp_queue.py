@@ -26,10 +26,11 @@ class EmailBackend(BaseEmailBackend):
         if not email_messages:
             return
 
-        from django_mailer import queue_email_message
+        from django_mailer import queue_email_messages
 
         num_sent = 0
-        
+        queued = []
+
         '''
         Now that email sending actually calls backend's "send" method,
         this had to be tweaked to simply append to outbox when priority
@@ -43,6 +44,7 @@ class EmailBackend(BaseEmailBackend):
                 from django.core import mail
                 mail.outbox.append(email_message)
             else:
-                queue_email_message(email_message)
+                queued.append(email_message)
             num_sent += 1
+        queue_email_messages(queued)
         return num_sent
@@ -0,0 +1,8 @@
+-- Indexes matching the order in which the queue is fetched (see
+-- django_mailer.engine._message_blocks), so the next block of messages which
+-- are due can be read straight off a range of the index, rather than sorting
+-- the whole queue or scanning past the messages which aren't due yet.
+CREATE INDEX django_mailer_queuedmessage_fetch
+    ON django_mailer_queuedmessage (priority, next_attempt, id);
+CREATE INDEX django_mailer_queuedmessage_queue_fetch
+    ON django_mailer_queuedmessage (queue, priority, next_attempt, id);
@@ -0,0 +1,60 @@
+-- Upgrade the tables of an existing django mailer installation to this
+-- version. Run "./manage.py syncdb" first to create the new tables, then run
+-- these statements once (for example, through "./manage.py dbshell").
+
+-- The content of new messages is held in a shared message body.
+ALTER TABLE "django_mailer_message"
+    ADD COLUMN "body_id" integer NULL
+        REFERENCES "django_mailer_messagebody" ("id");
+
+-- Failure counts, automatic retries, named queues and leases.
+ALTER TABLE "django_mailer_queuedmessage"
+    ADD COLUMN "failures" integer unsigned NOT NULL DEFAULT 0;
+ALTER TABLE "django_mailer_queuedmessage"
+    ADD COLUMN "next_attempt" datetime NULL;
+ALTER TABLE "django_mailer_queuedmessage"
+    ADD COLUMN "queue" varchar(50) NOT NULL DEFAULT 'default';
+ALTER TABLE "django_mailer_queuedmessage"
+    ADD COLUMN "lease_owner" varchar(100) NOT NULL DEFAULT '';
+ALTER TABLE "django_mailer_queuedmessage"
+    ADD COLUMN "lease_expires" datetime NULL;
+
+-- Every message is sent once its next attempt is due: messages queued
+-- before the upgrade when they were queued for, and messages deferred before
+-- the upgrade are retried automatically.
+UPDATE "django_mailer_queuedmessage" SET "next_attempt" = "date_queued"
+    WHERE "deferred" IS NULL;
+UPDATE "django_mailer_queuedmessage" SET "next_attempt" = "deferred"
+    WHERE "deferred" IS NOT NULL;
+
+-- The indexes printed by "./manage.py sqlindexes django_mailer".
+CREATE INDEX "django_mailer_message_5b892844"
+    ON "django_mailer_message" ("body_id");
+CREATE INDEX "django_mailer_message_7aea2042"
+    ON "django_mailer_message" ("date_created");
+CREATE INDEX "django_mailer_queuedmessage_a2c47956"
+    ON "django_mailer_queuedmessage" ("next_attempt");
+CREATE INDEX "django_mailer_queuedmessage_3e515174"
+    ON "django_mailer_queuedmessage" ("date_queued");
+CREATE INDEX "django_mailer_queuedmessage_f423320e"
+    ON "django_mailer_queuedmessage" ("lease_owner");
+CREATE INDEX "django_mailer_queuedmessage_dda57359"
+    ON "django_mailer_queuedmessage" ("lease_expires");
+CREATE INDEX "django_mailer_blacklist_39eed79e"
+    ON "django_mailer_blacklist" ("date_added");
+CREATE INDEX "django_mailer_log_986cbc25"
+    ON "django_mailer_log" ("date");
+
+-- The indexes matching the order the queue is fetched in (see
+-- ../queuedmessage.sql).
+CREATE INDEX "django_mailer_queuedmessage_fetch"
+    ON "django_mailer_queuedmessage" ("priority", "next_attempt", "id");
+CREATE INDEX "django_mailer_queuedmessage_queue_fetch"
+    ON "django_mailer_queuedmessage"
+    ("queue", "priority", "next_attempt", "id");
+
+-- Count the messages already queued (see "./manage.py mailer_stats").
+INSERT INTO "django_mailer_queuestat" ("queue", "queued", "deferred")
+    SELECT "queue", COUNT(*), COUNT("deferred")
+    FROM "django_mailer_queuedmessage"
+    GROUP BY "queue";
@@ -0,0 +1,308 @@
+"""
+Counters of the mail sent and the depth of each queue.
+
+``DeliveryStat`` rows count the messages sent, failed and skipped each hour
+(by priority and email backend), and ``QueueStat`` rows count the messages in
+each named queue. Both are updated incrementally as mail is queued and sent,
+so reporting on them (see the ``mailer_stats`` command) stays cheap however
+large the queue and logs get.
+
+Changes to the queue depths are recorded as new ``QueueStatChange`` rows,
+rather than by updating the queue's single ``QueueStat`` row while the mail
+is queued (which would make every request queueing mail wait for the
+others to commit). ``fold_queue_changes`` adds them to the ``QueueStat`` rows
+after each sending run.
+
+When old logs are deleted (see the ``cleanup_mail`` command), they are
+counted in ``LogRollup`` rows first, by day and result.
+
+Queued messages deleted other than by sending them (for example, through
+the admin) aren't counted, so the queue depths can be recounted with
+``rebuild_queue_stats``.
+
+"""
+
+import datetime
+
+from django.conf import settings as django_settings
+from django.db import IntegrityError, connections, transaction
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Count, F, Min, Sum
+
+from django_mailer import constants, models
+from django_mailer.managers import delete_in
+
+# The ``DeliveryStat`` counter for each result.
+RESULT_FIELDS = {
+    constants.RESULT_SENT: 'sent',
+    constants.RESULT_FAILED: 'failed',
+    constants.RESULT_SKIPPED: 'skipped',
+}
+
+
+def get_period(when=None):
+    """
+    Return the start of the hour ``when`` (defaulting to now) falls in.
+
+    """
+    if when is None:
+        when = datetime.datetime.now()
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def get_backend_name(backend=None):
+    """
+    Return the name deliveries through ``backend`` are counted under.
+
+    """
+    return (backend or getattr(django_settings, 'EMAIL_BACKEND', None) or
+            'smtp')[:255]
+
+
+def increment(model, key, **counts):
+    """
+    Add ``counts`` to the counter fields of the ``model`` row matching the
+    ``key`` lookup, creating the row if it doesn't exist yet.
+
+    """
+    counts = dict((field, count) for field, count in counts.items() if count)
+    if not counts:
+        return
+    if not transaction.is_managed():
+        # The savepoint below needs a transaction.
+        with transaction.commit_on_success():
+            return increment(model, key, **counts)
+    changes = dict((field, F(field) + count)
+                   for field, count in counts.items())
+    if model.objects.filter(**key).update(**changes):
+        return
+    values = dict(key)
+    values.update(counts)
+    sid = transaction.savepoint()
+    try:
+        model.objects.create(**values)
+    except IntegrityError:
+        # Another worker created the row first.
+        transaction.savepoint_rollback(sid)
+        model.objects.filter(**key).update(**changes)
+    else:
+        transaction.savepoint_commit(sid)
+
+
+def update_queue(queue, queued=0, deferred=0):
+    """
+    Add to the number of messages (and deferred messages) in ``queue``.
+
+    """
+    if queued or deferred:
+        models.QueueStatChange.objects.create(
+            queue=queue or constants.DEFAULT_QUEUE, queued=queued,
+            deferred=deferred)
+
+
+class _AlreadyFolded(Exception):
+    pass
+
+
+def fold_queue_changes(batch_size=1000):
+    """
+    Add the ``QueueStatChange`` rows to the ``QueueStat`` counters, deleting
+    them, and return the number of changes added.
+
+    Each batch of changes is deleted and added in a single transaction. If
+    another process is folding the same changes, they are left to it.
+
+    """
+    count = 0
+    while True:
+        try:
+            with transaction.commit_on_success():
+                changes = list(models.QueueStatChange.objects.order_by('pk')
+                               .values_list('pk', 'queue', 'queued',
+                                            'deferred')[:batch_size])
+                if not changes:
+                    return count
+                pks = [change[0] for change in changes]
+                if delete_in(models.QueueStatChange, 'id', pks) != len(pks):
+                    raise _AlreadyFolded
+                totals = {}
+                for pk, queue, queued, deferred in changes:
+                    counts = totals.setdefault(queue, [0, 0])
+                    counts[0] += queued
+                    counts[1] += deferred
+                for queue, (queued, deferred) in sorted(totals.items()):
+                    increment(models.QueueStat, {'queue': queue},
+                              queued=queued, deferred=deferred)
+        except _AlreadyFolded:
+            return count
+        count += len(changes)
+        if len(changes) < batch_size:
+            return count
+
+
+class StatsBuffer(object):
+    """
+    Collects changes to the counters so that they can be written together
+    (in the transaction writing the results they count).
+
+    """
+
+    def __init__(self, backend=None):
+        self.backend = get_backend_name(backend)
+        self.deliveries = {}
+        self.queues = {}
+
+    def delivered(self, priority, result, count=1):
+        key = (get_period(), priority)
+        counts = self.deliveries.setdefault(key, {})
+        field = RESULT_FIELDS[result]
+        counts[field] = counts.get(field, 0) + count
+
+    def queue_changed(self, queue, queued=0, deferred=0):
+        counts = self.queues.setdefault(queue, [0, 0])
+        counts[0] += queued
+        counts[1] += deferred
+
+    def flush(self):
+        deliveries, queues = self.deliveries, self.queues
+        self.deliveries, self.queues = {}, {}
+        for (period, priority), counts in sorted(deliveries.items()):
+            increment(models.DeliveryStat,
+                      {'period': period, 'priority': priority,
+                       'backend': self.backend}, **counts)
+        models.QueueStatChange.objects.bulk_create([
+            models.QueueStatChange(queue=queue, queued=queued,
+                                   deferred=deferred)
+            for queue, (queued, deferred) in sorted(queues.items())
+            if queued or deferred])
+
+
+def roll_up_logs(queryset):
+    """
+    Add the logs in ``queryset``, which are about to be deleted, to the daily
+    ``LogRollup`` counts.
+
+    The logs are counted by the database, so only one row for each day and
+    result is read.
+
+    """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    opts = models.Log._meta
+    day = connection.ops.date_trunc_sql('day', '%s.%s' % (
+        qn(opts.db_table), qn(opts.get_field('date').column)))
+    rows = queryset.extra(select={'day': day}).values('day', 'result') \
+        .order_by().annotate(count=Count('pk'))
+    counts = {}
+    for row in rows:
+        date = row['day']
+        if isinstance(date, basestring):
+            # SQLite returns the truncated date as a string.
+            date = typecast_timestamp(date)
+        if isinstance(date, datetime.datetime):
+            date = date.date()
+        key = (date, row['result'])
+        counts[key] = counts.get(key, 0) + row['count']
+    for (date, result), count in sorted(counts.items()):
+        increment(models.LogRollup, {'date': date, 'result': result},
+                  count=count)
+
+
+def queue_depths():
+    """
+    Return a list of ``(queue, queued, deferred)`` tuples, where ``queued``
+    counts every message in the queue (including deferred ones).
+
+    Changes which haven't been folded into the counters yet are included.
+
+    """
+    depths = {}
+    for queue, queued, deferred in models.QueueStat.objects.values_list(
+            'queue', 'queued', 'deferred'):
+        depths[queue] = [queued, deferred]
+    changes = models.QueueStatChange.objects.values('queue').order_by() \
+        .annotate(queued_total=Sum('queued'), deferred_total=Sum('deferred'))
+    for change in changes:
+        counts = depths.setdefault(change['queue'], [0, 0])
+        counts[0] += change['queued_total']
+        counts[1] += change['deferred_total']
+    return [(queue, queued, deferred)
+            for queue, (queued, deferred) in sorted(depths.items())]
+
+
+def oldest_queued(queue=None):
+    """
+    Return when the oldest message which is due to be sent (or was deferred)
+    was queued, or ``None`` if there are no such messages.
+
+    """
+    queryset = models.QueuedMessage.objects.exclude_future()
+    if queue is None:
+        return queryset.aggregate(oldest=Min('date_queued'))['oldest']
+    # Look up each priority separately, so that each lookup can be read off
+    # the queue's index.
+    times = []
+    for priority in sorted(constants.PRIORITIES.values()):
+        times.append(queryset.filter(queue=queue, priority=priority)
+                     .aggregate(oldest=Min('date_queued'))['oldest'])
+    times = [time for time in times if time is not None]
+    return times and min(times) or None
+
+
+def delivery_totals(since=None):
+    """
+    Return a list of ``(period, sent, failed, skipped)`` tuples totalling the
+    deliveries made each hour since ``since``, most recent first.
+
+    """
+    queryset = models.DeliveryStat.objects.all()
+    if since is not None:
+        queryset = queryset.filter(period__gte=get_period(since))
+    totals = queryset.values('period').order_by('-period').annotate(
+        sent_total=Sum('sent'), failed_total=Sum('failed'),
+        skipped_total=Sum('skipped'))
+    return [(row['period'], row['sent_total'], row['failed_total'],
+             row['skipped_total']) for row in totals]
+
+
+def _count_by_queue(queryset):
+    """
+    Return a dictionary mapping each queue to ``[queued, deferred]`` counts
+    of the queued messages in ``queryset``.
+
+    """
+    depths = {}
+    queryset = queryset.values_list('queue').order_by()
+    for queue, count in queryset.annotate(Count('pk')):
+        depths[queue] = [count, 0]
+    for queue, count in queryset.exclude(deferred=None).annotate(Count('pk')):
+        depths[queue][1] = count
+    return depths
+
+
+def queued_deleted(queryset):
+    """
+    Remove the queued messages in ``queryset``, which are about to be
+    deleted, from the queue depths.
+
+    """
+    for queue, (queued, deferred) in sorted(
+            _count_by_queue(queryset).items()):
+        update_queue(queue, -queued, -deferred)
+
+
+def rebuild_queue_stats():
+    """
+    Recount the messages in each queue by scanning the queue.
+
+    """
+    depths = _count_by_queue(models.QueuedMessage.objects.all())
+    with transaction.commit_on_success():
+        models.QueueStatChange.objects.all().delete()
+        models.QueueStat.objects.exclude(queue__in=depths.keys()).delete()
+        for queue, (queued, deferred) in depths.items():
+            updated = models.QueueStat.objects.filter(queue=queue).update(
+                queued=queued, deferred=deferred)
+            if not updated:
+                models.QueueStat.objects.create(queue=queue, queued=queued,
+                                                deferred=deferred)
@@ -1,4 +1,12 @@
 from django_mailer.tests.commands import TestCommands
-from django_mailer.tests.engine import EngineTest, ErrorHandlingTest, LockTest #COULD DROP THIS TEST
+from django_mailer.tests.engine import EngineTest, ErrorHandlingTest, LockTest, NotifyTest #COULD DROP THIS TEST
 from django_mailer.tests.backend import TestBackend
 from django_mailer.tests.models import MailerModelTest
+from django_mailer.tests.blacklist import BlacklistIndexTest
+from django_mailer.tests.ratelimit import RateLimitTest, RateLimitedSendTest
+from django_mailer.tests.circuit import CircuitBreakerTest
+from django_mailer.tests.pool import ManagedConnectionTest
+from django_mailer.tests.queryplan import QueryPlanTest
+from django_mailer.tests.logwriter import LogWriterTest
+from django_mailer.tests.stats import StatsTest
+from django_mailer.tests.locks import LockBackendTest
@@ -87,3 +87,13 @@ class TestBackend(MailerTestCase):
         queued_messages = models.QueuedMessage.objects.all()
         self.assertEqual(queued_messages.count(), 0)
         self.assertEqual(len(mail.outbox), 1)
+
+    def testSendMassMail(self):
+        if not constants.EMAIL_BACKEND_SUPPORT:
+            return
+        datatuple = [('subject %s' % i, 'body', 'mail_from@abc.com',
+                      ['mail_to%s@abc.com' % i, 'mail_to@abc.com'])
+                     for i in range(3)]
+        self.assertEqual(mail.send_mass_mail(datatuple), 3)
+        self.assertEqual(models.QueuedMessage.objects.count(), 6)
+        self.assertEqual(len(mail.outbox), 0)
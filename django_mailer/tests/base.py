@@ -1,4 +1,6 @@
-from smtplib import SMTPRecipientsRefused
+from email.utils import parseaddr
+from smtplib import SMTP, SMTPRecipientsRefused, SMTPServerDisconnected
+import socket
 
 from django.core import mail
 from django.test import TestCase
@@ -6,6 +8,7 @@ from django_mailer import queue_email_message
 from django_mailer.tests.exceptions import DeferOnError
 try:
     from django.core.mail import backends
+    from django.core.mail.backends import smtp
     EMAIL_BACKEND_SUPPORT = True
 except ImportError:
     # Django version < 1.2
@@ -46,6 +49,26 @@ class OtherErrorBackend(backends.base.BaseEmailBackend):
         raise Exception('Fake Error')
 
 
+class ConnectionErrorBackend(backends.base.BaseEmailBackend):
+    '''
+    An EmailBackend that always fails to connect, counting the messages it
+    was asked to send in ``attempts``
+    '''
+    attempts = 0
+
+    def send_messages(self, email_messages):
+        ConnectionErrorBackend.attempts += len(email_messages)
+        raise socket.error('Connection refused')
+
+
+class DisconnectingBackend(backends.base.BaseEmailBackend):
+    '''
+    An EmailBackend whose server always closes the connection while sending
+    '''
+    def send_messages(self, email_messages):
+        raise SMTPServerDisconnected('Connection unexpectedly closed')
+
+
 class DeferOnErrorBackend(backends.base.BaseEmailBackend):
     '''
     An EmailBackend that always raises a FakeMailerException
@@ -54,6 +77,40 @@ class DeferOnErrorBackend(backends.base.BaseEmailBackend):
     def send_messages(self, email_messages):
         raise DeferOnError('Defer this')
 
+class RefusingSMTP(SMTP):
+    """
+    A fake SMTP connection which refuses addresses starting with "refused"
+    and keeps the mails it is asked to send. Like smtplib, it raises
+    ``SMTPRecipientsRefused`` if every recipient is refused.
+
+    """
+    def sendmail(self, from_addr, to_addrs, msg):
+        refused = dict((addr, (550, 'No such user')) for addr in to_addrs
+                       if parseaddr(addr)[1].startswith('refused'))
+        if len(refused) == len(to_addrs):
+            raise SMTPRecipientsRefused(refused)
+        RefusingSMTPBackend.sent.append((from_addr, to_addrs, msg))
+        return refused
+
+    def quit(self):
+        pass
+
+
+class RefusingSMTPBackend(smtp.EmailBackend):
+    """
+    An SMTP EmailBackend which uses a ``RefusingSMTP`` connection, keeping
+    the mails sent in ``sent``.
+
+    """
+    sent = []
+
+    def open(self):
+        if self.connection:
+            return False
+        self.connection = RefusingSMTP()
+        return True
+
+
 class MailerTestCase(TestCase):
     """
     A base class for Django Mailer test cases which diverts emails to the test
@@ -0,0 +1,61 @@
+from django.test import TestCase
+
+from django_mailer import blacklist, settings
+from django_mailer.models import Blacklist
+
+
+class BlacklistIndexTest(TestCase):
+
+    def test_lookup(self):
+        Blacklist.objects.create(email='Foo@Example.com')
+        Blacklist.objects.create(email='*@spam.example.com')
+        index = blacklist.BlacklistIndex()
+        index.load()
+        self.assertTrue('foo@example.com' in index)
+        self.assertTrue('FOO@EXAMPLE.COM ' in index)
+        self.assertFalse('bar@example.com' in index)
+        self.assertTrue('anyone@spam.example.com' in index)
+        self.assertTrue('anyone@SPAM.example.com' in index)
+        self.assertFalse('anyone@ham.example.com' in index)
+
+    def test_refresh(self):
+        index = blacklist.BlacklistIndex()
+        index.refresh()
+        self.assertEqual(len(index), 0)
+        Blacklist.objects.create(email='foo@example.com')
+        index.refresh()
+        self.assertTrue('foo@example.com' in index)
+        # Removed addresses are dropped when the blacklist is reloaded.
+        Blacklist.objects.all().delete()
+        Blacklist.objects.create(email='bar@example.com')
+        index.refresh()
+        self.assertTrue('foo@example.com' in index)
+        old_reload = settings.BLACKLIST_RELOAD
+        settings.BLACKLIST_RELOAD = 0
+        try:
+            index.refresh()
+        finally:
+            settings.BLACKLIST_RELOAD = old_reload
+        self.assertFalse('foo@example.com' in index)
+        self.assertTrue('bar@example.com' in index)
+
+    def test_get_blacklist_queries(self):
+        """
+        Repeated lookups through get_blacklist only query the database once
+        it is time to check for new entries.
+        """
+        blacklist._invalidate(None)
+        blacklist.get_blacklist()
+        def lookups():
+            for i in range(10):
+                'foo@example.com' in blacklist.get_blacklist()
+        self.assertNumQueries(0, lookups)
+        # Entries added by this process are picked up straight away.
+        Blacklist.objects.create(email='foo@example.com')
+        self.assertTrue('foo@example.com' in blacklist.get_blacklist())
+        old_refresh = settings.BLACKLIST_REFRESH
+        settings.BLACKLIST_REFRESH = 0
+        try:
+            self.assertNumQueries(1, blacklist.get_blacklist)
+        finally:
+            settings.BLACKLIST_REFRESH = old_refresh
@@ -0,0 +1,82 @@
+from django.conf import settings as django_settings
+from django.test import TestCase
+
+from django_mailer import circuit, engine, send_mail
+from django_mailer.models import CircuitState, Log, QueuedMessage
+from django_mailer.tests.base import ConnectionErrorBackend
+
+import datetime
+import socket
+import threading
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.ConnectionErrorBackend'
+        ConnectionErrorBackend.attempts = 0
+        circuit.reset()
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        circuit.reset()
+
+    def test_breaker(self):
+        breaker = circuit.CircuitBreaker('test', threshold=2,
+                                         probe_interval=60)
+        breaker.record(socket.error())
+        breaker.record(None)
+        breaker.record(socket.error())
+        self.assertTrue(breaker.allow())
+        breaker.record(socket.error())
+        self.assertFalse(breaker.allow())
+        # Other workers see the circuit is open.
+        other = circuit.CircuitBreaker('test', threshold=2,
+                                       probe_interval=60)
+        other.refresh()
+        self.assertFalse(other.allow())
+        self.assertTrue(0 < other.wait_time() <= 60)
+
+        # Once the probe is due, only one worker gets to probe.
+        CircuitState.objects.update(
+            next_probe=datetime.datetime.now() - datetime.timedelta(1))
+        other.refresh()
+        self.assertEqual(other.state, circuit.HALF_OPEN)
+        breaker.refresh()
+        self.assertFalse(breaker.allow())
+
+        # A successful probe closes the circuit for everyone.
+        other.record(None)
+        self.assertEqual(other.state, circuit.CLOSED)
+        breaker.refresh()
+        self.assertTrue(breaker.allow())
+
+    def test_send_all(self):
+        """
+        send_all stops taking messages from the queue once the circuit is
+        tripped.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(10)])
+        engine.send_all(block_size=3)
+        self.assertEqual(ConnectionErrorBackend.attempts, 5)
+        self.assertEqual(Log.objects.count(), 5)
+        self.assertEqual(QueuedMessage.objects.non_deferred().count(), 5)
+        # Further runs don't try sending at all.
+        engine.send_all()
+        self.assertEqual(ConnectionErrorBackend.attempts, 5)
+
+    def test_send_all_open_leaves_no_threads(self):
+        """
+        send_all doesn't start any delivery threads while the circuit is open.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(10)])
+        engine.send_all(block_size=3)
+        threads = threading.active_count()
+        for i in range(3):
+            engine.send_all(concurrency=4)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(ConnectionErrorBackend.attempts, 5)
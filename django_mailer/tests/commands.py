@@ -2,9 +2,12 @@ from django.conf import settings as django_settings
 from django.core import mail
 from django.core.management import call_command
 
-from django_mailer import models, settings
+from django_mailer import archive, compression, models, settings
 from django_mailer.tests.base import MailerTestCase
 import datetime
+import os
+import shutil
+import tempfile
 
 
 class TestCommands(MailerTestCase):
@@ -30,9 +33,11 @@ class TestCommands(MailerTestCase):
         self.queue_message()
         self.queue_message()
         self.queue_message(subject='deferred')
+        # Deferred until retry_deferred is run.
         models.QueuedMessage.objects\
                     .filter(message__subject__startswith='deferred')\
-                    .update(deferred=datetime.datetime.now())
+                    .update(deferred=datetime.datetime.now(),
+                            next_attempt=None)
         queued_messages = models.QueuedMessage.objects.all()
         self.assertEqual(queued_messages.count(), 3)
         self.assertEqual(len(mail.outbox), 0)
@@ -85,4 +90,117 @@ class TestCommands(MailerTestCase):
         models.Message.objects.create(date_created=prev)
         call_command('cleanup_mail', days=30)
         self.assertEqual(models.Message.objects.count(), 1)
-        
+
+    def test_cleanup_mail_bodies(self):
+        """
+        The ``cleanup_mail`` command deletes message bodies which are no
+        longer used by any message.
+        """
+        prev = datetime.datetime.now() - datetime.timedelta(31)
+        old_body = models.MessageBody.objects.create(digest='old',
+            date_created=prev, last_used=prev)
+        shared_body = models.MessageBody.objects.create(digest='shared',
+            date_created=prev, last_used=prev)
+        models.Message.objects.create(body=old_body, date_created=prev)
+        models.Message.objects.create(body=shared_body, date_created=prev)
+        models.Message.objects.create(body=shared_body)
+        call_command('cleanup_mail', days=30)
+        self.assertEqual(models.Message.objects.count(), 1)
+        self.assertEqual(list(models.MessageBody.objects.all()),
+                         [shared_body])
+
+    def test_cleanup_mail_reused_body(self):
+        """
+        An old, unused message body which is being reused by a newly queued
+        message isn't deleted before the message is saved.
+        """
+        prev = datetime.datetime.now() - datetime.timedelta(31)
+        body = models.MessageBody.objects.get_for_content('reused')
+        models.MessageBody.objects.filter(pk=body.pk).update(
+            date_created=prev, last_used=prev)
+        self.assertEqual(
+            models.MessageBody.objects.get_for_content('reused'), body)
+        call_command('cleanup_mail', days=30, verbosity='0')
+        self.assertEqual(list(models.MessageBody.objects.all()), [body])
+
+    def test_cleanup_mail_batches(self):
+        """
+        The ``cleanup_mail`` command deletes mails a batch at a time, adding
+        their logs to the daily log summaries first, and can stop after a
+        time limit.
+        """
+        prev = datetime.datetime.now() - datetime.timedelta(31)
+        for i in range(3):
+            message = models.Message.objects.create(date_created=prev)
+            models.Log.objects.create(message=message, result=i % 2,
+                                      date=prev, log_message='')
+        models.QueuedMessage.objects.create(message=message)
+        call_command('cleanup_mail', days=30, batch_size=1, max_time=0.001,
+                     verbosity='0')
+        self.assertEqual(models.Message.objects.count(), 2)
+        call_command('cleanup_mail', days=30, batch_size=2, verbosity='0')
+        self.assertEqual(models.Message.objects.count(), 0)
+        self.assertEqual(models.Log.objects.count(), 0)
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+        self.assertEqual(
+            list(models.LogRollup.objects.values_list('date', 'result',
+                                                      'count')),
+            [(prev.date(), 0, 2), (prev.date(), 1, 1)])
+
+    def test_archive_mail(self):
+        """
+        The ``archive_mail`` command moves old mails and their logs into
+        archive files, which can be read back to resend them.
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.queue_message(subject='old', message=u'Caf\xe9')
+        self.queue_message(subject='new')
+        prev = datetime.datetime.now() - datetime.timedelta(31)
+        old = models.Message.objects.get(subject='old')
+        models.Message.objects.filter(pk=old.pk).update(date_created=prev)
+        models.Log.objects.create(message=old, result=0, log_message='Sent')
+        call_command('archive_mail', days=30, directory=directory,
+                     verbosity='0')
+        self.assertEqual(list(models.Message.objects.values_list('subject',
+                                                                 flat=True)),
+                         ['new'])
+        self.assertEqual(models.Log.objects.count(), 0)
+        self.assertEqual(archive.archive_files(directory, end=prev.date()),
+                         [os.path.join(directory, 'mail-%s.jsonl.gz' %
+                                       prev.date().isoformat())])
+        records = list(archive.read_archive(directory))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['logs'][0]['log_message'], 'Sent')
+        email_message = archive.email_message(records[0])
+        self.assertEqual(email_message.subject, 'old')
+        self.assertEqual(email_message.body, u'Caf\xe9')
+        self.assertEqual(email_message.to, ['recipient@djangomailer'])
+
+    def test_compress_mail(self):
+        """
+        The ``compress_mail`` command compresses the content of existing
+        mails and logs (and can decompress it again).
+        """
+        text = 'Lorem ipsum dolor sit amet. ' * 100
+        self.queue_message(message=text)
+        mime_body = models.MessageBody.objects.get_for_content(mime=text)
+        message = models.Message.objects.create(message=text)
+        log = models.Log.objects.create(message=message, result=0,
+                                        log_message=text)
+        call_command('compress_mail', verbosity='0', batch_size=1)
+        body = models.MessageBody.objects.exclude(pk=mime_body.pk).get()
+        self.assertTrue(compression.is_compressed(body.message))
+        mime_body = models.MessageBody.objects.get(pk=mime_body.pk)
+        self.assertTrue(compression.is_compressed(mime_body.mime))
+        message = models.Message.objects.get(pk=message.pk)
+        self.assertTrue(compression.is_compressed(message.message))
+        self.assertEqual(message.get_content()[0], text)
+        log = models.Log.objects.get(pk=log.pk)
+        self.assertTrue(compression.is_compressed(log.log_message))
+        self.assertEqual(log.get_log_message(), text)
+        call_command('compress_mail', verbosity='0', decompress=True)
+        self.assertEqual(models.MessageBody.objects.get(pk=body.pk).message,
+                         text)
+        self.assertEqual(models.MessageBody.objects.get(pk=mime_body.pk).mime,
+                         text)
@@ -1,15 +1,25 @@
 from django.core import mail
+from django.core.mail import get_connection
 from django.conf import settings as django_settings
 from django.test import TestCase
-from django_mailer import (constants, engine, settings, send_mail,
-                           send_html_mail)
+from django_mailer import (circuit, constants, engine, settings, send_mail,
+                           send_html_mail, queue_email_message)
 from django_mailer.engine import send_queued_message
+from django_mailer.tests.base import RefusingSMTPBackend
 from django_mailer.tests.exceptions import DeferOnError
-from django_mailer.models import Blacklist, Log, QueuedMessage
-from django_mailer.lockfile import FileLock
+from django_mailer.models import Blacklist, DeadLetter, Log, QueuedMessage
+from django_mailer.locks import get_lock
+from django_mailer.logwriter import SyncLogWriter
+from django_mailer.pool import InlineDelivery
+from django_mailer import notify
 
 from StringIO import StringIO
+import datetime
 import logging
+import shutil
+import socket
+import tempfile
+import threading
 import time
 
 
@@ -39,8 +49,7 @@ class LockTest(TestCase):
         # that the lock file has already been acquired by another process.
         self.original_lock_path = engine.LOCK_PATH
         engine.LOCK_PATH += '.mailer-test'
-        self.lock = FileLock(engine.LOCK_PATH)
-        self.lock.unique_name += '.mailer_test'
+        self.lock = get_lock(engine.LOCK_PATH)
         self.lock.acquire(0)
 
     def tearDown(self):
@@ -188,6 +197,379 @@ class EngineTest(TestCase):
                   priority=constants.PRIORITIES['now'])
         self.assertEqual(Log.objects.count(), 2)
 
+    def test_result_buffer(self):
+        """
+        Results collected in a ResultBuffer are only written to the database
+        when it is flushed.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+        results = engine.ResultBuffer(log_writer=SyncLogWriter())
+        for queued_message in QueuedMessage.objects.all():
+            engine.send_queued_message(queued_message, self.connection,
+                                       results=results)
+        self.assertEqual(len(self.mail.outbox), 3)
+        self.assertEqual(QueuedMessage.objects.count(), 3)
+        self.assertEqual(Log.objects.count(), 0)
+        results.flush()
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+        self.assertEqual(Log.objects.count(), 3)
+
+    def test_leased_messages(self):
+        """
+        Messages leased by another worker are not sent until the lease has
+        expired.
+        """
+        send_mail('Subject', 'Body', 'from@example.com', ['to1@example.com'])
+        send_mail('Subject', 'Body', 'from@example.com', ['to2@example.com'])
+        claimed = QueuedMessage.objects.claim('other-worker', limit=1)
+        self.assertEqual(len(claimed), 1)
+        # A second claim skips the already leased message.
+        self.assertEqual(
+            len(QueuedMessage.objects.claim('another-worker', limit=1)), 1)
+        QueuedMessage.objects.release_leases('another-worker')
+
+        engine.send_all(use_lock=False)
+        self.assertEqual(len(self.mail.outbox), 1)
+        self.assertEqual(QueuedMessage.objects.count(), 1)
+
+        # Once the lease expires, the message is picked up again.
+        QueuedMessage.objects.update(lease_expires=datetime.datetime.now() -
+                                     datetime.timedelta(seconds=1))
+        engine.send_all(use_lock=False)
+        self.assertEqual(len(self.mail.outbox), 2)
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+
+    def test_leases_renewed(self):
+        """
+        Leases on messages still held by a worker are renewed every time it
+        claims a new block, so other workers can't pick them up.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com'])
+        blocks = engine._message_blocks(1, 'worker')
+        blocks.next()
+        QueuedMessage.objects.update(lease_expires=datetime.datetime.now() -
+                                     datetime.timedelta(seconds=1))
+        blocks.next()
+        self.assertEqual(QueuedMessage.objects.unleased().count(), 0)
+        self.assertEqual(len(QueuedMessage.objects.claim('other-worker')), 0)
+
+    def test_leases_renewed_while_sending(self):
+        """
+        Leases on the rest of a block are renewed while a slow delivery is
+        being made, so no other worker claims them in the meantime.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(4)])
+        old_lease_seconds = settings.LEASE_SECONDS
+        settings.LEASE_SECONDS = 0.4
+        claimed = []
+        original_deliver = engine._deliver
+        def deliver(message, connection):
+            time.sleep(0.2)
+            claimed.extend(QueuedMessage.objects.claim('other-worker'))
+            return original_deliver(message, connection)
+        engine._deliver = deliver
+        try:
+            engine.send_all(use_lock=False)
+        finally:
+            engine._deliver = original_deliver
+            settings.LEASE_SECONDS = old_lease_seconds
+        self.assertEqual(claimed, [])
+        self.assertEqual(len(self.mail.outbox), 4)
+
+    def test_message_queue_priority(self):
+        """
+        Newly queued high priority messages jump ahead of the rest of the
+        queue while it is being iterated.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+        queue = engine._message_queue(1, 'worker')
+        message = queue.next()
+        self.assertEqual(message.message.to_address, 'to1@example.com')
+        message.delete()
+        send_mail('Subject', 'Body', 'from@example.com', ['high@example.com'],
+                  priority=constants.PRIORITY_HIGH)
+        message = queue.next()
+        self.assertEqual(message.message.to_address, 'high@example.com')
+        message.delete()
+        # Messages which aren't deleted or deferred aren't yielded again.
+        message = queue.next()
+        self.assertEqual(message.message.to_address, 'to2@example.com')
+        message = queue.next()
+        self.assertEqual(message.message.to_address, 'to3@example.com')
+        self.assertRaises(StopIteration, queue.next)
+
+    def test_message_blocks_priorities(self):
+        """
+        Blocks are claimed in order of priority, then of when the messages are
+        due, running on into the lower priorities.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['low1@example.com', 'low2@example.com'],
+                  priority=constants.PRIORITY_LOW)
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+        blocks = [[message.message.to_address for message in block]
+                  for block in engine._message_blocks(2, 'worker')]
+        self.assertEqual(blocks, [['to1@example.com', 'to2@example.com'],
+                                  ['to3@example.com', 'low1@example.com'],
+                                  ['low2@example.com']])
+
+    def test_no_block_size(self):
+        """
+        Without a block size, the queue is still claimed and its results
+        written back a block at a time.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(5)])
+        old_block_size = engine.DEFAULT_BLOCK_SIZE
+        engine.DEFAULT_BLOCK_SIZE = 2
+        flushes = []
+        original_flush = engine.ResultBuffer.flush
+        def flush(buffer):
+            if len(buffer):
+                flushes.append(len(buffer))
+            return original_flush(buffer)
+        engine.ResultBuffer.flush = flush
+        try:
+            self.assertEqual([len(block) for block in
+                              engine._message_blocks(0, 'worker')],
+                             [2, 2, 1])
+            QueuedMessage.objects.release_leases('worker')
+            engine.send_all(block_size=0)
+        finally:
+            engine.DEFAULT_BLOCK_SIZE = old_block_size
+            engine.ResultBuffer.flush = original_flush
+        self.assertEqual(flushes, [2, 2, 1])
+        self.assertEqual(len(self.mail.outbox), 5)
+
+    def test_claim_prefetches_bodies(self):
+        """
+        Claiming a block of messages fetches their shared bodies up front.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(5)])
+        block = list(QueuedMessage.objects.claim('worker'))
+        self.assertEqual(len(block), 5)
+        def build():
+            for queued_message in block:
+                queued_message.message.email_message()
+        self.assertNumQueries(0, build)
+
+    def test_store_mime(self):
+        """
+        Fully rendered messages are sent as they are, keeping cc, bcc,
+        attachments and extra headers.
+        """
+        msg = self.mail.EmailMessage('Subject', 'Body', 'from@example.com',
+            ['to@example.com'], bcc=['bcc@example.com'],
+            cc=['cc@example.com'], headers={'Reply-To': 'reply@example.com'})
+        msg.attach('file.txt', 'attached', 'text/plain')
+        self.assertEqual(queue_email_message(msg, store_mime=True), 3)
+        queued_message = QueuedMessage.objects.get(
+            message__to_address='bcc@example.com')
+        self.assertEqual(queued_message.message.get_content(),
+                         (u'Body', u''))
+        engine.send_all()
+        # The recipients share the same content, so are sent it together.
+        self.assertEqual(len(self.mail.outbox), 1)
+        self.assertEqual(sorted(self.mail.outbox[0].recipients()),
+                         ['bcc@example.com', 'cc@example.com',
+                          'to@example.com'])
+        self.assertEqual(Log.objects.count(), 3)
+        data = self.mail.outbox[0].message().as_string()
+        self.assertTrue('Reply-To: reply@example.com' in data)
+        self.assertTrue('Cc: cc@example.com' in data)
+        self.assertTrue('file.txt' in data)
+        self.assertFalse('bcc@example.com' in data)
+
+    def test_grouped_recipients(self):
+        """
+        Recipients of the same fully rendered message are sent it in one SMTP
+        transaction (of at most MAILER_MAX_RECIPIENTS recipients), with any
+        refused recipients recorded separately.
+        """
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.RefusingSMTPBackend'
+        RefusingSMTPBackend.sent = []
+        old_max_recipients = settings.MAX_RECIPIENTS
+        settings.MAX_RECIPIENTS = 3
+        try:
+            recipients = ['to%s@example.com' % i for i in range(4)]
+            msg = self.mail.EmailMessage('Subject', 'Body',
+                'from@example.com', recipients + ['refused@example.com'])
+            queue_email_message(msg, store_mime=True)
+            engine.send_all()
+        finally:
+            settings.MAX_RECIPIENTS = old_max_recipients
+        self.assertEqual(sorted(len(sent[1]) for sent in
+                                RefusingSMTPBackend.sent), [2, 3])
+        self.assertEqual(QueuedMessage.objects.get().message.to_address,
+                         'refused@example.com')
+        self.assertEqual(Log.objects.filter(
+            result=constants.RESULT_SENT).count(), 4)
+        log = Log.objects.get(result=constants.RESULT_FAILED)
+        self.assertEqual(log.message.to_address, 'refused@example.com')
+
+    def test_grouped_recipients_all_refused(self):
+        """
+        If every recipient of a group is refused, none of the messages are
+        recorded as sent, even when smtplib was given differently encoded
+        addresses.
+        """
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.RefusingSMTPBackend'
+        RefusingSMTPBackend.sent = []
+        recipients = [u'J\xf6rg <refused1@example.com>',
+                      u'Ren\xe9e <refused2@example.com>']
+        msg = self.mail.EmailMessage('Subject', 'Body', 'from@example.com',
+                                     recipients)
+        queue_email_message(msg, store_mime=True)
+        engine.send_all()
+        self.assertEqual(RefusingSMTPBackend.sent, [])
+        self.assertEqual(QueuedMessage.objects.count(), 2)
+        self.assertEqual(Log.objects.filter(
+            result=constants.RESULT_SENT).count(), 0)
+        self.assertEqual(Log.objects.filter(
+            result=constants.RESULT_FAILED).count(), 2)
+        for log in Log.objects.all():
+            self.assertTrue('No such user' in log.get_log_message())
+
+    def test_concurrency(self):
+        """
+        Messages can be delivered by several threads at once.
+        """
+        Blacklist.objects.create(email='foo@bar.com')
+        recipients = ['to%s@example.com' % i for i in range(10)]
+        send_mail('Subject', 'Body', 'from@example.com',
+                  recipients + ['foo@bar.com'])
+        engine.send_all(block_size=4, use_lock=False, concurrency=3)
+        self.assertEqual(len(self.mail.outbox), 10)
+        self.assertEqual(sorted(m.to[0] for m in self.mail.outbox),
+                         sorted(recipients))
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+        self.assertEqual(Log.objects.count(), 10)
+
+    def test_named_queues(self):
+        """
+        Messages can be put in named queues, which are sent separately.
+        """
+        msg = self.mail.EmailMessage('Subject', 'Body', 'from@example.com',
+            ['to1@example.com'],
+            headers={constants.QUEUE_HEADER: 'transactional'})
+        queue_email_message(msg)
+        send_mail('Subject', 'Body', 'from@example.com', ['to2@example.com'],
+                  queue='newsletter')
+        send_mail('Subject', 'Body', 'from@example.com', ['to3@example.com'])
+        self.assertEqual(sorted(QueuedMessage.objects.values_list('queue',
+                                                                  flat=True)),
+                         ['default', 'newsletter', 'transactional'])
+        self.assertFalse(constants.QUEUE_HEADER in msg.extra_headers)
+
+        engine.send_all(queue='transactional')
+        self.assertEqual([m.to[0] for m in self.mail.outbox],
+                         ['to1@example.com'])
+        engine.send_all()
+        self.assertEqual(len(self.mail.outbox), 3)
+
+        self.assertNotEqual(engine._lock_path('transactional'),
+                            engine._lock_path())
+
+    def test_send_at(self):
+        """
+        Messages scheduled for later aren't sent before they are due.
+        """
+        send_at = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        send_mail('Subject', 'Body', 'from@example.com', ['to1@example.com'],
+                  send_at=send_at)
+        queued_message = QueuedMessage.objects.get()
+        self.assertEqual(queued_message.date_queued, send_at)
+        self.assertEqual(queued_message.next_attempt, send_at)
+        engine.send_all()
+        self.assertEqual(len(self.mail.outbox), 0)
+        self.assertTrue(290 < engine._next_due() <= 300)
+        self.assertTrue(290 < engine._next_due(queue='default') <= 300)
+        self.assertEqual(engine._next_due(queue='other'), None)
+
+        due = datetime.datetime.now() - datetime.timedelta(1)
+        QueuedMessage.objects.update(date_queued=due, next_attempt=due)
+        self.assertEqual(engine._next_due(), None)
+        engine.send_all()
+        self.assertEqual(len(self.mail.outbox), 1)
+
+    def test_persistent_delivery(self):
+        """
+        A delivery passed to send_all keeps its connection open between runs,
+        and nothing more is sent once the stop event is set.
+        """
+        opened = []
+
+        def connection_factory():
+            connection = get_connection()
+            opened.append(connection)
+            return connection
+
+        delivery = InlineDelivery(connection_factory, engine._deliver)
+        stop = threading.Event()
+        try:
+            send_mail('Subject', 'Body', 'from@example.com',
+                      ['to1@example.com'])
+            engine.send_all(delivery=delivery, stop=stop)
+            send_mail('Subject', 'Body', 'from@example.com',
+                      ['to2@example.com'])
+            engine.send_all(delivery=delivery, stop=stop)
+            self.assertEqual(len(self.mail.outbox), 2)
+            self.assertEqual(len(opened), 1)
+
+            stop.set()
+            send_mail('Subject', 'Body', 'from@example.com',
+                      ['to3@example.com'])
+            engine.send_all(delivery=delivery, stop=stop)
+            self.assertEqual(len(self.mail.outbox), 2)
+            self.assertEqual(QueuedMessage.objects.count(), 1)
+        finally:
+            delivery.close()
+
+    def test_send_loop_backs_off(self):
+        """
+        The sending loop waits rather than spinning while the due mail is
+        leased by another worker, or another process holds the lock.
+        """
+        send_mail('Subject', 'Body', 'from@example.com', ['to1@example.com'])
+        QueuedMessage.objects.claim('other-worker')
+        calls = []
+        original_send_all = engine.send_all
+        def send_all(*args, **kwargs):
+            calls.append(1)
+            return original_send_all(*args, **kwargs)
+
+        def run_loop():
+            stop = threading.Event()
+            timer = threading.Timer(0.5, stop.set)
+            timer.start()
+            try:
+                engine.send_loop(empty_queue_sleep=0.1, stop=stop)
+            finally:
+                timer.cancel()
+
+        engine.send_all = send_all
+        lock = get_lock(engine._lock_path())
+        try:
+            run_loop()
+            self.assertEqual(calls, [])
+            QueuedMessage.objects.release_leases('other-worker')
+            lock.acquire(0)
+            run_loop()
+            self.assertTrue(0 < len(calls) <= 6)
+            self.assertEqual(len(self.mail.outbox), 0)
+        finally:
+            engine.send_all = original_send_all
+            if lock.i_am_locking():
+                lock.release()
+
 
 class ErrorHandlingTest(TestCase):
 
@@ -230,6 +612,132 @@ class ErrorHandlingTest(TestCase):
         queued_message = QueuedMessage.objects.latest('id')
         engine.send_queued_message(queued_message)
         self.assertEqual(queued_message.deferred, None)
+
+    def test_failed_messages_tried_once(self):
+        """
+        Messages which fail without being deferred are only tried once per
+        run.
+        """
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.OtherErrorBackend'
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com', 'to3@example.com'])
+        engine.send_all(block_size=1)
+        self.assertEqual(Log.objects.count(), 3)
+        self.assertEqual(QueuedMessage.objects.non_deferred().count(), 3)
+
+    def test_dead_letters(self):
+        """
+        Messages which keep failing are moved out of the queue to the dead
+        letters, from where they can be requeued.
+        """
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.OtherErrorBackend'
+        send_mail('Subject', 'Body', 'from@example.com', ['to1@example.com'])
+        for i in range(settings.DEAD_LETTER_FAILURES):
+            self.assertEqual(QueuedMessage.objects.count(), 1)
+            engine.send_all()
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+        dead_letter = DeadLetter.objects.get()
+        self.assertEqual(dead_letter.failures, settings.DEAD_LETTER_FAILURES)
+        self.assertTrue(dead_letter.reason)
+        self.assertEqual(DeadLetter.objects.requeue(), 1)
+        self.assertEqual(DeadLetter.objects.count(), 0)
+        self.assertEqual(QueuedMessage.objects.get().failures, 0)
+
+        # Deferred messages are moved once they have been retried too often.
+        old_retries = settings.DEAD_LETTER_RETRIES
+        settings.DEAD_LETTER_RETRIES = 1
+        try:
+            django_settings.EMAIL_BACKEND = \
+                'django_mailer.tests.base.RecipientErrorBackend'
+            engine.send_all()
+            QueuedMessage.objects.update(next_attempt=datetime.datetime.now())
+            engine.send_all()
+        finally:
+            settings.DEAD_LETTER_RETRIES = old_retries
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+        self.assertEqual(DeadLetter.objects.get().retries, 1)
+
+    def test_disconnections_not_dead_letters(self):
+        """
+        Messages which fail because the connection to the backend was lost
+        aren't counted towards becoming dead letters.
+        """
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.DisconnectingBackend'
+        send_mail('Subject', 'Body', 'from@example.com', ['to1@example.com'])
+        circuit.reset()
+        try:
+            for i in range(settings.DEAD_LETTER_FAILURES):
+                engine.send_all()
+        finally:
+            circuit.reset()
+        self.assertEqual(DeadLetter.objects.count(), 0)
+        self.assertEqual(QueuedMessage.objects.get().failures, 0)
+        self.assertEqual(Log.objects.filter(
+            result=constants.RESULT_FAILED).count(),
+            settings.DEAD_LETTER_FAILURES)
+
+    def test_retry_backoff(self):
+        """
+        Deferred messages are retried once their next attempt is due, with
+        the delay growing after each failed retry.
+        """
+        send_mail('Subject', 'Body', 'from@example.com', ['to1@example.com'])
+        start = datetime.datetime.now()
+        engine.send_all()
+        queued_message = QueuedMessage.objects.get()
+        delay = datetime.timedelta(seconds=settings.RETRY_DELAY)
+        self.assertEqual(queued_message.retries, 0)
+        self.assertTrue(start + delay / 2 <= queued_message.next_attempt)
+        self.assertTrue(queued_message.next_attempt <=
+                        datetime.datetime.now() + delay)
+        self.assertEqual(QueuedMessage.objects.due().count(), 0)
+
+        # Once the next attempt is due, the message is tried again.
+        QueuedMessage.objects.update(next_attempt=start)
+        self.assertEqual(QueuedMessage.objects.due().count(), 1)
+        start = datetime.datetime.now()
+        engine.send_all()
+        queued_message = QueuedMessage.objects.get()
+        self.assertEqual(queued_message.retries, 1)
+        self.assertTrue(start + delay <= queued_message.next_attempt)
+        self.assertEqual(Log.objects.count(), 2)
+
+        # Past MAILER_MAX_RETRIES, the message waits for retry_deferred.
+        old_max_retries = settings.MAX_RETRIES
+        settings.MAX_RETRIES = 2
+        try:
+            QueuedMessage.objects.update(next_attempt=start)
+            engine.send_all()
+        finally:
+            settings.MAX_RETRIES = old_max_retries
+        queued_message = QueuedMessage.objects.get()
+        self.assertEqual(queued_message.retries, 2)
+        self.assertEqual(queued_message.next_attempt, None)
+
+    def test_concurrent_errors(self):
+        """
+        Failures while delivering with several threads are deferred and
+        logged.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(20)])
+        engine.send_all(use_lock=False, concurrency=2)
+        self.assertEqual(QueuedMessage.objects.non_deferred().count(), 0)
+        self.assertEqual(QueuedMessage.objects.deferred().count(), 20)
+        self.assertEqual(Log.objects.filter(
+            result=constants.RESULT_FAILED).count(), 20)
+        # Messages deferred together are still spread out, rather than all
+        # being retried at the same moment.
+        self.assertTrue(QueuedMessage.objects.values('next_attempt')
+                        .distinct().count() > 1)
+        delay = datetime.timedelta(seconds=settings.RETRY_DELAY)
+        for queued_message in QueuedMessage.objects.all():
+            self.assertTrue(queued_message.deferred + delay / 2 <=
+                            queued_message.next_attempt <=
+                            queued_message.deferred + delay)
     
     def test_defer_on_errors_setting(self):
         """
@@ -247,4 +755,82 @@ class ErrorHandlingTest(TestCase):
         engine.send_queued_message(queued_message)
         queued_message = QueuedMessage.objects.latest('id')
         self.assertNotEqual(queued_message.deferred, None)
-        settings.DEFER_ON_ERRORS = old_errors
\ No newline at end of file
+        settings.DEFER_ON_ERRORS = old_errors
+
+
+class NotifyTest(TestCase):
+    """
+    Tests for waking up a waiting sender when mail is queued.
+    """
+
+    def setUp(self):
+        self.old_socket_dir = settings.NOTIFY_SOCKET_DIR
+        settings.NOTIFY_SOCKET_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(settings.NOTIFY_SOCKET_DIR)
+        settings.NOTIFY_SOCKET_DIR = self.old_socket_dir
+
+    def test_socket_notify(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            return
+        listener = notify.SocketListener()
+        try:
+            self.assertFalse(listener.wait(0))
+            send_mail('Subject', 'Body', 'from@example.com',
+                      ['to1@example.com', 'to2@example.com'])
+            self.assertTrue(listener.wait(1))
+            self.assertFalse(listener.wait(0))
+        finally:
+            listener.close()
+        # Notifying with nobody listening does nothing.
+        notify.notify()
+
+    def test_notified_recheck(self):
+        """
+        After a notification, the queue is checked again several times while
+        the new mail isn't visible yet.
+        """
+        class Listener(object):
+            notified = False
+
+            def wait(self, timeout):
+                if not self.notified:
+                    self.notified = True
+                    return True
+                time.sleep(timeout)
+                return False
+
+            def close(self):
+                pass
+
+        start = time.time()
+        stop = threading.Event()
+        timer = threading.Timer(5, stop.set)
+        calls = []
+        original = (notify.get_listener, engine._queue_has_mail,
+                    engine.send_all)
+        # The mail only becomes visible after a second.
+        notify.get_listener = lambda: Listener()
+        engine._queue_has_mail = lambda queue: time.time() - start > 1
+        def send_all(*args, **kwargs):
+            calls.append(time.time() - start)
+            stop.set()
+            return 1
+        engine.send_all = send_all
+        timer.start()
+        try:
+            engine.send_loop(empty_queue_sleep=30, stop=stop)
+        finally:
+            timer.cancel()
+            (notify.get_listener, engine._queue_has_mail,
+             engine.send_all) = original
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(calls[0] < 2.5)
+
+    def test_connection_params(self):
+        params = notify.connection_params({
+            'NAME': 'mail', 'USER': 'mailer', 'PASSWORD': '', 'HOST': '',
+            'PORT': '', 'OPTIONS': {'autocommit': True, 'sslmode': 'require'}})
+        self.assertEqual(params, {'database': 'mail', 'user': 'mailer',
+                                  'sslmode': 'require'})
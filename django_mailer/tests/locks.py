@@ -0,0 +1,138 @@
+import datetime
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings as django_settings
+from django.core import mail
+from django.test import TestCase
+
+from django_mailer import engine, locks, ratelimit, send_mail, settings
+from django_mailer.lockfile import AlreadyLocked
+from django_mailer.models import QueuedMessage, SendLock
+
+
+def _dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+class LockBackendTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'send_mail')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_flock(self):
+        """
+        An flock lock is held until it is released, recording its holder.
+        """
+        lock = locks.FlockLock(self.path)
+        other = locks.FlockLock(self.path)
+        lock.acquire(0)
+        self.assertRaises(AlreadyLocked, other.acquire, 0)
+        self.assertEqual(other.owner_info()['owner'], lock.owner)
+        lock.release()
+        self.assertEqual(other.owner_info(), None)
+        other.acquire(0)
+        other.release()
+
+    def test_file_lock_stale(self):
+        """
+        A file lock whose holder has died, or whose heartbeat is too old, is
+        broken.
+        """
+        lock = locks.FileLock(self.path)
+        other = locks.FileLock(self.path)
+        # Emulate the other lock being taken out by another process.
+        other.lock.unique_name += '.other'
+        lock.acquire(0)
+        self.assertRaises(AlreadyLocked, other.acquire, 0)
+        lock.pid = _dead_pid()
+        lock.last_heartbeat = 0
+        self.assertTrue(lock.heartbeat())
+        other.acquire(0)
+        lock.last_heartbeat = 0
+        self.assertFalse(lock.heartbeat())
+        # Without any details of its holder, the lock file's age is used.
+        os.unlink(other.owner_file)
+        self.assertRaises(AlreadyLocked, lock.acquire, 0)
+        os.utime(other.lock.lock_file, (0, 0))
+        lock.acquire(0)
+        lock.release()
+
+    def test_database_lock_stale(self):
+        """
+        A database lock is taken over once its heartbeat is too old, and the
+        previous holder finds out at its next heartbeat.
+        """
+        lock = locks.DatabaseLock(self.path)
+        other = locks.DatabaseLock(self.path)
+        lock.acquire(0)
+        self.assertRaises(AlreadyLocked, other.acquire, 0)
+        self.assertEqual(other.owner_info()['owner'], lock.owner)
+        SendLock.objects.update(
+            heartbeat=datetime.datetime.now() - datetime.timedelta(hours=1))
+        other.acquire(0)
+        lock.last_heartbeat = 0
+        self.assertFalse(lock.heartbeat())
+        self.assertFalse(lock.i_am_locking())
+        other.release()
+        self.assertEqual(SendLock.objects.get().owner, '')
+        lock.acquire(0)
+        lock.release()
+
+
+class LockedSendTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'django.core.mail.backends.locmem.EmailBackend'
+        self.old_lock_backend = settings.LOCK_BACKEND
+        settings.LOCK_BACKEND = 'django_mailer.locks.DatabaseLock'
+        self.old_stale_after = settings.LOCK_STALE_AFTER
+        settings.LOCK_STALE_AFTER = 0.5
+        self.old_limits = settings.RATE_LIMITS
+        settings.RATE_LIMITS = {'slow.example.com': {'rate': 4, 'burst': 1}}
+        ratelimit.reset()
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        settings.LOCK_BACKEND = self.old_lock_backend
+        settings.LOCK_STALE_AFTER = self.old_stale_after
+        settings.RATE_LIMITS = self.old_limits
+        ratelimit.reset()
+
+    def test_heartbeat_while_rate_limited(self):
+        """
+        The lock's heartbeat is kept up while a block is held back by a rate
+        limit, so another sender doesn't break it.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@slow.example.com' % i for i in range(4)])
+        broken = []
+        original_record = engine._record_delivery
+        def record(*args, **kwargs):
+            other = locks.get_lock(engine._lock_path())
+            try:
+                other.acquire(0)
+            except AlreadyLocked:
+                pass
+            else:
+                broken.append(other)
+                other.release()
+            return original_record(*args, **kwargs)
+        engine._record_delivery = record
+        try:
+            engine.send_all()
+        finally:
+            engine._record_delivery = original_record
+        self.assertEqual(broken, [])
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(QueuedMessage.objects.count(), 0)
@@ -0,0 +1,60 @@
+from django.conf import settings as django_settings
+from django.test import TestCase
+
+from django_mailer import engine, logwriter, send_mail
+from django_mailer.models import Log, QueuedMessage
+
+
+class LogWriterTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'django.core.mail.backends.locmem.EmailBackend'
+        logwriter.reset()
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        logwriter.reset()
+
+    def send(self, results, count):
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(count)])
+        for queued_message in QueuedMessage.objects.all():
+            engine.send_queued_message(queued_message, results=results)
+        results.flush()
+
+    def test_buffered(self):
+        """
+        Buffered logs are written once enough of them are waiting.
+        """
+        writer = logwriter.BufferedLogWriter(size=3, interval=60)
+        results = engine.ResultBuffer(log_writer=writer)
+        self.send(results, 2)
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+        self.assertEqual(Log.objects.count(), 0)
+        self.assertEqual(len(writer), 2)
+        self.send(results, 1)
+        self.assertEqual(Log.objects.count(), 3)
+        self.assertEqual(len(writer), 0)
+
+    def test_close(self):
+        """
+        Closing a writer flushing in the background writes the logs left in
+        its buffer.
+        """
+        writer = logwriter.BufferedLogWriter(size=10, interval=60)
+        writer.start()
+        self.send(engine.ResultBuffer(log_writer=writer), 2)
+        self.assertEqual(Log.objects.count(), 0)
+        writer.close()
+        self.assertEqual(Log.objects.count(), 2)
+
+    def test_send_all(self):
+        """
+        Logs buffered while sending are written before send_all returns.
+        """
+        send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        engine.send_all()
+        self.assertEqual(Log.objects.count(), 1)
+        self.assertFalse(len(logwriter.get_log_writer()))
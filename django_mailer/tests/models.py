@@ -1,9 +1,15 @@
+import datetime
+
 from django.core import mail
 from django.core.mail import EmailMessage, EmailMultiAlternatives
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 
-from django_mailer import constants, send_mail, send_html_mail
-from django_mailer.models import Message, QueuedMessage
+from django_mailer import (compression, constants, settings, send_mail,
+                           send_html_mail, queue_email_messages)
+from django_mailer.managers import create_with_pks
+from django_mailer.models import (Blacklist, Message, MessageBody,
+                                  QueuedMessage)
 
 class MailerModelTest(TestCase):
     
@@ -35,16 +41,52 @@ class MailerModelTest(TestCase):
         send_mail(subject, content, from_address, to_addresses)
         message = Message.objects.get(pk=1)
         self.assertEqual(message.subject, subject)
-        self.assertEqual(message.message, content)
+        self.assertEqual(message.get_content()[0], content)
         self.assertEqual(message.from_address, from_address)
         self.assertEqual(message.to_address, to_addresses[0])
         message = Message.objects.get(pk=2)
         self.assertEqual(message.subject, subject)
-        self.assertEqual(message.message, content)
+        self.assertEqual(message.get_content()[0], content)
         self.assertEqual(message.from_address, from_address)
         self.assertEqual(message.to_address, to_addresses[1])
 
     
+    def test_shared_body(self):
+        """
+        Messages with identical content share a single ``MessageBody``.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com'])
+        send_mail('Other subject', 'Body', 'from@example.com',
+                  ['to3@example.com'])
+        send_html_mail('Subject', 'Body', '<p>Body</p>', 'from@example.com',
+                       ['to1@example.com'])
+        self.assertEqual(Message.objects.count(), 4)
+        self.assertEqual(MessageBody.objects.count(), 2)
+        for message in Message.objects.all():
+            self.assertEqual(message.email_message().body, 'Body')
+
+    def test_compression(self):
+        """
+        Message content is stored compressed if the ``MAILER_COMPRESS``
+        setting is enabled.
+        """
+        html = '<p>%s</p>' % ('Lorem ipsum dolor sit amet. ' * 100)
+        old_compress = settings.COMPRESS
+        settings.COMPRESS = True
+        try:
+            send_html_mail('Subject', 'Body', html, 'from@example.com',
+                           ['to1@example.com'])
+        finally:
+            settings.COMPRESS = old_compress
+        body = MessageBody.objects.get()
+        self.assertTrue(compression.is_compressed(body.html_message))
+        self.assertTrue(len(body.html_message) < len(html))
+        # Short content which doesn't compress is stored as it is.
+        self.assertEqual(body.message, 'Body')
+        message = Message.objects.get()
+        self.assertEqual(message.email_message().alternatives[0][0], html)
+
     def test_send_html_mail(self):
         """
         Test to make sure that send__html_mail creates the right ``Message``
@@ -58,8 +100,8 @@ class MailerModelTest(TestCase):
         send_html_mail(subject, content, html_content, from_address, to_address)
         message = Message.objects.get(pk=1)
         self.assertEqual(message.subject, subject)
-        self.assertEqual(message.message, content)
-        self.assertEqual(message.html_message, html_content)
+        self.assertEqual(message.get_content()[0], content)
+        self.assertEqual(message.get_content()[1], html_content)
         self.assertEqual(message.from_address, from_address)
         self.assertEqual(message.to_address, to_address[0])
 
@@ -73,5 +115,77 @@ class MailerModelTest(TestCase):
                   priority=constants.PRIORITY_EMAIL_NOW)
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(QueuedMessage.objects.count(), 0)
-        
-        
\ No newline at end of file
+
+    def test_queue_email_messages(self):
+        """
+        Test that queue_email_messages queues a message for every recipient,
+        writing them in batches.
+        """
+        def messages():
+            for i in range(3):
+                yield EmailMessage('Subject %s' % i, 'Body', 'from@example.com',
+                                   ['to%s@example.com' % i, 'cc@example.com'])
+        html = EmailMultiAlternatives('HTML', 'Body', 'from@example.com',
+                                      ['html@example.com'])
+        html.attach_alternative('<p>Body</p>', 'text/html')
+        count = queue_email_messages(list(messages()) + [html], batch_size=4)
+        self.assertEqual(count, 7)
+        self.assertEqual(QueuedMessage.objects.count(), 7)
+        self.assertEqual(Message.objects.filter(
+            to_address='cc@example.com').count(), 3)
+        self.assertEqual(Message.objects.get(subject='Subject 1',
+            to_address='to1@example.com').queuedmessage.priority,
+            constants.PRIORITY_NORMAL)
+        self.assertEqual(Message.objects.get(subject='HTML').get_content(),
+                         ('Body', '<p>Body</p>'))
+
+    def test_queue_email_messages_recipients(self):
+        """
+        A message can be queued for a separate (streamed) list of recipients.
+        """
+        email_message = EmailMessage('Subject', 'Body', 'from@example.com',
+                                     ['ignored@example.com'])
+        recipients = ('to%s@example.com' % i for i in range(5))
+        count = queue_email_messages([email_message], batch_size=2,
+                                     priority=constants.PRIORITY_LOW,
+                                     recipients=recipients,
+                                     queue='newsletter')
+        self.assertEqual(count, 5)
+        self.assertEqual(QueuedMessage.objects.low_priority().count(), 5)
+        self.assertEqual(QueuedMessage.objects.filter(
+            queue='newsletter').count(), 5)
+        self.assertFalse(Message.objects.filter(
+            to_address='ignored@example.com').exists())
+
+    def test_create_with_pks(self):
+        """
+        The primary keys of messages created together are set, even if other
+        messages to the same address were created at the same time.
+        """
+        now = datetime.datetime.now()
+        other = Message.objects.create(to_address='to@example.com',
+                                       date_created=now)
+        messages = [Message(to_address='to@example.com', subject=str(i),
+                            date_created=now) for i in range(3)]
+        create_with_pks(Message, messages)
+        self.assertNotIn(other.pk, [message.pk for message in messages])
+        for message in messages:
+            self.assertEqual(Message.objects.get(pk=message.pk).subject,
+                             message.subject)
+
+
+class QueueTransactionTest(TransactionTestCase):
+
+    def test_queue_email_messages_rolled_back(self):
+        """
+        Messages queued in bulk within a managed transaction are part of it,
+        so rolling it back leaves nothing committed.
+        """
+        with transaction.commit_manually():
+            Blacklist.objects.create(email='blocked@example.com')
+            queue_email_messages([EmailMessage('Subject', 'Body',
+                'from@example.com', ['to1@example.com', 'to2@example.com'])])
+            transaction.rollback()
+        self.assertEqual(Blacklist.objects.count(), 0)
+        self.assertEqual(Message.objects.count(), 0)
+        self.assertEqual(QueuedMessage.objects.count(), 0)
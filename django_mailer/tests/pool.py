@@ -0,0 +1,73 @@
+from django.test import TestCase
+
+from django_mailer.pool import ManagedConnection
+
+import smtplib
+import socket
+
+
+class FakeConnection(object):
+    """
+    A connection which the server drops after it has sent ``limit`` messages.
+
+    """
+
+    def __init__(self, sent, limit=None):
+        self.sent = sent
+        self.limit = limit
+        self.count = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, message):
+        if self.limit and self.count >= self.limit:
+            raise smtplib.SMTPServerDisconnected('Too many messages')
+        self.count += 1
+        self.sent.append((self, message))
+
+
+def deliver(message, connection):
+    connection.send(message)
+
+
+class ManagedConnectionTest(TestCase):
+
+    def test_reconnect(self):
+        """
+        A message sent over a connection which the server has dropped is
+        tried again over a new one.
+        """
+        sent = []
+        connection = ManagedConnection(lambda: FakeConnection(sent, limit=2))
+        for i in range(5):
+            self.assertEqual(connection.attempt(deliver, i), None)
+        self.assertEqual([message for c, message in sent], range(5))
+        self.assertEqual(len(set(c for c, message in sent)), 3)
+
+    def test_no_retry_on_new_connection(self):
+        attempts = []
+
+        def refuse():
+            attempts.append(1)
+            raise socket.error('Connection refused')
+
+        connection = ManagedConnection(refuse)
+        self.assertTrue(isinstance(connection.attempt(deliver, 1),
+                                   socket.error))
+        self.assertEqual(len(attempts), 1)
+
+    def test_recycle(self):
+        """
+        Connections are recycled after sending max_messages messages.
+        """
+        sent = []
+        connection = ManagedConnection(lambda: FakeConnection(sent, limit=2),
+                                       max_messages=2)
+        for i in range(5):
+            self.assertEqual(connection.attempt(deliver, i), None)
+        self.assertEqual(sorted(c.count for c in
+                                set(c for c, message in sent)), [1, 2, 2])
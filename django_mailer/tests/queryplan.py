@@ -0,0 +1,151 @@
+from django.conf import settings as django_settings
+from django.core.management import call_command
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test import TransactionTestCase
+from django.utils import unittest
+
+from django_mailer import engine, send_mail, stats
+from django_mailer.models import Log, Message, QueuedMessage
+
+import datetime
+import re
+
+# The tables which grow with the amount of mail sent.
+TABLES = ('django_mailer_queuedmessage', 'django_mailer_message',
+          'django_mailer_messagebody', 'django_mailer_log')
+
+
+class RecordingCursor(object):
+    """
+    A cursor wrapper which records the SQL (and parameters) executed.
+
+    """
+
+    def __init__(self, cursor, statements):
+        self.cursor = cursor
+        self.statements = statements
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+@unittest.skipUnless(connections[DEFAULT_DB_ALIAS].vendor == 'sqlite',
+                     'Query plans are only checked on SQLite.')
+class QueryPlanTest(TransactionTestCase):
+    """
+    Check that the queries run while sending and cleaning up mail are all
+    backed by indexes, using SQLite's ``EXPLAIN QUERY PLAN``.
+
+    Python's sqlite3 module commits before running an ``EXPLAIN``, so these
+    can't run inside the transaction a ``TestCase`` rolls back.
+
+    """
+
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'django.core.mail.backends.locmem.EmailBackend'
+        # Record the queries run through the connection.
+        self.connection = connections[DEFAULT_DB_ALIAS]
+        self.statements = []
+        self.old_use_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        self.connection.make_debug_cursor = lambda cursor: RecordingCursor(
+            cursor, self.statements)
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        self.stop_recording()
+
+    def stop_recording(self):
+        if 'make_debug_cursor' in self.connection.__dict__:
+            del self.connection.make_debug_cursor
+            self.connection.use_debug_cursor = self.old_use_debug_cursor
+
+    def assertIndexed(self):
+        self.stop_recording()
+        cursor = self.connection.cursor()
+        checked = 0
+        for sql, params in self.statements:
+            if not re.match(r'(SELECT|UPDATE|DELETE)\b', sql):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            details = [row[-1] for row in cursor.fetchall()]
+            # Sorting rows which were looked up by primary key is fine, there
+            # are only ever as many of those as were asked for.
+            by_pk = any('PRIMARY KEY' in detail for detail in details)
+            for detail in details:
+                match = re.match(r'SCAN (TABLE )?(\w+)$', detail)
+                self.assertFalse(match and match.group(2) in TABLES,
+                                 'Full table scan: %s\n%s' % (detail, sql))
+                if not by_pk and any(table in sql for table in TABLES):
+                    self.assertFalse('TEMP B-TREE' in detail,
+                                     'Unindexed sort: %s\n%s' % (detail, sql))
+            checked += 1
+        self.assertTrue(checked)
+
+    def test_send(self):
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(5)])
+        send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'],
+                  send_at=datetime.datetime.now() + datetime.timedelta(1))
+        engine._queue_has_mail()
+        engine._queue_has_mail('default')
+        engine._next_due()
+        engine.send_all()
+        engine.send_all(queue='default')
+        self.assertIndexed()
+
+    def test_due_range(self):
+        """
+        Messages which are due are read off a range of an index, without
+        scanning past the deferred messages which aren't due yet.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@example.com' % i for i in range(5)])
+        QueuedMessage.objects.filter(pk__in=list(
+            QueuedMessage.objects.values_list('pk', flat=True)[:3])).update(
+            deferred=datetime.datetime.now(),
+            next_attempt=datetime.datetime.now() + datetime.timedelta(1))
+        engine._queue_has_mail()
+        engine._queue_has_mail('default')
+        engine.send_all(block_size=1)
+        engine.send_all(queue='default')
+        self.stop_recording()
+        cursor = self.connection.cursor()
+        checked = 0
+        for sql, params in self.statements:
+            if not re.match(r'SELECT\b.*"next_attempt" <= ', sql):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            details = [row[-1] for row in cursor.fetchall()]
+            self.assertTrue(any('next_attempt<' in detail
+                                for detail in details),
+                            'No range of due messages: %s\n%s' %
+                            (details, sql))
+            checked += 1
+        self.assertTrue(checked)
+
+    def test_admin_lists(self):
+        send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        list(QueuedMessage.objects.all()[:100])
+        list(Message.objects.all()[:100])
+        list(Log.objects.all()[:100])
+        stats.oldest_queued()
+        stats.oldest_queued('default')
+        self.assertIndexed()
+
+    def test_cleanup(self):
+        send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'])
+        call_command('cleanup_mail', days=0, verbosity='0')
+        self.assertIndexed()
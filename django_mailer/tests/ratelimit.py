@@ -0,0 +1,132 @@
+from django.conf import settings as django_settings
+from django.core import mail
+from django.test import TestCase
+
+from django_mailer import engine, ratelimit, send_mail, settings
+from django_mailer.models import QueuedMessage, RateLimitBucket
+
+
+class RateLimitTest(TestCase):
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(rate=2, burst=3)
+        now = bucket.updated
+        self.assertEqual(bucket.take(2, now=now), 0)
+        self.assertEqual(bucket.take(1, now=now), 0)
+        self.assertEqual(bucket.take(1, now=now), 0.5)
+        self.assertEqual(bucket.take(1, now=now + 0.5), 0)
+        # A full bucket gives out more than it holds, then has to catch up.
+        self.assertEqual(bucket.take(5, now=now + 10), 0)
+        self.assertEqual(bucket.take(1, now=now + 10), 1.5)
+
+    def test_database_bucket(self):
+        bucket = ratelimit.DatabaseBucket('test', rate=1, burst=2)
+        self.assertEqual(bucket.take(2, now=100), 0)
+        # The state is shared by every bucket with the same key.
+        other = ratelimit.DatabaseBucket('test', rate=1, burst=2)
+        self.assertEqual(other.take(1, now=100.5), 0.5)
+        self.assertEqual(bucket.take(1, now=101), 0)
+        self.assertEqual(RateLimitBucket.objects.count(), 1)
+
+    def test_concurrency(self):
+        limiter = ratelimit.Limiter({'*': {'concurrency': 1}})
+        self.assertEqual(limiter.acquire('example.com'), 0)
+        self.assertEqual(limiter.acquire('example.net'), 0)
+        self.assertTrue(limiter.acquire('example.com'))
+        limiter.release('example.com')
+        self.assertEqual(limiter.acquire('example.com'), 0)
+
+    def test_backend_limit(self):
+        limiter = ratelimit.Limiter({'example.com': {'rate': 1, 'burst': 1}},
+                                    backend_limit={'concurrency': 1})
+        self.assertEqual(limiter.acquire('example.com'), 0)
+        # Held back by the backend's concurrency cap.
+        self.assertTrue(limiter.acquire('example.net'))
+        limiter.release('example.com')
+        self.assertTrue(limiter.acquire('example.com'))
+        self.assertEqual(limiter.acquire('example.net'), 0)
+
+    def test_queues_share_limits(self):
+        """
+        The workers of every queue share the buckets of the global limits,
+        while a queue's own limits are kept separately.
+        """
+        old_limits = settings.RATE_LIMITS
+        old_queues = settings.QUEUES
+        old_shared = settings.SHARED_RATE_LIMITS
+        settings.RATE_LIMITS = {'example.com': {'rate': 1, 'burst': 1}}
+        settings.QUEUES = {
+            'bulk': {},
+            'own': {'rate_limits': {'example.com': {'rate': 1, 'burst': 1}}},
+        }
+        settings.SHARED_RATE_LIMITS = True
+        ratelimit.reset()
+        try:
+            self.assertEqual(
+                ratelimit.get_limiter().acquire('example.com'), 0)
+            self.assertTrue(
+                ratelimit.get_limiter(queue='bulk').acquire('example.com'))
+            self.assertEqual(
+                ratelimit.get_limiter(queue='own').acquire('example.com'), 0)
+            self.assertEqual(RateLimitBucket.objects.count(), 2)
+        finally:
+            settings.RATE_LIMITS = old_limits
+            settings.QUEUES = old_queues
+            settings.SHARED_RATE_LIMITS = old_shared
+            ratelimit.reset()
+
+
+class RateLimitedSendTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'django.core.mail.backends.locmem.EmailBackend'
+        self.old_limits = settings.RATE_LIMITS
+        settings.RATE_LIMITS = {'slow.example.com': {'rate': 20, 'burst': 1}}
+        ratelimit.reset()
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        settings.RATE_LIMITS = self.old_limits
+        ratelimit.reset()
+
+    def test_interleaving(self):
+        """
+        Mail to other domains is sent while a domain is held back by its rate
+        limit.
+        """
+        slow = ['to%s@slow.example.com' % i for i in range(3)]
+        fast = ['to%s@fast.example.com' % i for i in range(3)]
+        send_mail('Subject', 'Body', 'from@example.com', slow + fast)
+        engine.send_all()
+        self.assertEqual(QueuedMessage.objects.count(), 0)
+        sent = [m.to[0] for m in mail.outbox]
+        self.assertEqual(sorted(sent), sorted(slow + fast))
+        self.assertTrue(max(sent.index(to) for to in fast) <
+                        sent.index(slow[1]))
+
+    def test_leases_renewed_while_waiting(self):
+        """
+        Leases on messages held back by a rate limit are renewed, so no other
+        worker claims them in the meantime.
+        """
+        settings.RATE_LIMITS = {'slow.example.com': {'rate': 4, 'burst': 1}}
+        ratelimit.reset()
+        old_lease_seconds = settings.LEASE_SECONDS
+        settings.LEASE_SECONDS = 0.4
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to%s@slow.example.com' % i for i in range(4)])
+        claimed = []
+        original_record = engine._record_delivery
+        def record(*args, **kwargs):
+            claimed.extend(QueuedMessage.objects.claim('other-worker'))
+            return original_record(*args, **kwargs)
+        engine._record_delivery = record
+        try:
+            engine.send_all(use_lock=False)
+        finally:
+            engine._record_delivery = original_record
+            settings.LEASE_SECONDS = old_lease_seconds
+        self.assertEqual(claimed, [])
+        self.assertEqual(len(mail.outbox), 4)
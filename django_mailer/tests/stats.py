@@ -0,0 +1,93 @@
+from django.conf import settings as django_settings
+from django.core.management import call_command
+from django.test import TestCase
+
+from django_mailer import circuit, engine, send_mail, stats
+from django_mailer.models import (Blacklist, DeliveryStat, QueuedMessage,
+                                  QueueStat, QueueStatChange)
+
+from StringIO import StringIO
+import datetime
+import sys
+
+
+class StatsTest(TestCase):
+
+    def setUp(self):
+        self.old_backend = django_settings.EMAIL_BACKEND
+        django_settings.EMAIL_BACKEND = \
+            'django.core.mail.backends.locmem.EmailBackend'
+        circuit.reset()
+
+    def tearDown(self):
+        django_settings.EMAIL_BACKEND = self.old_backend
+        circuit.reset()
+
+    def assertDepth(self, queue, queued, deferred):
+        depths = dict((row[0], row[1:]) for row in stats.queue_depths())
+        self.assertEqual(depths.get(queue, (0, 0)), (queued, deferred))
+
+    def test_counters(self):
+        """
+        The counters are updated as mail is queued and sent.
+        """
+        Blacklist.objects.create(email='skip@example.com')
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to@example.com', 'skip@example.com'])
+        send_mail('Subject', 'Body', 'from@example.com', ['to@example.com'],
+                  queue='other')
+        self.assertDepth('default', 2, 0)
+        self.assertDepth('other', 1, 0)
+        engine.send_all(queue='default')
+        self.assertDepth('default', 0, 0)
+        self.assertDepth('other', 1, 0)
+        django_settings.EMAIL_BACKEND = \
+            'django_mailer.tests.base.ConnectionErrorBackend'
+        engine.send_all(queue='other')
+        self.assertDepth('other', 1, 1)
+        self.assertEqual(stats.delivery_totals(),
+                         [(stats.get_period(), 1, 1, 1)])
+        self.assertEqual(DeliveryStat.objects.get(failed=1).backend,
+                         'django_mailer.tests.base.ConnectionErrorBackend')
+
+    def test_queue_changes(self):
+        """
+        Queueing mail only inserts changes, which are added to the counters
+        later.
+        """
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com'])
+        send_mail('Subject', 'Body', 'from@example.com', ['to3@example.com'])
+        self.assertEqual(QueueStat.objects.count(), 0)
+        self.assertEqual(QueueStatChange.objects.count(), 2)
+        self.assertEqual(stats.fold_queue_changes(), 2)
+        self.assertEqual(QueueStatChange.objects.count(), 0)
+        stat = QueueStat.objects.get()
+        self.assertEqual((stat.queue, stat.queued, stat.deferred),
+                         ('default', 3, 0))
+        self.assertEqual(stats.fold_queue_changes(), 0)
+
+    def test_rebuild(self):
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com'])
+        QueuedMessage.objects.all()[:1].get().delete()
+        QueuedMessage.objects.update(deferred=datetime.datetime.now())
+        self.assertDepth('default', 2, 0)
+        stats.rebuild_queue_stats()
+        self.assertDepth('default', 1, 1)
+
+    def test_commands(self):
+        send_mail('Subject', 'Body', 'from@example.com',
+                  ['to1@example.com', 'to2@example.com'])
+        old_stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertRaises(SystemExit, call_command, 'send_mail',
+                              count=True)
+            call_command('mailer_stats', verbosity='0')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+        self.assertTrue(output.startswith('2 queued messages (and 0 deferred '
+                                          'messages).\n'))
+        self.assertTrue('default: 2 queued (0 deferred), oldest queued '
+                        in output)
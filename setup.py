@@ -17,6 +17,7 @@ setup(
         'django_mailer.management.commands',
         'django_mailer.tests',
     ],
+    package_data={'django_mailer': ['sql/*.sql', 'sql/upgrade/*.sql']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',